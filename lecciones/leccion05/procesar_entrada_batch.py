@@ -1,12 +1,27 @@
 import json
 import os
 import sys
-from langchain_ollama import OllamaLLM, OllamaEmbeddings
+from datetime import datetime
+from langchain_ollama import OllamaEmbeddings
 from langchain_chroma import Chroma
 from langchain_text_splitters import CharacterTextSplitter
 
+# Extracción con esquema JSON compartida con la API: scrics/api tiene que estar en PYTHONPATH
+# (en el contenedor ya lo está: ENV PYTHONPATH=/app/scrics/api en el Dockerfile)
+try:
+    from cliente_ollama import ClienteOllama
+    from extraccion_estructurada import ExtractorEstructurado
+except ModuleNotFoundError as e:
+    if e.name not in ("cliente_ollama", "extraccion_estructurada"):
+        raise
+    print(f"ERROR: no se encuentra el módulo '{e.name}' de la API (scrics/api).")
+    print("Añade scrics/api a PYTHONPATH, por ejemplo: export PYTHONPATH=/app/scrics/api")
+    sys.exit(1)
+
 # --- CONFIGURACIÓN ---
 OLLAMA_LLM_MODEL = "llama3.1:8b"
+# Cascada para la extracción: primero el modelo pequeño y solo si falla la validación, el grande
+OLLAMA_LLM_CASCADA = ["llama3.2:1b", OLLAMA_LLM_MODEL]
 #OLLAMA_LLM_MODEL = "qwen3:32b"
 #OLLAMA_LLM_MODEL = "qwen2.5:7b" 
 OLLAMA_EMBED_MODEL = "nomic-embed-text" 
@@ -33,8 +48,8 @@ JSON:
 NO respondas nada más. Devuelve SOLO el objeto JSON solicitado, sin explicaciones ni contexto adicional.
 """
 
-# Inicializar el LLM para la extracción (solo una vez)
-llm_extractor = OllamaLLM(model=OLLAMA_LLM_MODEL, system=EXTRACTION_PROMPT)
+# Inicializar el extractor (solo una vez): el esquema se pasa a Ollama en `format`
+llm_extractor = ExtractorEstructurado(ClienteOllama(timeout=120))
 
 # --- 2. FUNCIONES ---
 
@@ -78,6 +93,18 @@ def reindex_rag():
     except Exception as e:
         print(f"Error durante la re-indexación: {e}")
 
+def validar_metadata(metadata):
+    """La fecha, si hay, debe ser AAAA-MM-DD y no futura; el TIPO no puede ir vacío."""
+    errores = [] if metadata.get("TIPO", "").strip() else ["TIPO vacío"]
+    fecha = metadata.get("FECHA", "")
+    if fecha:
+        try:
+            if datetime.strptime(fecha, "%Y-%m-%d") > datetime.now():
+                errores.append(f"FECHA '{fecha}' en el futuro")
+        except ValueError:
+            errores.append(f"FECHA '{fecha}' no tiene el formato AAAA-MM-DD")
+    return errores
+
 def process_single_entry(texto_nota_voz: str): 
     """Procesa una sola entrada, extrae etiquetas y la escribe en el archivo."""
     
@@ -93,26 +120,7 @@ def process_single_entry(texto_nota_voz: str):
             {"role": "system", "content": EXTRACTION_PROMPT},
             {"role": "user", "content": texto_nota_voz}
         ]
-        json_output_str = llm_extractor.invoke(messages).strip()
-        json_output_str = json_output_str.strip()
-        if json_output_str.startswith("```json"):
-            json_output_str = json_output_str[7:]
-        if json_output_str.endswith("```"):
-            json_output_str = json_output_str[:-3]
-        json_output_str = json_output_str.strip()
-        import re
-        matches = re.findall(r'\{[\s\S]*?\}', json_output_str)
-        metadata = None
-        for bloque in matches:
-            try:
-                metadata = json.loads(bloque)
-                break
-            except Exception as ex_json:
-                print(f"[DEBUG] Fallo al parsear bloque JSON: {bloque}\nError: {ex_json}")
-                continue
-        if not metadata:
-            print(f"[DEBUG] No se pudo extraer JSON válido de la respuesta: {json_output_str}")
-            raise ValueError("No se pudo extraer JSON válido")
+        metadata, modelo = llm_extractor.extraer_cascada("diario", messages, OLLAMA_LLM_CASCADA, validar=validar_metadata)
         fecha = metadata.get('FECHA', 'FECHA_DESCONOCIDA')
         tipo = metadata.get('TIPO', 'EVENTO_DESCONOCIDO')
         lugar = metadata.get('LUGAR', 'LUGAR_DESCONOCIDO')
@@ -122,7 +130,7 @@ def process_single_entry(texto_nota_voz: str):
         # --- C. Guardar en el Archivo de Texto ---
         with open(DIARY_FILE, 'a', encoding='utf-8') as f:
             f.write(entrada_rag)
-        print(f"-> Entrada guardada con etiquetas: {etiquetas}")
+        print(f"-> Entrada guardada con etiquetas ({modelo}): {etiquetas}")
     except Exception as e:
         print(f"--- ERROR: No se pudo extraer la metadata. Saltando entrada. ---")
         print(f"[DEBUG] Motivo: {e}")
@@ -155,6 +163,7 @@ if __name__ == "__main__":
             process_single_entry(line.strip())
             
         print("\n--- PROCESAMIENTO DE ARCHIVO FINALIZADO ---")
+        print(f"Extracciones: {llm_extractor.estadisticas()}")
         reindex_rag()
         
         print("\n¡El archivo RAG ha sido actualizado y está listo para ser consultado!")
@@ -1,104 +1,446 @@
-from flask import Flask, request, Response
+from flask import Flask, request, Response, stream_with_context, g, has_request_context
+from contextlib import contextmanager
 import json
 import os
-import shutil
 from datetime import datetime
-import requests
 import logging
-from langchain_ollama import OllamaEmbeddings
-from langchain_chroma import Chroma
-from langchain_text_splitters import CharacterTextSplitter
+import re
+import sys
 import traceback
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 from datetime import timedelta
-
-# Configurar logging detallado
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('/app/datos/api_ollama_server.log'),
-        logging.StreamHandler()
-    ]
-)
+from cliente_ollama import ClienteOllama, OllamaError, OllamaNoDisponible
+from historial_store import parsear_historial_legado
+from metricas import RegistroMetricas
+from modelos_residentes import ModelosResidentes
+from perfil_imports import modulos_pesados_cargados, registrar_perfil
+from persona_store import PersonaStore
+from presupuesto_tokens import (empaquetar_fragmentos, estimar_tokens, opciones_modelo, presupuesto_modelo,
+                                recortar_historial, tokens_mensaje)
+from sesiones import GestorSesiones
+from cache_respuestas import CacheRespuestas, clave_cache
+from bloqueo_ficheros import BloqueoFichero, BloqueosPorNombre, escribir_atomico
+from cache_semantica import CacheSemantica
+from planificador import Planificador, Saturado
+from extractor_local import ExtractorLocal
+from extraccion_estructurada import ExtraccionError, ExtractorEstructurado
+from rag_diario import DiarioVectorial
+from seleccion_eventos import SelectorEventos, renderizar_evento
+from registro_logs import CARGA, configurar_logging, logger_a_fichero
+from trabajos import ColaTrabajos
+
+# Logging asíncrono (cola + hilo de fondo). El entorno fija el nivel y cuánto de los
+# payloads grandes se escribe; OLLAMA_API_LOG_NIVEL permite forzar el nivel.
+# OLLAMA_API_LOG_FILE vacío deja solo la consola (lo usa el diagnóstico de imports).
+LOG_FILE = os.environ.get("OLLAMA_API_LOG_FILE", '/app/datos/api_ollama_server.log') or None
+LOG_ENTORNO = os.environ.get("OLLAMA_API_ENTORNO", "desarrollo")
+LOG_NIVEL = os.environ.get("OLLAMA_API_LOG_NIVEL")
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_COPIAS = 5
+# Con gunicorn hay varios procesos escribiendo el mismo fichero: no se rota desde Python
+# (WatchedFileHandler + logrotate). OLLAMA_API_LOG_ROTAR=1/0 fuerza una u otra opción.
+LOG_ROTAR = os.environ.get("OLLAMA_API_LOG_ROTAR", "0" if "gunicorn" in sys.modules else "1") == "1"
+# Diagnóstico de arranque: mide en un proceso aparte lo que cuesta importar el servidor
+PERFIL_IMPORTS = os.environ.get("OLLAMA_API_PERFIL_IMPORTS") == "1"
+
+configurar_logging(LOG_FILE, entorno=LOG_ENTORNO, nivel=LOG_NIVEL, max_bytes=LOG_MAX_BYTES, copias=LOG_COPIAS,
+                   rotar=LOG_ROTAR)
 logger = logging.getLogger(__name__)
 
 # -----------------------------
 # Configuración Ollama
 # -----------------------------
-OLLAMA_URL = "http://localhost:11434/api/chat"
+OLLAMA_BASE_URL = "http://localhost:11434"
+OLLAMA_URL = f"{OLLAMA_BASE_URL}/api/chat"
 MODEL_NAME = "llama3.2:1b"
+EMBED_MODEL = "nomic-embed-text"
+# Modelo de cada uso: "chat" (/preguntar), "resumen" (/resumir y resúmenes automáticos) y
+# "embeddings" (caché semántica y diario vectorial). La extracción va por MODELOS_EXTRACCION.
+RUTAS_MODELOS = {
+    "chat": MODEL_NAME,
+    "resumen": MODEL_NAME,
+    "embeddings": EMBED_MODEL,
+}
+MODELO_CHAT = RUTAS_MODELOS["chat"]
+MODELO_RESUMEN = RUTAS_MODELOS["resumen"]
+MODELO_EMBEDDINGS = RUTAS_MODELOS["embeddings"]
+# Cascada de modelos por tarea de extracción: del más barato al más caro. Solo se pasa al
+# siguiente si la respuesta no es válida (esquema, fecha coherente, campos obligatorios).
+MODELOS_EXTRACCION = {
+    "diario": [MODEL_NAME, "llama3.1:8b"],
+    "evento": [MODEL_NAME, "llama3.1:8b"],
+}
+OLLAMA_POOL_SIZE = 10        # conexiones keep-alive reutilizadas
+OLLAMA_REINTENTOS = 3        # reintentos ante errores de conexión
+OLLAMA_BACKOFF = 0.5         # segundos, se duplica en cada reintento
+OLLAMA_UMBRAL_FALLOS = 5     # fallos seguidos que abren el circuito
+OLLAMA_TIEMPO_APERTURA = 30  # segundos que el circuito permanece abierto
+TIMEOUT_CHAT = 60
+TIMEOUT_RESUMEN = 120
+EXTRACCION_REINTENTOS = 2    # reintentos si el JSON extraído no cumple el esquema
+EXTRACCION_STREAM = True     # corta la generación en cuanto llega un objeto JSON válido
+# Los modelos de RUTAS_MODELOS y el primero de cada cascada se cargan al arrancar y se
+# fijan en memoria con este keep_alive (-1: sin caducidad). El refresco los vuelve a
+# cargar si Ollama los ha descargado (reinicio, falta de memoria).
+MODELOS_KEEP_ALIVE = -1
+MODELOS_REFRESCO_INTERVALO = 300  # segundos; None para no refrescar
+TIMEOUT_CARGA_MODELO = 180
+# Control de admisión: generaciones simultáneas por modelo (como OLLAMA_NUM_PARALLEL) y
+# colas por clase, de mayor a menor prioridad. Con la cola llena se responde 429.
+PLANIFICADOR_MAX_EN_VUELO = 2
+PLANIFICADOR_MAX_POR_MODELO = {}  # {"llama3.1:8b": 1} para limitar un modelo concreto
+PLANIFICADOR_CLASES = {
+    "chat": {"prioridad": 0, "max_cola": 16, "espera_max": 30},
+    "extraccion": {"prioridad": 1, "max_cola": 32, "espera_max": 60},
+    "resumen": {"prioridad": 2, "max_cola": 8, "espera_max": None},
+}
+CONTEXTO_CACHE_MAX = 256     # personas con el system prompt renderizado en memoria
+EVENTOS_PRESUPUESTO_TOKENS = 512  # tokens máximos de eventos en el system prompt
+EVENTOS_EMBEDDINGS = True    # puntuar también por similitud de embeddings (si no, fecha y palabras)
+HISTORIAL_MAX_TURNOS = 50    # turnos del historial que se envían en cada pregunta
+RESUMEN_AUTO_TURNOS = 40     # encola un resumen al superar estos turnos (None para desactivar)
+TRABAJOS_HILOS = 1           # hilos que ejecutan los trabajos en segundo plano
+SESION_KEEP_ALIVE = "30m"    # tiempo que Ollama mantiene el modelo (y su caché KV) cargado
+SESIONES_MAX = 100           # sesiones de persona guardadas en memoria
+SESIONES_MAX_BYTES = 50 * 1024 * 1024
+SESIONES_TTL = 1800          # segundos sin uso antes de descartar una sesión
+SESIONES_MEMORIA_MINIMA_MB = 512  # por debajo de esta memoria libre se desalojan sesiones
+CACHE_RESPUESTAS_MAX = 1000  # preguntas sin persona guardadas
+CACHE_RESPUESTAS_TTL = 3600  # segundos
+CACHE_RESPUESTAS_FILE = "/app/datos/cache_respuestas.json"  # None para no persistir
+CACHE_PERSISTIR_INTERVALO = 60
+TIMEOUT_EMBED = 10
+CACHE_SEMANTICA_UMBRAL = 0.92    # similitud coseno mínima para reutilizar una respuesta
+CACHE_SEMANTICA_TTL = 3600
+CACHE_SEMANTICA_MAX = 500        # preguntas guardadas por persona
+CACHE_SEMANTICA_PERSONAS = False # con persona solo se usa si la petición trae "cache_semantica": true
+# Contextos, eventos e historial de todas las personas. Los ficheros que aparezcan en
+# CONTEXTOS_DIR e HISTORIAL_DIR se importan al arrancar (y los contextos nuevos, al usarlos).
+PERSONAS_DB = "/app/datos/personas.db"
+RESUMEN_BLOQUEOS_DIR = "/app/datos/.locks/resumen"  # un resumen a la vez por persona, entre workers
 HISTORIAL_DIR = "/app/datos/historial"
 CONTEXTOS_DIR = "/app/datos/contextos"
 DIARIO_FILE = "/app/datos/diario/diario_personal_vida.txt"
 DIARIO_CHROMA_DB = "/app/datos/diario/diario_chroma_db"
+DIARIO_CHROMA_ESCRITOR = DIARIO_CHROMA_DB + ".escritor.lock"  # solo un worker escribe en Chroma
+DIARIO_SEPARADOR = "\n---\n"
+CHROMA_FLUSH_INTERVALO = 5   # segundos entre volcados de entradas pendientes
+CHROMA_MAX_LOTE = 64         # entradas pendientes que fuerzan un volcado
+RAG_LOTE_CONCURRENCIA = 4    # extracciones simultáneas contra Ollama en /procesar_rag_lote
+RAG_LOTE_MAX = 5000          # frases máximas por petición
+EXTRACTOR_LOCAL_UMBRAL = 0.8 # confianza mínima del extractor local para no preguntar al LLM
+LUGARES_FILE = "/app/datos/diario/lugares.json"  # lista JSON de sitios conocidos extra
+# /preguntar con "rag": true añade los fragmentos del diario más parecidos a la pregunta
+RAG_K = 4                    # fragmentos recuperados de Chroma
+RAG_PRESUPUESTO_TOKENS = 1024  # tokens máximos de diario en el prompt
+RAG_CACHE_MAX = 256          # búsquedas recientes guardadas (por pregunta normalizada)
+RAG_CACHE_TTL = 600
+RAG_CABECERA = ("Fragmentos del diario personal del usuario que pueden ayudar a responder. "
+                "Úsalos solo si son relevantes para la pregunta:\n")
+
+# Bloqueo del diario válido también entre procesos (varios workers de gunicorn)
+bloqueo_diario = BloqueoFichero(DIARIO_FILE + ".lock")
+bloqueos_resumen = BloqueosPorNombre(RESUMEN_BLOQUEOS_DIR)
+
+# Cliente compartido por todos los endpoints
+ollama = ClienteOllama(
+    base_url=OLLAMA_BASE_URL,
+    pool_size=OLLAMA_POOL_SIZE,
+    timeout=TIMEOUT_CHAT,
+    reintentos=OLLAMA_REINTENTOS,
+    backoff=OLLAMA_BACKOFF,
+    umbral_fallos=OLLAMA_UMBRAL_FALLOS,
+    tiempo_apertura=OLLAMA_TIEMPO_APERTURA
+)
+
+persona_store = PersonaStore(PERSONAS_DB)
+cola_trabajos = ColaTrabajos(num_hilos=TRABAJOS_HILOS, almacen=persona_store)
+sesiones = GestorSesiones(
+    max_sesiones=SESIONES_MAX,
+    max_bytes=SESIONES_MAX_BYTES,
+    ttl=SESIONES_TTL,
+    memoria_minima_mb=SESIONES_MEMORIA_MINIMA_MB
+)
+diario_vectorial = DiarioVectorial(
+    DIARIO_CHROMA_DB,
+    embed_model=MODELO_EMBEDDINGS,
+    intervalo_flush=CHROMA_FLUSH_INTERVALO,
+    max_lote=CHROMA_MAX_LOTE,
+    separador=DIARIO_SEPARADOR,
+    ruta_escritor=DIARIO_CHROMA_ESCRITOR
+)
+planificador = Planificador(
+    max_en_vuelo=PLANIFICADOR_MAX_EN_VUELO,
+    clases=PLANIFICADOR_CLASES,
+    max_por_modelo=PLANIFICADOR_MAX_POR_MODELO
+)
+extractor_estructurado = ExtractorEstructurado(
+    ollama, reintentos=EXTRACCION_REINTENTOS, stream=EXTRACCION_STREAM,
+    admision=lambda modelo: planificador.admitir("extraccion", modelo)
+)
+extractor_local = ExtractorLocal(umbral=EXTRACTOR_LOCAL_UMBRAL, lugares_file=LUGARES_FILE)
+# Modelos que se precargan: los de cada ruta y el primer escalón de cada cascada
+# (los siguientes solo se usan cuando falla el primero y se cargan bajo demanda)
+modelos_residentes = ModelosResidentes(
+    ollama,
+    {
+        **{cascada[0]: "chat" for cascada in MODELOS_EXTRACCION.values()},
+        MODELO_CHAT: "chat",
+        MODELO_RESUMEN: "chat",
+        MODELO_EMBEDDINGS: "embeddings",
+    },
+    keep_alive=MODELOS_KEEP_ALIVE,
+    intervalo=MODELOS_REFRESCO_INTERVALO,
+    timeout=TIMEOUT_CARGA_MODELO
+)
+cache_semantica = CacheSemantica(
+    umbral=CACHE_SEMANTICA_UMBRAL,
+    ttl=CACHE_SEMANTICA_TTL,
+    max_por_espacio=CACHE_SEMANTICA_MAX
+)
+cache_respuestas = CacheRespuestas(
+    max_entradas=CACHE_RESPUESTAS_MAX,
+    ttl=CACHE_RESPUESTAS_TTL,
+    ruta_persistencia=CACHE_RESPUESTAS_FILE
+)
+cache_recuperacion = CacheRespuestas(max_entradas=RAG_CACHE_MAX, ttl=RAG_CACHE_TTL)
+selector_eventos = SelectorEventos(
+    embeber=(lambda textos: ollama.embeddings(textos, MODELO_EMBEDDINGS, timeout=TIMEOUT_EMBED))
+    if EVENTOS_EMBEDDINGS else None,
+    presupuesto=EVENTOS_PRESUPUESTO_TOKENS,
+    max_indices=CONTEXTO_CACHE_MAX
+)
+
+# -----------------------------
+# Métricas (GET /metrics)
+# -----------------------------
+METRICAS_UMBRAL_CARGA = 0.1  # segundos de load_duration a partir de los que se cuenta una carga del modelo
+
+metricas = RegistroMetricas()
+m_peticiones = metricas.contador(
+    "api_peticiones_total", "Peticiones HTTP atendidas", ("endpoint", "metodo", "status"))
+m_duracion_peticion = metricas.histograma(
+    "api_peticion_duracion_segundos", "Duración de las peticiones HTTP (incluido el streaming)", ("endpoint",))
+m_tokens_prompt = metricas.contador(
+    "ollama_tokens_prompt_total", "Tokens de prompt evaluados por Ollama", ("modelo",))
+m_tokens_generados = metricas.contador(
+    "ollama_tokens_generados_total", "Tokens generados por Ollama", ("modelo",))
+m_prompt_eval = metricas.histograma(
+    "ollama_prompt_eval_segundos", "Tiempo de evaluación del prompt por generación", ("modelo",))
+m_generacion = metricas.histograma(
+    "ollama_generacion_segundos", "Tiempo de generación de tokens por generación", ("modelo",))
+m_tokens_segundo = metricas.histograma(
+    "ollama_tokens_por_segundo", "Velocidad de generación (eval_count / eval_duration)", ("modelo",),
+    buckets=(1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300))
+m_cargas = metricas.contador(
+    "ollama_cargas_modelo_total", "Generaciones que han tenido que cargar el modelo en memoria", ("modelo",))
+m_carga_segundos = metricas.contador(
+    "ollama_carga_modelo_segundos_total", "Tiempo total cargando modelos", ("modelo",))
+m_cortadas = metricas.contador(
+    "ollama_generaciones_cortadas_total", "Generaciones en streaming cortadas antes de terminar", ("modelo",))
+
+@ollama.observar
+def observar_generacion(modelo, data):
+    """
+    Recoge las estadísticas que Ollama devuelve al final de cada generación. Las cortadas
+    (`parcial`) solo traen los tokens generados y el tiempo medido aquí hasta el corte.
+    """
+    ns = 1e9
+    m_tokens_prompt.inc(data.get("prompt_eval_count") or 0, modelo=modelo)
+    m_tokens_generados.inc(data.get("eval_count") or 0, modelo=modelo)
+    if data.get("parcial"):
+        m_cortadas.inc(modelo=modelo)
+        if data.get("eval_duration"):
+            m_generacion.observar(data["eval_duration"] / ns, modelo=modelo)
+        return
+    if data.get("prompt_eval_duration"):
+        m_prompt_eval.observar(data["prompt_eval_duration"] / ns, modelo=modelo)
+    if data.get("eval_duration"):
+        m_generacion.observar(data["eval_duration"] / ns, modelo=modelo)
+        if data.get("eval_count"):
+            m_tokens_segundo.observar(data["eval_count"] / (data["eval_duration"] / ns), modelo=modelo)
+    carga = (data.get("load_duration") or 0) / ns
+    if carga >= METRICAS_UMBRAL_CARGA:
+        m_cargas.inc(modelo=modelo)
+        m_carga_segundos.inc(carga, modelo=modelo)
+
+@metricas.colector
+def metricas_estado():
+    """Valores que ya se llevan en las cachés, el planificador y el historial."""
+    caches = {
+        "respuestas": cache_respuestas.estadisticas(),
+        "semantica": cache_semantica.estadisticas(),
+        "recuperacion": cache_recuperacion.estadisticas(),
+    }
+    yield ("cache_aciertos_total", "counter", "Aciertos de caché",
+           [({"cache": n}, e["aciertos"]) for n, e in caches.items()])
+    yield ("cache_fallos_total", "counter", "Fallos de caché",
+           [({"cache": n}, e["fallos"]) for n, e in caches.items()])
+    yield ("cache_ratio_aciertos", "gauge", "Proporción de aciertos de caché",
+           [({"cache": n}, e["ratio_aciertos"]) for n, e in caches.items()])
+    yield ("cache_entradas", "gauge", "Entradas guardadas en caché",
+           [({"cache": n}, e["entradas"]) for n, e in caches.items()])
+
+    estado = planificador.estadisticas()
+    yield ("planificador_en_cola", "gauge", "Generaciones esperando turno",
+           [({"clase": c}, e["en_cola"]) for c, e in estado["clases"].items()])
+    yield ("planificador_rechazadas_total", "counter", "Generaciones rechazadas con 429",
+           [({"clase": c}, e["rechazadas"]) for c, e in estado["clases"].items()])
+    yield ("planificador_espera_media_segundos", "gauge", "Espera media en cola",
+           [({"clase": c}, e["espera_media_s"]) for c, e in estado["clases"].items()])
+    yield ("planificador_en_vuelo", "gauge", "Generaciones en curso",
+           [({"modelo": m}, e["en_vuelo"]) for m, e in estado["modelos"].items()])
+
+    yield ("extraccion_exitos_total", "counter", "Extracciones estructuradas válidas",
+           [({"esquema": n}, e["exitos"]) for n, e in extractor_estructurado.estadisticas().items()])
+    yield ("extraccion_fallos_total", "counter", "Extracciones estructuradas fallidas",
+           [({"esquema": n}, e["fallos"]) for n, e in extractor_estructurado.estadisticas().items()])
+
+    turnos, tamanos = [], []
+    for persona, n, tamano in persona_store.resumen_historial():
+        turnos.append(({"persona": persona}, n))
+        tamanos.append(({"persona": persona}, tamano))
+    yield ("historial_turnos", "gauge", "Turnos guardados en el historial de cada persona", turnos)
+    yield ("historial_bytes", "gauge", "Tamaño del historial de cada persona", tamanos)
+    yield ("sesiones_activas", "gauge", "Sesiones de persona en memoria", [({}, sesiones.estadisticas()["sesiones"])])
+
+# -----------------------------
+# Tiempos por fase (Server-Timing)
+# -----------------------------
+PETICION_LENTA_UMBRAL = 5.0  # segundos; las peticiones más lentas van a PETICIONES_LENTAS_LOG
+PETICIONES_LENTAS_LOG = "/app/datos/peticiones_lentas.log"
+
+logger_lento = logger_a_fichero("peticiones_lentas", PETICIONES_LENTAS_LOG if LOG_FILE else None, rotar=LOG_ROTAR)
+
+def registrar_fase(nombre, duracion):
+    """Apunta la duración de una fase en la petición actual (fuera de una petición no hace nada)."""
+    if has_request_context():
+        g.setdefault("fases", []).append((nombre, duracion))
+
+@contextmanager
+def fase(nombre):
+    inicio = time.monotonic()
+    try:
+        yield
+    finally:
+        registrar_fase(nombre, time.monotonic() - inicio)
+
+def cabecera_server_timing(fases, total):
+    partes = [f"{nombre};dur={duracion * 1000:.1f}" for nombre, duracion in fases]
+    partes.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(partes)
 
 # -----------------------------
 # Funciones de contexto
 # -----------------------------
-def cargar_contexto(nombre_persona):
-    archivo = os.path.join(CONTEXTOS_DIR, f"{nombre_persona}.json")
-    if not os.path.exists(archivo):
-        return ""
-    with open(archivo, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
-    contexto = f"Nombre: {data.get('nombre', '')}\n"
-    contexto += f"Relación con el usuario: {data.get('relacion', '')}\n"
-    contexto += f"Personalidad: {data.get('personalidad', '')}\n"
+# Caché LRU de la parte fija del system prompt (sin eventos) por persona: {persona: (version, contexto)}
+_contextos_cache = OrderedDict()
+_contextos_cache_lock = threading.Lock()
+
+def renderizar_contexto(data, eventos=None):
+    """System prompt de la persona. `eventos` son las líneas ya elegidas; si es None se usan todos los de `data`."""
+    lineas = [
+        f"Nombre: {data.get('nombre', '')}",
+        f"Relación con el usuario: {data.get('relacion', '')}",
+        f"Personalidad: {data.get('personalidad', '')}",
+    ]
     proyectos = data.get("proyectos", [])
     if proyectos:
-        contexto += "Proyectos y actividades:\n"
-        for p in proyectos:
-            contexto += f"- {p}\n"
+        lineas.append("Proyectos y actividades:")
+        lineas.extend(f"- {p}" for p in proyectos)
 
-    eventos = data.get("eventos", [])
+    if eventos is None:
+        eventos = [renderizar_evento(e) for e in data.get("eventos", [])]
     if eventos:
-        contexto += "Eventos importantes:\n"
-        for e in eventos:
-            tipo = e.get('tipo', '')
-            nombre = e.get('nombre', '')
-            lugar = e.get('lugar', '')  
-            fecha = e.get('fecha', '')
-            notas = e.get('notas', '')
-            contexto += f"- {tipo}: {nombre} en {lugar} el {fecha}"
-            if notas:
-                contexto += f" | Notas: {notas}"
-            contexto += "\n"
-
-    return contexto.strip()
+        lineas.append("Eventos importantes:")
+        lineas.extend(eventos)
+
+    return "\n".join(lineas).strip()
+
+def clave_persona(nombre_persona):
+    """
+    Clave de la persona en las cachés en memoria (contextos, caché semántica, sesiones).
+    Como en PersonaStore, no distingue mayúsculas: "laia" y "Laia" son la misma persona.
+    """
+    return nombre_persona.lower()
+
+def invalidar_contexto(nombre_persona):
+    """
+    Quita la parte fija de la persona de la caché. El índice de eventos no se toca: al
+    cambiar la versión se reconstruye reutilizando los embeddings de los eventos que ya tenía.
+    """
+    with _contextos_cache_lock:
+        _contextos_cache.pop(clave_persona(nombre_persona), None)
+
+def cargar_contexto(nombre_persona, pregunta=None, vector=None):
+    """
+    Devuelve (system prompt, info) de la persona. La parte fija y el índice de eventos se
+    guardan en caché y solo se vuelven a leer de la base de datos si cambia la versión de
+    su contexto (nuevo evento, reimportación).
+
+    Si los eventos no caben en EVENTOS_PRESUPUESTO_TOKENS se meten solo los más relevantes
+    para `pregunta` (`vector` es su embedding, si ya se tiene). Sin pregunta se eligen por
+    cercanía a hoy, así el prompt es estable entre turnos (sesiones, resúmenes).
+    """
+    version = persona_store.version(nombre_persona)
+    if version is None:
+        # Persona sin contexto: todavía se puede crear dejando su JSON en CONTEXTOS_DIR
+        archivo = os.path.join(CONTEXTOS_DIR, f"{nombre_persona}.json")
+        if os.path.exists(archivo) and persona_store.importar_contexto(archivo, nombre_persona):
+            version = persona_store.version(nombre_persona)
+        if version is None:
+            invalidar_contexto(nombre_persona)
+            selector_eventos.invalidar(nombre_persona)
+            return "", None
+
+    clave = clave_persona(nombre_persona)
+    with _contextos_cache_lock:
+        cacheado = _contextos_cache.get(clave)
+        if cacheado and cacheado[0] == version:
+            _contextos_cache.move_to_end(clave)
+    if not cacheado or cacheado[0] != version:
+        cacheado = (version, persona_store.datos(nombre_persona) or {})
+        with _contextos_cache_lock:
+            _contextos_cache[clave] = cacheado
+            _contextos_cache.move_to_end(clave)
+            while len(_contextos_cache) > CONTEXTO_CACHE_MAX:
+                _contextos_cache.popitem(last=False)
+
+    indice = selector_eventos.indice(nombre_persona, version, lambda: persona_store.eventos(nombre_persona))
+    if pregunta and vector is None and selector_eventos.necesita_vector(indice):
+        try:
+            vector = ollama.embeddings([str(pregunta)], MODELO_EMBEDDINGS, timeout=TIMEOUT_EMBED)[0]
+        except OllamaError as e:
+            logger.warning(f"⚠️ Sin embedding de la pregunta, eventos por fecha y palabras: {e}")
+    eventos, info = selector_eventos.seleccionar(indice, pregunta, vector)
+    if info["incluidos"] < info["total"]:
+        logger.debug(f"🗂️ Eventos de {nombre_persona}: {info}")
+    return renderizar_contexto(cacheado[1], eventos), info
 
 # -----------------------------
 # Funciones de historial
 # -----------------------------
-def cargar_historial(nombre_persona):
-    archivo = os.path.join(HISTORIAL_DIR, f"{nombre_persona}_history.txt")
-    if not os.path.exists(archivo):
-        return []
-    with open(archivo, "r", encoding="utf-8") as f:
-        lines = f.readlines()
-
+def mensajes_historial(registros):
+    """Convierte los turnos guardados en mensajes user/assistant."""
     historial = []
-    i = 0
-    while i < len(lines):
-        line = lines[i].strip()
-        if line.startswith("Usuario: "):
-            user_line = line.replace("Usuario: ", "")
-            if i + 1 < len(lines):
-                assistant_line = lines[i + 1].strip()
-                if ": " in assistant_line:
-                    assistant_line = assistant_line.split(": ", 1)[1]
-                historial.append({"role": "user", "content": str(user_line)})
-                historial.append({"role": "assistant", "content": str(assistant_line)})
-            i += 2
-        else:
-            i += 1
+    for registro in registros:
+        historial.append({"role": "user", "content": str(registro["usuario"])})
+        historial.append({"role": "assistant", "content": str(registro["asistente"])})
     return historial
 
-def guardar_historial(nombre_persona, user_msg, assistant_msg):
-    archivo = os.path.join(HISTORIAL_DIR, f"{nombre_persona}_history.txt")
-    with open(archivo, "a", encoding="utf-8") as f:
-        f.write(f"Usuario: {user_msg}\n")
-        f.write(f"{nombre_persona.capitalize()}: {assistant_msg}\n")
+def cargar_historial(nombre_persona, max_turnos=HISTORIAL_MAX_TURNOS):
+    """Devuelve los últimos `max_turnos` turnos como mensajes user/assistant (todos si es None)."""
+    return mensajes_historial(persona_store.ultimos(nombre_persona, max_turnos))
+
+def guardar_historial(nombre_persona, user_msg, assistant_msg, tokens_asistente=None):
+    persona_store.anadir(nombre_persona, user_msg, assistant_msg, tokens_asistente=tokens_asistente)
+    if RESUMEN_AUTO_TURNOS and persona_store.numero_turnos(nombre_persona) > RESUMEN_AUTO_TURNOS:
+        logger.info(f"📏 Historial de {nombre_persona} supera {RESUMEN_AUTO_TURNOS} turnos, encolando resumen")
+        encolar_resumen(nombre_persona, automatico=True)
 
 def procesar_resumen_formato(resumen_completo, nombre_persona):
     """
@@ -157,40 +499,20 @@ def preguntar_a_ollama(nombre_persona, pregunta):
     logger.debug(f"🤖 Preguntando a Ollama para {nombre_persona}")
 
     try:
-        contexto = cargar_contexto(nombre_persona)
+        contexto, _ = cargar_contexto(nombre_persona, pregunta)
         logger.debug(f"🎭 Contexto cargado, longitud: {len(contexto) if contexto else 0}")
 
         historial = cargar_historial(nombre_persona)
         logger.debug(f"📚 Historial cargado con {len(historial)} mensajes")
+        historial, presupuesto = recortar_historial(contexto, historial, pregunta, MODELO_CHAT)
+        logger.debug(f"✂️ Presupuesto de tokens: {presupuesto}")
 
         messages = generar_mensajes(contexto, historial, pregunta)
         logger.debug(f"📝 Mensajes preparados: {len(messages)} mensajes")
 
         logger.info("📤 Enviando petición a Ollama...")
-        response = requests.post(
-            OLLAMA_URL,
-            json={
-                "model": MODEL_NAME,
-                "messages": messages,
-                "stream": False
-            },
-            timeout=60
-        )
-
-        logger.debug(f"📥 Respuesta de Ollama: status={response.status_code}")
-
-        if response.status_code != 200:
-            logger.error(f"❌ Error HTTP de Ollama: {response.status_code} - {response.text}")
-            return None
-
-        response.raise_for_status()
-        data = response.json()
-
-        if "message" not in data or "content" not in data["message"]:
-            logger.error(f"❌ Respuesta de Ollama malformada: {data}")
-            return None
-
-        assistant_msg = data["message"]["content"]
+        assistant_msg = ollama.chat_contenido(messages, MODELO_CHAT, timeout=TIMEOUT_CHAT,
+                                              options=opciones_modelo(MODELO_CHAT))
         logger.info(f"✅ Respuesta generada, longitud: {len(assistant_msg)} caracteres")
 
         # Guardar en historial
@@ -200,53 +522,132 @@ def preguntar_a_ollama(nombre_persona, pregunta):
 
         return assistant_msg
 
-    except requests.exceptions.Timeout:
-        logger.error("❌ Timeout conectando con Ollama")
-        return None
-    except requests.exceptions.ConnectionError:
-        logger.error("❌ Error de conexión con Ollama")
-        return None
-    except requests.exceptions.RequestException as e:
-        logger.error(f"❌ Error en petición HTTP a Ollama: {e}")
-        return None
-    except json.JSONDecodeError as e:
-        logger.error(f"❌ Error decodificando JSON de Ollama: {e}")
+    except OllamaError as e:
+        logger.error(f"❌ Error consultando Ollama: {e}")
         return None
     except Exception as e:
         logger.error(f"❌ Error inesperado en preguntar_a_ollama: {e}")
         logger.error(f"   Traceback: {traceback.format_exc()}")
         return None
 
+# -----------------------------
+# Streaming de tokens
+# -----------------------------
+def formatear_evento_stream(evento, formato):
+    """Serializa un evento de streaming como línea NDJSON o como evento SSE."""
+    linea = json.dumps(evento, ensure_ascii=False)
+    if formato == "sse":
+        return f"data: {linea}\n\n"
+    return linea + "\n"
+
+def stream_respuesta_ollama(messages, pregunta, persona=None, formato="ndjson", extra=None,
+                            opciones=None, al_terminar=None):
+    """
+    Reenvía los fragmentos de Ollama a medida que llegan.
+    Cada fragmento se emite como {"token": ..., "done": false}; al terminar se emite
+    {"done": true, "respuesta": ...} (más los campos de `extra`) y, si hay persona,
+    se guarda el mensaje completo en el historial. `al_terminar(respuesta, chunk_final)`
+    se llama antes del último evento.
+    """
+    opciones = opciones or {"options": opciones_modelo(MODELO_CHAT)}
+    chunk_final = {}
+    partes = []
+    tokens_asistente = None
+    inicio = time.monotonic()
+    try:
+        logger.info("📤 Enviando petición en streaming a Ollama...")
+        for chunk in ollama.chat_stream(messages, MODELO_CHAT, timeout=TIMEOUT_CHAT, **opciones):
+            token = chunk.get("message", {}).get("content", "")
+            if token:
+                partes.append(token)
+                yield formatear_evento_stream({"token": token, "done": False}, formato)
+            if chunk.get("done"):
+                chunk_final = chunk
+                tokens_asistente = chunk.get("eval_count")
+    except OllamaError as e:
+        logger.error(f"❌ Error de Ollama durante el streaming: {e}")
+        yield formatear_evento_stream({"error": "No se pudo obtener respuesta de Ollama", "done": True}, formato)
+        return
+
+    registrar_fase("ollama", time.monotonic() - inicio)
+    if not chunk_final:
+        # El stream se ha cerrado sin "done": la respuesta está incompleta, no se guarda ni se cachea
+        logger.error("❌ El streaming de Ollama terminó sin el fragmento final")
+        yield formatear_evento_stream({"error": "Respuesta de Ollama incompleta", "done": True}, formato)
+        return
+
+    respuesta = "".join(partes)
+    logger.info(f"✅ Respuesta en streaming completada, longitud: {len(respuesta)} caracteres")
+    if persona:
+        with fase("guardar_historial"):
+            guardar_historial(persona, pregunta, respuesta, tokens_asistente=tokens_asistente)
+    extra = dict(extra or {})
+    if al_terminar:
+        extra.update(al_terminar(respuesta, chunk_final) or {})
+    final = {"done": True, "pregunta": pregunta, "respuesta": respuesta, "persona": persona}
+    final.update(extra)
+    yield formatear_evento_stream(final, formato)
+
+# -----------------------------
+# Sesiones (reutilización de la caché KV)
+# -----------------------------
+def obtener_sesion(persona, contexto, pregunta):
+    """
+    Sesión de la persona con un prefijo de mensajes estable. Si con la nueva pregunta se
+    pasa del presupuesto de tokens, se reinicia a partir del historial recortado.
+    Devuelve (sesion, mensajes): los mensajes son una copia hecha con el lock de la sesión,
+    la que hay que usar para el prompt aunque otra petición añada un turno mientras tanto.
+    """
+    def crear_mensajes():
+        historial, _ = recortar_historial(contexto, cargar_historial(persona), pregunta, MODELO_CHAT)
+        return generar_mensajes(contexto, historial, pregunta)[:-1]
+
+    clave = clave_persona(persona)
+    sesion = sesiones.obtener(clave, contexto, crear_mensajes)
+    mensajes = sesion.instantanea()
+    tokens = sum(tokens_mensaje(m) for m in mensajes) + estimar_tokens(str(pregunta))
+    if tokens > presupuesto_modelo(MODELO_CHAT):
+        logger.info(f"✂️ Sesión de {persona} fuera de presupuesto, se reinicia")
+        sesiones.descartar(clave)
+        sesion = sesiones.obtener(clave, contexto, crear_mensajes)
+        mensajes = sesion.instantanea()
+    return sesion, mensajes
+
+def info_sesion(sesion, data_ollama):
+    with sesion.lock:
+        turnos, prefijo = sesion.turnos, len(sesion.mensajes)
+    return {
+        "turnos": turnos,
+        "mensajes_prefijo": prefijo,
+        "prompt_eval_count": data_ollama.get("prompt_eval_count"),
+    }
+
 # -----------------------------
 # Función para verificar Ollama
 # -----------------------------
 def verificar_ollama():
     logger.info("🔍 Verificando conectividad con Ollama...")
     try:
-        response = requests.get("http://localhost:11434/api/tags", timeout=10)
-        logger.debug(f"📥 Respuesta de /api/tags: status={response.status_code}")
-
-        if response.status_code == 200:
-            data = response.json()
-            models = data.get("models", [])
-            model_names = [model["name"] for model in models]
-            logger.info(f"📋 Modelos disponibles: {model_names}")
-
-            if MODEL_NAME in model_names:
-                logger.info(f"✅ Modelo {MODEL_NAME} disponible")
-                return True
-            else:
-                logger.error(f"❌ Modelo {MODEL_NAME} no encontrado. Modelos disponibles: {model_names}")
+        model_names = ollama.modelos(timeout=10)
+        logger.info(f"📋 Modelos disponibles: {model_names}")
+
+        # Sin el modelo de chat no se puede servir; el resto solo degrada su endpoint
+        disponibles = set(model_names) | {n.split(":")[0] for n in model_names if n.endswith(":latest")}
+        for uso, modelo in RUTAS_MODELOS.items():
+            if modelo in disponibles:
+                logger.info(f"✅ Modelo {modelo} disponible ({uso})")
+            elif uso == "chat":
+                logger.error(f"❌ Modelo {modelo} no encontrado. Modelos disponibles: {model_names}")
                 return False
-        else:
-            logger.error(f"❌ Ollama no responde correctamente: {response.status_code} - {response.text}")
-            return False
+            else:
+                logger.warning(f"⚠️ Modelo {modelo} ({uso}) no encontrado, ese uso fallará hasta que se descargue")
+        return True
 
-    except requests.exceptions.Timeout:
-        logger.error("❌ Timeout conectando con Ollama")
+    except OllamaNoDisponible as e:
+        logger.error(f"❌ Ollama no disponible: {e}")
         return False
-    except requests.exceptions.ConnectionError:
-        logger.error("❌ Error de conexión con Ollama")
+    except OllamaError as e:
+        logger.error(f"❌ Ollama no responde correctamente: {e}")
         return False
     except Exception as e:
         logger.error(f"❌ Error inesperado verificando Ollama: {e}")
@@ -259,59 +660,29 @@ def resumir_historial(nombre_persona):
     logger.debug(f"📂 Ruta completa del historial: {os.path.abspath(HISTORIAL_DIR)}")
 
     try:
-        # Verificar que el directorio existe
-        if not os.path.exists(HISTORIAL_DIR):
-            logger.error(f"❌ Directorio HISTORIAL_DIR no existe: {HISTORIAL_DIR}")
+        # La búsqueda no distingue mayúsculas: se usa el nombre con el que se dio de alta
+        persona_canonica = persona_store.nombre_canonico(nombre_persona)
+        if not persona_canonica:
+            logger.error(f"❌ No se encontró historial para {nombre_persona}")
             return False
+        nombre_persona = persona_canonica
 
-        # Buscar archivo de historial (case-insensitive)
-        nombre_persona_lower = nombre_persona.lower()
-        logger.debug(f"🔍 Buscando archivo para: {nombre_persona_lower}_history.txt")
-
-        historial_files = [f for f in os.listdir(HISTORIAL_DIR) if f.endswith('_history.txt')]
-        logger.debug(f"📋 Archivos encontrados en {HISTORIAL_DIR}: {historial_files}")
-
-        archivo = None
-        for hist_file in historial_files:
-            logger.debug(f"🔍 Comparando '{hist_file.lower()}' con '{nombre_persona_lower}_history.txt'")
-            if hist_file.lower() == f"{nombre_persona_lower}_history.txt":
-                archivo = os.path.join(HISTORIAL_DIR, hist_file)
-                logger.info(f"✅ Archivo encontrado: {archivo}")
-                break
-
-        if not archivo or not os.path.exists(archivo):
-            logger.error(f"❌ No se encontró archivo de historial para {nombre_persona}")
-            return False
-
-        # Verificar permisos de lectura
-        if not os.access(archivo, os.R_OK):
-            logger.error(f"❌ No hay permisos de lectura para: {archivo}")
-            return False
-
-        # Leer contenido del archivo
-        logger.debug(f"📖 Leyendo archivo: {archivo}")
-        with open(archivo, 'r', encoding='utf-8') as f:
-            contenido = f.read()
-
-        logger.debug(f"📖 Archivo leído exitosamente. Longitud: {len(contenido)} caracteres")
+        logger.debug("📚 Cargando historial completo...")
+        # Una sola lectura: lo que se resume y lo que se conserva salen de la misma instantánea
+        registros = persona_store.ultimos(nombre_persona)
+        turnos_resumidos = len(registros)
+        historial = mensajes_historial(registros)
 
-        # Verificar que hay contenido
-        if not contenido.strip():
-            logger.warning("⚠️ El archivo está vacío")
+        if not historial:
+            logger.warning("⚠️ El historial está vacío")
             return False
 
-        # Backup del historial antiguo
+        # Backup del historial antiguo (JSONL, un turno por línea)
+        os.makedirs(HISTORIAL_DIR, exist_ok=True)
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        backup_file = f"{archivo}_{timestamp}"
-        logger.debug(f"💾 Creando backup: {backup_file}")
-        shutil.copy2(archivo, backup_file)
-
-        # Cargar historial completo
-        logger.debug("📚 Cargando historial completo...")
-        historial = cargar_historial(nombre_persona)
-        if not historial:
-            logger.warning("⚠️ No se pudo cargar el historial")
-            return False
+        archivo = os.path.join(HISTORIAL_DIR, f"{nombre_persona}_history.jsonl_{timestamp}")
+        logger.debug(f"💾 Creando backup: {archivo}")
+        escribir_atomico(archivo, "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in registros))
 
         logger.debug(f"📚 Historial cargado con {len(historial)} mensajes")
 
@@ -320,7 +691,7 @@ def resumir_historial(nombre_persona):
         logger.debug(f"📝 Texto a resumir generado, longitud: {len(resumen_texto)}")
 
         # Preparar prompt para Ollama - MODIFICADO para mantener formato
-        contexto = cargar_contexto(nombre_persona)
+        contexto, _ = cargar_contexto(nombre_persona)
         logger.debug(f"🎭 Contexto cargado, longitud: {len(contexto) if contexto else 0}")
 
         prompt_resumen = (
@@ -342,50 +713,30 @@ def resumir_historial(nombre_persona):
 
         logger.info("🤖 Enviando petición a Ollama para resumir historial...")
 
-        response = requests.post(
-            OLLAMA_URL,
-            json={
-                "model": MODEL_NAME,
-                "messages": [
+        with planificador.admitir("resumen", MODELO_RESUMEN, rechazar=False):
+            resumen_completo = ollama.chat_contenido(
+                [
                     {"role": "system", "content": contexto if contexto else "Eres un asistente útil que resume conversaciones."},
                     {"role": "user", "content": prompt_resumen}
                 ],
-                "stream": False
-            },
-            timeout=120  # Aumentar timeout
-        )
-
-        logger.debug(f"📥 Respuesta de Ollama: status={response.status_code}")
-
-        if response.status_code != 200:
-            logger.error(f"❌ Error HTTP de Ollama: {response.status_code} - {response.text}")
-            return False
-
-        response.raise_for_status()
-        data = response.json()
-
-        if "message" not in data or "content" not in data["message"]:
-            logger.error(f"❌ Respuesta de Ollama malformada: {data}")
-            return False
-
-        resumen_completo = data["message"]["content"]
+                MODELO_RESUMEN,
+                timeout=TIMEOUT_RESUMEN
+            )
         logger.info(f"✅ Resumen generado exitosamente, longitud: {len(resumen_completo)} caracteres")
 
         # Procesar el resumen para asegurar formato correcto
         resumen_formateado = procesar_resumen_formato(resumen_completo, nombre_persona)
         logger.debug(f"📝 Resumen formateado, longitud: {len(resumen_formateado)}")
 
-        # Verificar permisos de escritura
-        if not os.access(archivo, os.W_OK):
-            logger.error(f"❌ No hay permisos de escritura para: {archivo}")
-            return False
-
         # Guardar resumen formateado en el historial
-        logger.debug(f"💾 Guardando resumen formateado en: {archivo}")
-        with open(archivo, "w", encoding="utf-8") as f:
-            f.write(resumen_formateado)
+        logger.debug(f"💾 Guardando resumen formateado de {nombre_persona}")
+        persona_store.reemplazar(
+            nombre_persona,
+            parsear_historial_legado(resumen_formateado.splitlines(), nombre_persona),
+            conservar_desde=turnos_resumidos
+        )
 
-        logger.info(f"💾 Resumen guardado exitosamente en {archivo}")
+        logger.info(f"💾 Resumen de {nombre_persona} guardado (backup en {archivo})")
         return True
 
     except FileNotFoundError as e:
@@ -396,13 +747,8 @@ def resumir_historial(nombre_persona):
         logger.error(f"❌ Error de permisos: {e}")
         logger.error(f"   Traceback: {traceback.format_exc()}")
         return False
-    except requests.exceptions.RequestException as e:
-        logger.error(f"❌ Error de conexión con Ollama: {e}")
-        logger.error(f"   Traceback: {traceback.format_exc()}")
-        return False
-    except json.JSONDecodeError as e:
-        logger.error(f"❌ Error decodificando JSON de Ollama: {e}")
-        logger.error(f"   Traceback: {traceback.format_exc()}")
+    except OllamaError as e:
+        logger.error(f"❌ Error consultando Ollama: {e}")
         return False
     except Exception as e:
         logger.error(f"❌ Error inesperado en resumir_historial: {e}")
@@ -410,19 +756,82 @@ def resumir_historial(nombre_persona):
         logger.error(f"   Traceback completo: {traceback.format_exc()}")
         return False
 
+def trabajo_resumir(nombre_persona, automatico=False):
+    # La cola solo evita duplicados dentro del proceso; el bloqueo, entre workers. Sin él dos
+    # resúmenes a la vez sustituirían el historial con posiciones ya desfasadas y se perderían turnos.
+    with bloqueos_resumen(nombre_persona):
+        if automatico and persona_store.numero_turnos(nombre_persona) <= RESUMEN_AUTO_TURNOS:
+            # Otro worker lo ha resumido mientras se esperaba el bloqueo
+            return {"mensaje": f"Historial de {nombre_persona} ya resumido"}
+        if not resumir_historial(nombre_persona):
+            raise RuntimeError(f"No se pudo resumir historial de {nombre_persona}")
+    sesiones.descartar(clave_persona(nombre_persona))
+    return {"mensaje": f"Historial de {nombre_persona} resumido correctamente"}
+
+def encolar_resumen(nombre_persona, automatico=False):
+    """
+    Encola el resumen; si ya hay uno pendiente para la persona devuelve su id. Los
+    automáticos se saltan si al empezar el historial ya no supera RESUMEN_AUTO_TURNOS.
+    """
+    return cola_trabajos.encolar("resumir", trabajo_resumir, nombre_persona, automatico,
+                                 clave=("resumir", nombre_persona.lower()))
+
 # -----------------------------
 # API Flask
 # -----------------------------
 app = Flask(__name__)
 
 
+def respuesta_saturado(error):
+    """HTTP 429 con Retry-After cuando no hay hueco en la cola del modelo."""
+    logger.warning(f"🚦 {error}")
+    return Response(
+        json.dumps({"error": "Servidor saturado, reintenta más tarde", "retry_after": error.retry_after}, ensure_ascii=False),
+        mimetype="application/json",
+        status=429,
+        headers={"Retry-After": str(error.retry_after)}
+    )
+
+def respuesta_error_ollama(error):
+    """Respuesta HTTP para un fallo de Ollama: 503 si no está disponible, 500 en otro caso."""
+    if isinstance(error, OllamaNoDisponible):
+        return Response(
+            json.dumps({"error": "Ollama no está disponible"}, ensure_ascii=False),
+            mimetype="application/json",
+            status=503
+        )
+    return Response(
+        json.dumps({"error": "No se pudo obtener respuesta de Ollama"}, ensure_ascii=False),
+        mimetype="application/json",
+        status=500
+    )
+
+
 # --- Endpoint para añadir eventos con texto coloquial ---
+def validar_fecha(texto, formato, campo, permitir_futuro=False):
+    """Errores de una fecha extraída: formato incorrecto o fuera de rango. Vacía es válida."""
+    if not texto:
+        return []
+    try:
+        fecha = datetime.strptime(texto, formato)
+    except ValueError:
+        return [f"{campo} '{texto}' no tiene el formato {formato}"]
+    if fecha.year < 1900 or (not permitir_futuro and fecha > datetime.now() + timedelta(days=1)):
+        return [f"{campo} '{texto}' fuera de rango"]
+    return []
+
+def validar_evento(evento):
+    campos = ["persona", "tipo", "nombre", "lugar", "fecha"]
+    if not any(evento.get(k) for k in campos):
+        return ["todos los campos están vacíos"]
+    return validar_fecha(evento.get("fecha"), "%Y/%m/%d", "fecha", permitir_futuro=True)
+
 @app.route("/anadir_evento_colloquial", methods=["POST"])
 def anadir_evento_colloquial():
     logger.info("🔄 Endpoint /anadir_evento_colloquial llamado")
     try:
         data = request.get_json()
-        logger.debug(f"📥 Datos recibidos: {data}")
+        logger.debug("📥 Datos recibidos: %s", data, extra=CARGA)
         if not data or "texto" not in data:
             logger.warning("❌ Falta parámetro 'texto'")
             return Response(
@@ -452,77 +861,26 @@ def anadir_evento_colloquial():
             "{\n  \"persona\": \"Laia\",\n  \"tipo\": \"paseo\",\n  \"nombre\": \"\",\n  \"lugar\": \"Casa de Campo, Madrid\",\n  \"fecha\": \"\",\n  \"notas\": \"Hacía muy buen día\"\n}\n"
             f"\nTEXTO: {texto}\nJSON:"
         )
-        logger.debug(f"🟦 PROMPT enviado al LLM:\n{prompt}")
+        logger.debug("🟦 PROMPT enviado al LLM:\n%s", prompt, extra=CARGA)
         messages = [{"role": "user", "content": prompt}]
-        logger.debug(f"🟦 MESSAGES enviados a Ollama: {messages}")
-        response = requests.post(
-            OLLAMA_URL,
-            json={
-                "model": MODEL_NAME,
-                "messages": messages,
-                "stream": False
-            },
-            timeout=60
-        )
-        logger.debug(f"📥 Respuesta de Ollama: status={response.status_code}")
-        logger.debug(f"📥 Respuesta RAW de Ollama: {response.text}")
-        if response.status_code != 200:
-            logger.error(f"❌ Error HTTP de Ollama: {response.status_code} - {response.text}")
-            return Response(
-                json.dumps({"error": "No se pudo obtener respuesta de Ollama"}, ensure_ascii=False),
-                mimetype="application/json",
-                status=500
-            )
-        data_ollama = response.json()
-        logger.debug(f"🟦 JSON recibido de Ollama: {data_ollama}")
-        if "message" not in data_ollama or "content" not in data_ollama["message"]:
-            logger.error(f"❌ Respuesta de Ollama malformada: {data_ollama}")
-            return Response(
-                json.dumps({"error": "Respuesta de Ollama malformada"}, ensure_ascii=False),
-                mimetype="application/json",
-                status=500
-            )
-        # Intentar extraer el primer bloque JSON de la respuesta
-        import re
-        import json as pyjson
-        respuesta_llm = data_ollama["message"]["content"]
-        logger.debug(f"📝 Respuesta LLM: {respuesta_llm}")
-        # Buscar todos los bloques JSON válidos
-        matches = re.findall(r'\{[\s\S]*?\}', respuesta_llm)
-        logger.debug(f"🟦 BLOQUES JSON extraídos: {matches}")
-        if not matches:
-            logger.error("❌ No se encontró JSON en la respuesta de Ollama")
-            return Response(
-                json.dumps({"error": "No se encontró JSON en la respuesta de Ollama"}, ensure_ascii=False),
-                mimetype="application/json",
-                status=500
-            )
-        evento = None
-        for bloque in matches:
-            try:
-                posible = pyjson.loads(bloque)
-            except Exception as e:
-                continue
-            # Si es un dict con campos relevantes y no todos vacíos
-            campos = ["persona", "tipo", "nombre", "lugar", "fecha"]
-            if all(k in posible for k in campos) and any(posible.get(k) for k in campos):
-                evento = posible
-                break
-            # Si es un dict con 'eventos' como lista, usar el primer evento válido
-            if "eventos" in posible and isinstance(posible["eventos"], list):
-                for ev in posible["eventos"]:
-                    if all(k in ev for k in campos) and any(ev.get(k) for k in campos):
-                        # Prompt mejorado para extracción robusta
-                        break
-                if evento:
-                    break
-        if not evento:
-            logger.error("❌ No se encontró ningún evento válido en los bloques JSON")
+        try:
+            with fase("extraccion"):
+                evento, modelo = extractor_estructurado.extraer_cascada(
+                    "evento", messages, MODELOS_EXTRACCION["evento"], timeout=TIMEOUT_CHAT, validar=validar_evento
+                )
+        except Saturado as e:
+            return respuesta_saturado(e)
+        except OllamaError as e:
+            logger.error(f"❌ Error consultando Ollama: {e}")
+            return respuesta_error_ollama(e)
+        except ExtraccionError as e:
+            logger.error(f"❌ No se encontró ningún evento válido: {e}")
             return Response(
-                json.dumps({"error": "No se encontró ningún evento válido en los bloques JSON"}, ensure_ascii=False),
+                json.dumps({"error": "No se encontró ningún evento válido en la respuesta de Ollama"}, ensure_ascii=False),
                 mimetype="application/json",
                 status=500
             )
+        logger.debug(f"🟦 EVENTO extraído con {modelo}: {evento}")
         # Si el campo persona está vacío, intentar inferirlo del texto original
         persona = evento.get("persona")
         if not persona:
@@ -538,18 +896,15 @@ def anadir_evento_colloquial():
                     mimetype="application/json",
                     status=400
                 )
-        archivo = os.path.join(CONTEXTOS_DIR, f"{persona}.json")
-        if os.path.exists(archivo):
-            with open(archivo, "r", encoding="utf-8") as f:
-                datos = json.load(f)
-        else:
-            datos = {"nombre": persona, "eventos": []}
-        if "eventos" not in datos or not isinstance(datos["eventos"], list):
-            datos["eventos"] = []
-        evento_guardar = {k: v for k, v in evento.items() if k != "persona"}
-        datos["eventos"].append(evento_guardar)
-        with open(archivo, "w", encoding="utf-8") as f:
-            json.dump(datos, f, ensure_ascii=False, indent=2)
+        with fase("guardar_contexto"):
+            if persona_store.version(persona) is None:
+                # Persona nueva: sus datos, o el JSON que tuviera pendiente de importar
+                archivo = os.path.join(CONTEXTOS_DIR, f"{persona}.json")
+                if not (os.path.exists(archivo) and persona_store.importar_contexto(archivo, persona)):
+                    persona_store.guardar_contexto(persona, {"nombre": persona})
+            persona_store.anadir_evento(persona, {k: v for k, v in evento.items() if k != "persona"})
+        invalidar_contexto(persona)
+        cache_semantica.invalidar(clave_persona(persona))
         logger.info(f"✅ Evento añadido para {persona} (colloquial)")
         return Response(
             json.dumps({"mensaje": f"Evento añadido para {persona}"}, ensure_ascii=False),
@@ -564,12 +919,92 @@ def anadir_evento_colloquial():
             status=500
         )
 
+def saltar_cache():
+    """La caché se ignora con `X-Cache-Bypass: 1` o `Cache-Control: no-cache`."""
+    return (request.headers.get("X-Cache-Bypass", "").lower() in ("1", "true", "yes")
+            or "no-cache" in request.headers.get("Cache-Control", ""))
+
+def stream_respuesta_cacheada(pregunta, respuesta, persona, formato, extra):
+    yield formatear_evento_stream({"token": respuesta, "done": False}, formato)
+    final = {"done": True, "pregunta": pregunta, "respuesta": respuesta, "persona": persona}
+    final.update(extra)
+    yield formatear_evento_stream(final, formato)
+
+def respuesta_cacheada(pregunta, respuesta, persona, stream, formato, extra):
+    if stream:
+        return Response(
+            stream_respuesta_cacheada(pregunta, respuesta, persona, formato, extra),
+            mimetype="text/event-stream" if formato == "sse" else "application/x-ndjson",
+            headers={"X-Cache": "HIT"}
+        )
+    return Response(
+        json.dumps({"pregunta": pregunta, "respuesta": respuesta, "persona": persona, **extra}, ensure_ascii=False),
+        mimetype="application/json",
+        headers={"X-Cache": "HIT"}
+    )
+
+def consultar_cache_semantica(espacio, pregunta):
+    """
+    Busca una pregunta parecida ya respondida. Devuelve (respuesta, info, vector); el
+    vector se reutiliza para guardar la respuesta nueva si no hay acierto.
+    """
+    try:
+        vector = ollama.embeddings([str(pregunta)], MODELO_EMBEDDINGS, timeout=TIMEOUT_EMBED)[0]
+    except OllamaError as e:
+        logger.warning(f"⚠️ Caché semántica no disponible: {e}")
+        return None, None, None
+    respuesta, similitud, original = cache_semantica.buscar(espacio, vector)
+    info = {"similitud": round(similitud, 4)}
+    if original is not None:
+        info["pregunta_cacheada"] = original
+    return respuesta, info, vector
+
+def recuperar_diario(pregunta):
+    """
+    Busca en el diario vectorial los fragmentos más parecidos a `pregunta` y los junta
+    en un bloque de texto de como mucho RAG_PRESUPUESTO_TOKENS. Devuelve (bloque, info);
+    el bloque es None si no hay nada que añadir o el diario no está disponible.
+    """
+    # La versión cambia con cada volcado a Chroma, así no se sirven búsquedas viejas
+    clave = clave_cache(pregunta, f"diario:{diario_vectorial.version}", {"k": RAG_K})
+    resultados = cache_recuperacion.obtener(clave)
+    info = {"cache": "hit" if resultados is not None else "miss"}
+    if resultados is None:
+        try:
+            resultados = diario_vectorial.buscar(pregunta, k=RAG_K)
+        except Exception as e:
+            # Sin Chroma, sin langchain o sin embeddings se responde igualmente, sin diario
+            logger.warning(f"⚠️ Diario no disponible para la pregunta: {e}")
+            return None, {"error": "Diario no disponible"}
+        cache_recuperacion.guardar(clave, resultados)
+
+    textos = [texto.strip() for texto, _ in resultados if texto.strip()]
+    elegidos, tokens = empaquetar_fragmentos(textos, RAG_PRESUPUESTO_TOKENS)
+    info.update({"recuperados": len(resultados), "fragmentos": len(elegidos), "tokens": tokens})
+    if not elegidos:
+        return None, info
+    return RAG_CABECERA + DIARIO_SEPARADOR.join(elegidos), info
+
+def respuesta_stream(messages, pregunta, persona, formato, extra=None, opciones=None, al_terminar=None):
+    """Respuesta en streaming. El hueco del planificador se mantiene hasta cerrar la respuesta."""
+    with fase("cola"):
+        turno = planificador.admitir("chat", MODELO_CHAT)
+    mimetype = "text/event-stream" if formato == "sse" else "application/x-ndjson"
+    response = Response(
+        stream_with_context(stream_respuesta_ollama(messages, pregunta, persona, formato, extra,
+                                                    opciones, al_terminar)),
+        mimetype=mimetype,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+    response.call_on_close(turno.liberar)
+    return response
+
 @app.route("/preguntar", methods=["POST"])
 def preguntar():
     logger.info("🔄 Endpoint /preguntar llamado")
     try:
         data = request.get_json()
-        logger.debug(f"📥 Datos recibidos: {data}")
+        logger.debug("📥 Datos recibidos: %s", data, extra=CARGA)
 
 
         if not data or "pregunta" not in data:
@@ -582,44 +1017,89 @@ def preguntar():
 
         pregunta = data["pregunta"]
         persona = data.get("persona")
-        logger.debug(f"❓ Pregunta recibida: {pregunta}")
+        stream = bool(data.get("stream", False))
+        usar_sesion = bool(data.get("sesion", False))
+        usar_rag = bool(data.get("rag", False))
+        formato_stream = "sse" if "text/event-stream" in request.headers.get("Accept", "") else "ndjson"
+        extra = {}
+        vector = None
+        usar_semantica = (not usar_sesion and not usar_rag and not saltar_cache()
+                          and (not persona or data.get("cache_semantica", CACHE_SEMANTICA_PERSONAS)))
+        logger.debug("❓ Pregunta recibida: %s", pregunta, extra=CARGA)
         if persona:
             logger.info(f"👤 Procesando pregunta para persona: {persona}")
-            contexto = cargar_contexto(persona)
-            logger.debug(f"🧩 Contexto usado: {contexto}")
-            historial = cargar_historial(persona)
-            logger.debug(f"📚 Historial usado: {historial}")
-            messages = generar_mensajes(contexto, historial, pregunta)
-            logger.debug(f"📝 Mensajes enviados a Ollama: {messages}")
+            espacio = clave_persona(persona)
+            if usar_semantica:
+                with fase("cache_semantica"):
+                    respuesta, extra["cache_semantica"], vector = consultar_cache_semantica(espacio, pregunta)
+                if respuesta is not None:
+                    logger.info(f"⚡ Respuesta semántica para {persona}: {extra['cache_semantica']}")
+                    guardar_historial(persona, pregunta, respuesta)
+                    extra["cache"] = "hit"
+                    return respuesta_cacheada(pregunta, respuesta, persona, stream, formato_stream, extra)
+            with fase("cargar_contexto"):
+                # En sesión el prompt no depende de la pregunta, para que el prefijo siga sirviendo
+                contexto, info_eventos = cargar_contexto(persona, None if usar_sesion else pregunta, vector)
+            if info_eventos:
+                extra["eventos"] = info_eventos
+            logger.debug("🧩 Contexto usado: %s", contexto, extra=CARGA)
+            if usar_rag and usar_sesion:
+                # El diario cambiaría el prefijo en cada turno y la sesión dejaría de servir
+                extra["rag"] = {"omitido": "no se combina con sesion"}
+            elif usar_rag:
+                with fase("rag"):
+                    bloque, extra["rag"] = recuperar_diario(pregunta)
+                if bloque:
+                    contexto = f"{contexto}\n\n{bloque}" if contexto else bloque
+            opciones = {"options": opciones_modelo(MODELO_CHAT)}
+            sesion = None
+            if usar_sesion:
+                with fase("sesion"):
+                    sesion, prefijo = obtener_sesion(persona, contexto, pregunta)
+                messages = prefijo + [{"role": "user", "content": str(pregunta)}]
+                if MODELO_CHAT not in ollama.keep_alive:
+                    # Si el modelo ya está fijado en memoria no se acorta su keep_alive
+                    opciones["keep_alive"] = SESION_KEEP_ALIVE
+            else:
+                with fase("cargar_historial"):
+                    historial = cargar_historial(persona)
+                logger.debug("📚 Historial usado: %s", historial, extra=CARGA)
+                with fase("recortar_historial"):
+                    historial, extra["presupuesto"] = recortar_historial(contexto, historial, pregunta, MODELO_CHAT)
+                if extra["presupuesto"]["turnos_descartados"]:
+                    logger.info(f"✂️ Historial recortado: {extra['presupuesto']}")
+                messages = generar_mensajes(contexto, historial, pregunta)
+            logger.debug("📝 Mensajes enviados a Ollama: %s", messages, extra=CARGA)
+            if stream:
+                al_terminar = None
+                if sesion:
+                    def al_terminar(respuesta, chunk_final):
+                        sesiones.anadir_turno(sesion, pregunta, respuesta)
+                        return {"sesion": info_sesion(sesion, chunk_final)}
+                elif vector is not None:
+                    def al_terminar(respuesta, chunk_final):
+                        if respuesta:
+                            cache_semantica.guardar(espacio, vector, pregunta, respuesta)
+                return respuesta_stream(messages, pregunta, persona, formato_stream, extra, opciones, al_terminar)
             try:
-                response = requests.post(
-                    OLLAMA_URL,
-                    json={
-                        "model": MODEL_NAME,
-                        "messages": messages,
-                        "stream": False
-                    },
-                    timeout=60
-                )
-                logger.debug(f"📥 Respuesta de Ollama: status={response.status_code}")
-                if response.status_code != 200:
-                    logger.error(f"❌ Error HTTP de Ollama: {response.status_code} - {response.text}")
-                    return Response(
-                        json.dumps({"error": "No se pudo obtener respuesta de Ollama"}, ensure_ascii=False),
-                        mimetype="application/json",
-                        status=500
-                    )
-                data_ollama = response.json()
-                if "message" not in data_ollama or "content" not in data_ollama["message"]:
-                    logger.error(f"❌ Respuesta de Ollama malformada: {data_ollama}")
-                    return Response(
-                        json.dumps({"error": "Respuesta de Ollama malformada"}, ensure_ascii=False),
-                        mimetype="application/json",
-                        status=500
-                    )
+                with fase("cola"):
+                    turno = planificador.admitir("chat", MODELO_CHAT)
+                with turno, fase("ollama"):
+                    data_ollama = ollama.chat(messages, MODELO_CHAT, timeout=TIMEOUT_CHAT, **opciones)
                 respuesta = data_ollama["message"]["content"]
                 # Guardar en historial
-                guardar_historial(persona, pregunta, respuesta)
+                with fase("guardar_historial"):
+                    guardar_historial(persona, pregunta, respuesta, tokens_asistente=data_ollama.get("eval_count"))
+                if sesion:
+                    sesiones.anadir_turno(sesion, pregunta, respuesta)
+                    extra["sesion"] = info_sesion(sesion, data_ollama)
+                if vector is not None:
+                    cache_semantica.guardar(espacio, vector, pregunta, respuesta)
+            except Saturado as e:
+                return respuesta_saturado(e)
+            except OllamaError as e:
+                logger.error(f"❌ Error consultando Ollama: {e}")
+                return respuesta_error_ollama(e)
             except Exception as e:
                 logger.error(f"❌ Error inesperado en pregunta persona: {e}")
                 logger.error(f"   Traceback: {traceback.format_exc()}")
@@ -632,34 +1112,53 @@ def preguntar():
             logger.info("🤖 Procesando pregunta general (sin persona)")
             # Prompt general sin contexto ni historial
             messages = [{"role": "user", "content": str(pregunta)}]
-            logger.debug(f"📝 Mensaje enviado a Ollama: {messages}")
+            logger.debug("📝 Mensaje enviado a Ollama: %s", messages, extra=CARGA)
+            opciones = {"options": opciones_modelo(MODELO_CHAT)}
+            clave = clave_cache(pregunta, MODELO_CHAT,
+                                {**opciones, "rag": diario_vectorial.version} if usar_rag else opciones)
+            if not saltar_cache():
+                with fase("cache"):
+                    respuesta = cache_respuestas.obtener(clave)
+                if respuesta is not None:
+                    logger.info("⚡ Respuesta servida desde la caché")
+                    extra["cache"] = "hit"
+                    return respuesta_cacheada(pregunta, respuesta, None, stream, formato_stream, extra)
+            if usar_semantica:
+                with fase("cache_semantica"):
+                    respuesta, extra["cache_semantica"], vector = consultar_cache_semantica("", pregunta)
+                if respuesta is not None:
+                    logger.info(f"⚡ Respuesta semántica: {extra['cache_semantica']}")
+                    cache_respuestas.guardar(clave, respuesta)
+                    extra["cache"] = "hit"
+                    return respuesta_cacheada(pregunta, respuesta, None, stream, formato_stream, extra)
+            extra["cache"] = "miss"
+            if usar_rag:
+                with fase("rag"):
+                    bloque, extra["rag"] = recuperar_diario(pregunta)
+                if bloque:
+                    messages.insert(0, {"role": "system", "content": bloque})
+
+            def guardar_en_caches(respuesta):
+                cache_respuestas.guardar(clave, respuesta)
+                if vector is not None:
+                    cache_semantica.guardar("", vector, pregunta, respuesta)
+
+            if stream:
+                def al_terminar(respuesta, chunk_final):
+                    if respuesta:
+                        guardar_en_caches(respuesta)
+                return respuesta_stream(messages, pregunta, None, formato_stream, extra, opciones, al_terminar)
             try:
-                response = requests.post(
-                    OLLAMA_URL,
-                    json={
-                        "model": MODEL_NAME,
-                        "messages": messages,
-                        "stream": False
-                    },
-                    timeout=60
-                )
-                logger.debug(f"📥 Respuesta de Ollama: status={response.status_code}")
-                if response.status_code != 200:
-                    logger.error(f"❌ Error HTTP de Ollama: {response.status_code} - {response.text}")
-                    return Response(
-                        json.dumps({"error": "No se pudo obtener respuesta de Ollama"}, ensure_ascii=False),
-                        mimetype="application/json",
-                        status=500
-                    )
-                data_ollama = response.json()
-                if "message" not in data_ollama or "content" not in data_ollama["message"]:
-                    logger.error(f"❌ Respuesta de Ollama malformada: {data_ollama}")
-                    return Response(
-                        json.dumps({"error": "Respuesta de Ollama malformada"}, ensure_ascii=False),
-                        mimetype="application/json",
-                        status=500
-                    )
-                respuesta = data_ollama["message"]["content"]
+                with fase("cola"):
+                    turno = planificador.admitir("chat", MODELO_CHAT)
+                with turno, fase("ollama"):
+                    respuesta = ollama.chat_contenido(messages, MODELO_CHAT, timeout=TIMEOUT_CHAT, **opciones)
+                guardar_en_caches(respuesta)
+            except Saturado as e:
+                return respuesta_saturado(e)
+            except OllamaError as e:
+                logger.error(f"❌ Error consultando Ollama: {e}")
+                return respuesta_error_ollama(e)
             except Exception as e:
                 logger.error(f"❌ Error inesperado en pregunta general: {e}")
                 logger.error(f"   Traceback: {traceback.format_exc()}")
@@ -679,10 +1178,12 @@ def preguntar():
 
         logger.info("✅ Respuesta generada exitosamente")
         return Response(
-            json.dumps({"pregunta": pregunta, "respuesta": respuesta, "persona": persona}, ensure_ascii=False),
+            json.dumps({"pregunta": pregunta, "respuesta": respuesta, "persona": persona, **extra}, ensure_ascii=False),
             mimetype="application/json"
         )
 
+    except Saturado as e:
+        return respuesta_saturado(e)
     except json.JSONDecodeError as e:
         logger.error(f"❌ Error decodificando JSON de la petición: {e}")
         return Response(
@@ -704,7 +1205,7 @@ def resumir():
     logger.info("🔄 Endpoint /resumir llamado")
     try:
         data = request.get_json()
-        logger.debug(f"📥 Datos recibidos: {data}")
+        logger.debug("📥 Datos recibidos: %s", data, extra=CARGA)
 
         if not data or "persona" not in data:
             logger.warning("❌ Falta parámetro 'persona'")
@@ -715,23 +1216,18 @@ def resumir():
             )
 
         persona = data["persona"]
-        logger.info(f"👤 Procesando resumen para persona: {persona}")
-
-        exito = resumir_historial(persona)
-        logger.info(f"📊 Resultado de resumir_historial: {exito}")
+        logger.info(f"👤 Encolando resumen para persona: {persona}")
 
-        if not exito:
-            logger.error(f"❌ No se pudo resumir historial de {persona}")
-            return Response(
-                json.dumps({"error": f"No se pudo resumir historial de {persona}"}, ensure_ascii=False),
-                mimetype="application/json",
-                status=500
-            )
-
-        logger.info(f"✅ Historial de {persona} resumido correctamente")
+        id_trabajo = encolar_resumen(persona)
         return Response(
-            json.dumps({"mensaje": f"Historial de {persona} resumido correctamente"}, ensure_ascii=False),
-            mimetype="application/json"
+            json.dumps({
+                "mensaje": f"Resumen de {persona} encolado",
+                "job_id": id_trabajo,
+                "estado": cola_trabajos.estado(id_trabajo)["estado"]
+            }, ensure_ascii=False),
+            mimetype="application/json",
+            status=202,
+            headers={"Location": f"/jobs/{id_trabajo}"}
         )
 
     except json.JSONDecodeError as e:
@@ -750,23 +1246,96 @@ def resumir():
             status=500
         )
 
-# --- Endpoint para procesar frase y añadir al RAG ---
-@app.route("/procesar_rag_frase", methods=["POST"])
-def procesar_rag_frase():
-    logger.info("🔄 Endpoint /procesar_rag_frase llamado")
-    try:
-        data = request.get_json()
-        frase = data.get("frase")
-        if not frase:
-            return Response(json.dumps({"error": "Falta parámetro 'frase'"}, ensure_ascii=False), mimetype="application/json", status=400)
+@app.route("/jobs/<id_trabajo>", methods=["GET"])
+def estado_trabajo(id_trabajo):
+    trabajo = cola_trabajos.estado(id_trabajo)
+    if not trabajo:
+        return Response(
+            json.dumps({"error": f"Trabajo {id_trabajo} no encontrado"}, ensure_ascii=False),
+            mimetype="application/json",
+            status=404
+        )
+    return Response(json.dumps(trabajo, ensure_ascii=False), mimetype="application/json")
+
+@app.before_request
+def inicio_peticion():
+    g.inicio_peticion = time.monotonic()
+
+def pide_debug():
+    """Desglose de tiempos en el cuerpo con `?debug=1` o `"debug": true` en el JSON."""
+    if request.args.get("debug", "").lower() in ("1", "true", "yes"):
+        return True
+    data = request.get_json(silent=True)
+    return isinstance(data, dict) and bool(data.get("debug"))
+
+@app.after_request
+def medir_peticion(response):
+    # Se mide al cerrar la respuesta para incluir el tiempo de streaming
+    endpoint = request.url_rule.rule if request.url_rule else "desconocido"
+    metodo, status, inicio = request.method, response.status_code, g.get("inicio_peticion")
+    fases = g.setdefault("fases", [])
+
+    if inicio is not None:
+        # En streaming la cabecera sale antes de generar: solo lleva las fases previas
+        total = time.monotonic() - inicio
+        response.headers["Server-Timing"] = cabecera_server_timing(fases, total)
+        if response.mimetype == "application/json" and not response.is_streamed and pide_debug():
+            try:
+                cuerpo = json.loads(response.get_data())
+            except ValueError:
+                cuerpo = None
+            if isinstance(cuerpo, dict):
+                cuerpo["tiempos"] = {nombre: round(d * 1000, 1) for nombre, d in fases}
+                cuerpo["tiempos"]["total"] = round(total * 1000, 1)
+                response.set_data(json.dumps(cuerpo, ensure_ascii=False))
+
+    def registrar():
+        m_peticiones.inc(endpoint=endpoint, metodo=metodo, status=status)
+        if inicio is None:
+            return
+        duracion = time.monotonic() - inicio
+        m_duracion_peticion.observar(duracion, endpoint=endpoint)
+        if duracion >= PETICION_LENTA_UMBRAL:
+            logger_lento.warning(json.dumps({
+                "endpoint": endpoint, "metodo": metodo, "status": status,
+                "total_ms": round(duracion * 1000, 1),
+                "fases_ms": {nombre: round(d * 1000, 1) for nombre, d in fases},
+            }, ensure_ascii=False))
+
+    response.call_on_close(registrar)
+    return response
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(metricas.exportar(), content_type=RegistroMetricas.CONTENT_TYPE)
+
+@app.route("/estadisticas", methods=["GET"])
+def estadisticas():
+    return Response(
+        json.dumps({
+            "extraccion": extractor_estructurado.estadisticas(),
+            "cache_respuestas": cache_respuestas.estadisticas(),
+            "cache_semantica": cache_semantica.estadisticas(),
+            "cache_recuperacion": cache_recuperacion.estadisticas(),
+            "eventos": selector_eventos.estadisticas(),
+            "sesiones": sesiones.estadisticas(),
+            "planificador": planificador.estadisticas(),
+            "modelos": modelos_residentes.estadisticas(),
+        }, ensure_ascii=False),
+        mimetype="application/json"
+    )
 
-        # Prompt de extracción mejorado para fechas relativas
-        # Calcular fechas para los ejemplos y definir el prompt antes de cualquier uso
-        hoy = datetime.now()
-        ayer = hoy - timedelta(days=1)
-        dias_hasta_domingo = (hoy.weekday() + 1) % 7
-        ultimo_domingo = hoy - timedelta(days=dias_hasta_domingo)
-        extraction_prompt = f"""
+# -----------------------------
+# Extracción de metadatos del diario
+# -----------------------------
+@lru_cache(maxsize=4)
+def prompt_extraccion_diario(fecha_actual):
+    """Prompt de extracción con ejemplos de fechas relativas calculados para `fecha_actual` (YYYY-MM-DD)."""
+    hoy = datetime.strptime(fecha_actual, "%Y-%m-%d")
+    ayer = hoy - timedelta(days=1)
+    dias_hasta_domingo = (hoy.weekday() + 1) % 7
+    ultimo_domingo = hoy - timedelta(days=dias_hasta_domingo)
+    return f"""
 Eres un asistente experto en estructuración de diarios personales.
 Tu tarea es analizar cada entrada de texto y extraer los siguientes campos:
 - FECHA: Extrae la fecha del evento y tradúcela a formato DD/MM/YYYY (por ejemplo, si el texto dice 'el 1 de diciembre de 2025', responde '01/12/2025').
@@ -794,92 +1363,219 @@ JSON:
 
 NO respondas nada más. Devuelve SOLO el objeto JSON solicitado, sin explicaciones ni contexto adicional.
 """
-        logger.debug(f"🟦 PROMPT enviado al LLM:\n{extraction_prompt}")
-        messages = [
-            {"role": "system", "content": extraction_prompt},
-            {"role": "user", "content": frase}
-        ]
-        logger.debug(f"🟦 MESSAGES enviados a Ollama: {messages}")
-        response = requests.post(
-            OLLAMA_URL,
-            json={
-                "model": MODEL_NAME,
-                "messages": messages,
-                "stream": False
-            },
-            timeout=60
-        )
-        logger.debug(f"📥 Respuesta de Ollama: status={response.status_code}")
-        logger.debug(f"📥 Respuesta RAW de Ollama: {response.text}")
-        if response.status_code != 200:
-            logger.error(f"❌ Error HTTP de Ollama: {response.status_code} - {response.text}")
-            return Response(json.dumps({"error": "No se pudo obtener respuesta de Ollama"}, ensure_ascii=False), mimetype="application/json", status=500)
-        data_ollama = response.json()
-        logger.debug(f"🟦 JSON recibido de Ollama: {data_ollama}")
-        respuesta_llm = data_ollama.get("message", {}).get("content", "")
-        logger.debug(f"📝 Respuesta LLM: {respuesta_llm}")
-        import re
-        import json as pyjson
-        matches = re.findall(r'\{[\s\S]*?\}', respuesta_llm)
-        logger.debug(f"🟦 BLOQUES JSON extraídos: {matches}")
-        metadata = None
-        for bloque in matches:
-            try:
-                metadata = pyjson.loads(bloque)
-                logger.debug(f"🟦 METADATA extraída: {metadata}")
-                break
-            except Exception as ex_json:
-                logger.warning(f"[DEBUG] Fallo al parsear bloque JSON: {bloque}\nError: {ex_json}")
-                continue
-        if not metadata:
-            logger.error(f"[DEBUG] No se pudo extraer JSON válido de la respuesta: {respuesta_llm}")
+
+def extraer_metadata_diario(frase):
+    """
+    Devuelve FECHA/TIPO/LUGAR de una frase del diario. Primero prueba el extractor local
+    y solo si su confianza no llega a EXTRACTOR_LOCAL_UMBRAL se lo pide al LLM.
+    Lanza OllamaError si falla Ollama y ExtraccionError si la respuesta no cumple el esquema.
+    """
+    local = extractor_local.extraer(frase)
+    if extractor_local.es_fiable(local):
+        logger.debug(f"⚡ METADATA extraída sin LLM (confianza {local['confianza']}): {local}")
+        return {"FECHA": local["FECHA"], "TIPO": local["TIPO"], "LUGAR": local["LUGAR"], "_extractor": "local"}
+    logger.debug(f"🟦 Extractor local con confianza {local['confianza']}, se pregunta al LLM")
+    return extraer_metadata_llm(frase)
+
+def extraer_metadata_llm(frase):
+    """Pide al LLM FECHA/TIPO/LUGAR de una frase del diario con el esquema "diario"."""
+    extraction_prompt = prompt_extraccion_diario(datetime.now().strftime("%Y-%m-%d"))
+    logger.debug("🟦 PROMPT enviado al LLM:\n%s", extraction_prompt, extra=CARGA)
+    messages = [
+        {"role": "system", "content": extraction_prompt},
+        {"role": "user", "content": frase}
+    ]
+    logger.debug("🟦 MESSAGES enviados a Ollama: %s", messages, extra=CARGA)
+    metadata, modelo = extractor_estructurado.extraer_cascada(
+        "diario", messages, MODELOS_EXTRACCION["diario"], timeout=TIMEOUT_CHAT, validar=validar_metadata_diario
+    )
+    logger.debug(f"🟦 METADATA extraída con {modelo}: {metadata}")
+    metadata["_extractor"] = "llm"
+    metadata["_modelo"] = modelo
+    return metadata
+
+def validar_metadata_diario(metadata):
+    errores = [] if metadata.get("TIPO", "").strip() else ["TIPO vacío"]
+    return errores + validar_fecha(metadata.get("FECHA"), "%d/%m/%Y", "FECHA")
+
+def formatear_entrada_diario(frase, metadata):
+    """Devuelve (etiquetas, entrada_rag) con el formato del fichero del diario."""
+    fecha = metadata.get('FECHA', 'FECHA_DESCONOCIDA')
+    tipo = metadata.get('TIPO', 'EVENTO_DESCONOCIDO')
+    lugar = metadata.get('LUGAR', 'LUGAR_DESCONOCIDO')
+    etiquetas = f"[FECHA: {fecha}] [TIPO: {tipo}] [LUGAR: {lugar}]"
+    return etiquetas, f"{etiquetas}\n{frase}\n{DIARIO_SEPARADOR}"
+
+# --- Endpoint para procesar frase y añadir al RAG ---
+@app.route("/procesar_rag_frase", methods=["POST"])
+def procesar_rag_frase():
+    logger.info("🔄 Endpoint /procesar_rag_frase llamado")
+    try:
+        data = request.get_json()
+        frase = data.get("frase")
+        if not frase:
+            return Response(json.dumps({"error": "Falta parámetro 'frase'"}, ensure_ascii=False), mimetype="application/json", status=400)
+
+        try:
+            with fase("extraccion"):
+                metadata = extraer_metadata_diario(frase)
+        except Saturado as e:
+            return respuesta_saturado(e)
+        except OllamaError as e:
+            logger.error(f"❌ Error consultando Ollama: {e}")
+            return respuesta_error_ollama(e)
+        except ExtraccionError:
             return Response(json.dumps({"error": "No se pudo extraer JSON válido"}, ensure_ascii=False), mimetype="application/json", status=500)
         # Guardar en el RAG (diario_personal_vida.txt)
-        SEPARADOR = "\n---\n"
-        fecha = metadata.get('FECHA', 'FECHA_DESCONOCIDA')
-        tipo = metadata.get('TIPO', 'EVENTO_DESCONOCIDO')
-        lugar = metadata.get('LUGAR', 'LUGAR_DESCONOCIDO')
-        etiquetas = f"[FECHA: {fecha}] [TIPO: {tipo}] [LUGAR: {lugar}]"
-        entrada_rag = f"{etiquetas}\n{frase}\n{SEPARADOR}"
+        etiquetas, entrada_rag = formatear_entrada_diario(frase, metadata)
         # Escribir en diario_personal_vida.txt
-        with open(DIARIO_FILE, 'a', encoding='utf-8') as f:
+        with fase("escribir_diario"), bloqueo_diario, open(DIARIO_FILE, 'a', encoding='utf-8') as f:
             f.write(entrada_rag)
-        # Añadir la entrada al vector store Chroma
+        # Añadir la entrada al vector store Chroma (se vuelca por lotes salvo con "sincrono": true)
         try:
-            embeddings = OllamaEmbeddings(model="nomic-embed-text")
-            text_splitter = CharacterTextSplitter(separator=SEPARADOR, chunk_size=4000, chunk_overlap=0, length_function=len)
             # Dividir la entrada en fragmentos (aunque normalmente será solo uno)
-            texts = text_splitter.create_documents([entrada_rag])
-            vectorstore = Chroma(
-                embedding_function=embeddings,
-                persist_directory=DIARIO_CHROMA_DB
-            )
-            vectorstore.add_documents(texts)
-            if hasattr(vectorstore, "persist"):
-                vectorstore.persist()
-            logger.info(f"✅ Entrada añadida al vector store ChromaDB: {etiquetas}")
+            with fase("chroma"):
+                texts = diario_vectorial.trocear([entrada_rag])
+                chroma = diario_vectorial.anadir(texts, sincrono=bool(data.get("sincrono", False)))
         except Exception as e:
             logger.error(f"❌ Error añadiendo entrada a ChromaDB: {e}")
             logger.error(f"   Traceback: {traceback.format_exc()}")
             return Response(json.dumps({"error": "Error añadiendo entrada a ChromaDB"}, ensure_ascii=False), mimetype="application/json", status=500)
-        logger.info(f"✅ Entrada añadida al RAG y ChromaDB: {etiquetas}")
-        return Response(json.dumps({"mensaje": "Entrada añadida al RAG y ChromaDB", "etiquetas": etiquetas}), mimetype="application/json")
+        if chroma == "sincrono":
+            mensaje = "Entrada añadida al RAG y ChromaDB"
+        else:
+            mensaje = "Entrada añadida al RAG; se añadirá a ChromaDB en el siguiente volcado"
+        logger.info(f"✅ {mensaje}: {etiquetas}")
+        return Response(json.dumps({"mensaje": mensaje, "chroma": chroma, "etiquetas": etiquetas, "extractor": metadata.get("_extractor"), "modelo": metadata.get("_modelo")}, ensure_ascii=False), mimetype="application/json")
     except Exception as e:
         logger.error(f"❌ Error inesperado en endpoint /procesar_rag_frase: {e}")
         logger.error(f"   Traceback: {traceback.format_exc()}")
         return Response(json.dumps({"error": "Error interno del servidor"}, ensure_ascii=False), mimetype="application/json", status=500)
 
-if __name__ == "__main__":
+def leer_frases_lote():
+    """Frases de la petición: fichero subido ('fichero', una por línea) o JSON {"frases": [...]}."""
+    if "fichero" in request.files:
+        contenido = request.files["fichero"].read().decode("utf-8")
+        frases = contenido.splitlines()
+    else:
+        data = request.get_json(silent=True) or {}
+        frases = data.get("frases") or []
+    return [f.strip() for f in frases if isinstance(f, str) and f.strip()]
+
+def guardar_lote_diario(entradas):
+    """
+    Escribe las entradas en el diario y las añade a Chroma por lotes. No lanza excepciones:
+    devuelve los campos que hay que añadir al resumen del lote, `"chroma"` ("sincrono" si
+    ya están en Chroma, "pendiente" si las vuelca otro worker más tarde) o los de error.
+    """
+    if not entradas:
+        return {}
+    try:
+        with bloqueo_diario, open(DIARIO_FILE, 'a', encoding='utf-8') as f:
+            f.write("".join(entradas))
+    except OSError as e:
+        logger.error(f"❌ Error escribiendo el lote en el diario: {e}")
+        return {"error_diario": "No se pudieron escribir las entradas en el diario"}
+    try:
+        documentos = diario_vectorial.trocear(entradas)
+        estados = {diario_vectorial.anadir(documentos[inicio:inicio + CHROMA_MAX_LOTE], sincrono=True)
+                   for inicio in range(0, len(documentos), CHROMA_MAX_LOTE)}
+    except Exception as e:
+        logger.error(f"❌ Error añadiendo lote a ChromaDB: {e}")
+        logger.error(f"   Traceback: {traceback.format_exc()}")
+        return {"error_chroma": "Error añadiendo entradas a ChromaDB, se reintentará en el siguiente volcado"}
+    return {"chroma": "pendiente" if "pendiente" in estados else "sincrono"}
+
+def procesar_lote_diario(frases):
+    """
+    Extrae los metadatos de las frases con concurrencia limitada y va devolviendo el
+    resultado de cada una. Al final escribe las aceptadas en el diario de una vez (en el
+    orden original), las añade a Chroma por lotes y devuelve un resumen. Las aceptadas
+    se escriben aunque el cliente corte la conexión a mitad del lote.
+    """
+    aceptadas = {}
+    errores = 0
+    por_extractor = {}
+    escritura = {}
+    pool = ThreadPoolExecutor(max_workers=RAG_LOTE_CONCURRENCIA, thread_name_prefix="rag-lote")
+    try:
+        futuros = {pool.submit(extraer_metadata_diario, frase): i for i, frase in enumerate(frases)}
+        for futuro in as_completed(futuros):
+            i = futuros[futuro]
+            try:
+                metadata = futuro.result()
+            except (OllamaError, ExtraccionError, Saturado) as e:
+                errores += 1
+                yield {"indice": i, "frase": frases[i], "ok": False, "error": str(e)}
+                continue
+            except Exception as e:
+                # Un fallo inesperado en una frase no debe tirar el resto del lote
+                logger.error(f"❌ Error inesperado procesando la frase {i} del lote: {e}")
+                logger.error(f"   Traceback: {traceback.format_exc()}")
+                errores += 1
+                yield {"indice": i, "frase": frases[i], "ok": False, "error": "Error interno procesando la frase"}
+                continue
+            etiquetas, entrada_rag = formatear_entrada_diario(frases[i], metadata)
+            aceptadas[i] = entrada_rag
+            # Resumen por extractor: "local" o el modelo de la cascada que ha respondido
+            extractor = metadata.get("_modelo") or metadata.get("_extractor")
+            por_extractor[extractor] = por_extractor.get(extractor, 0) + 1
+            yield {"indice": i, "frase": frases[i], "ok": True, "etiquetas": etiquetas,
+                   "extractor": metadata.get("_extractor"), "modelo": metadata.get("_modelo")}
+    finally:
+        # Si el cliente corta la conexión no se lanzan las extracciones pendientes,
+        # pero las ya aceptadas se escriben igualmente
+        pool.shutdown(wait=True, cancel_futures=True)
+        escritura = guardar_lote_diario([aceptadas[i] for i in sorted(aceptadas)])
+
+    resumen = {"done": True, "total": len(frases), "aceptadas": len(aceptadas), "errores": errores,
+               "extractor": por_extractor, **escritura}
+    logger.info(f"✅ Lote del diario procesado: {resumen}")
+    yield resumen
+
+# --- Endpoint para procesar un lote de frases y añadirlas al RAG ---
+@app.route("/procesar_rag_lote", methods=["POST"])
+def procesar_rag_lote():
+    logger.info("🔄 Endpoint /procesar_rag_lote llamado")
+    try:
+        frases = leer_frases_lote()
+    except UnicodeDecodeError:
+        return Response(json.dumps({"error": "El fichero debe estar en UTF-8"}, ensure_ascii=False), mimetype="application/json", status=400)
+    if not frases:
+        return Response(json.dumps({"error": "Falta parámetro 'frases' o 'fichero'"}, ensure_ascii=False), mimetype="application/json", status=400)
+    if len(frases) > RAG_LOTE_MAX:
+        return Response(json.dumps({"error": f"Máximo {RAG_LOTE_MAX} frases por petición"}, ensure_ascii=False), mimetype="application/json", status=413)
+
+    logger.info(f"📦 Procesando lote de {len(frases)} frases")
+    return Response(
+        stream_with_context(formatear_evento_stream(r, "ndjson") for r in procesar_lote_diario(frases)),
+        mimetype="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def preparar_servidor():
+    """
+    Comprueba Ollama, crea los directorios y arranca las tareas de fondo.
+    Devuelve False si no se puede servir. Se usa tanto con app.run como con gunicorn.
+    """
     logger.info("🚀 Iniciando API Ollama Server...")
     logger.info(f"📡 Ollama URL: {OLLAMA_URL}")
-    logger.info(f"🤖 Modelo: {MODEL_NAME}")
+    logger.info(f"🤖 Modelos: {RUTAS_MODELOS}")
     logger.info(f"📂 Directorio historial: {HISTORIAL_DIR}")
     logger.info(f"📂 Directorio contextos: {CONTEXTOS_DIR}")
+    logger.info(f"🗄️ Base de datos de personas: {PERSONAS_DB}")
 
     # Verificar que Ollama esté disponible
     if not verificar_ollama():
         logger.error("❌ No se puede iniciar la API sin Ollama funcionando correctamente")
-        exit(1)
+        return False
+
+    # Cargar los modelos antes de aceptar peticiones para que nadie pague la carga en frío
+    logger.info("🔥 Precargando modelos...")
+    modelos_residentes.calentar_todos()
+    modelos_residentes.iniciar()
+
+    cache_respuestas.iniciar_persistencia(CACHE_PERSISTIR_INTERVALO)
 
     # Verificar directorios
     for directorio in [HISTORIAL_DIR, CONTEXTOS_DIR]:
@@ -890,7 +1586,31 @@ if __name__ == "__main__":
                 logger.info(f"✅ Directorio creado: {directorio}")
             except Exception as e:
                 logger.error(f"❌ Error creando directorio {directorio}: {e}")
-                exit(1)
+                return False
+
+    # Importar los contextos e historiales que sigan en ficheros
+    migrados = persona_store.migrar(CONTEXTOS_DIR, HISTORIAL_DIR)
+    if any(migrados.values()):
+        logger.info(f"🔁 Migrados a {PERSONAS_DB}: {migrados['contextos']} contextos, {migrados['historiales']} historiales")
+
+    # langchain/Chroma se cargan con la primera petición al diario, no al arrancar
+    logger.info(f"📦 Dependencias RAG cargadas al arrancar: {modulos_pesados_cargados() or 'ninguna'}")
+    if PERFIL_IMPORTS:
+        registrar_perfil(__name__ if __name__ != "__main__" else "api_ollama_server")
+    return True
+
+def crear_app():
+    """
+    Punto de entrada para varios workers, cada uno en su proceso:
+    gunicorn -w 4 -b 0.0.0.0:5000 --chdir /app/scrics/api 'api_ollama_server:crear_app()'
+    """
+    if not preparar_servidor():
+        raise RuntimeError("No se puede iniciar la API sin Ollama funcionando correctamente")
+    return app
+
+if __name__ == "__main__":
+    if not preparar_servidor():
+        exit(1)
 
     logger.info("🌐 Iniciando servidor Flask en puerto 5000...")
     logger.info("Rutas registradas en Flask justo antes de arrancar el servidor:")
@@ -902,5 +1622,3 @@ if __name__ == "__main__":
         logger.error(f"❌ Error iniciando servidor Flask: {e}")
         logger.error(f"   Traceback: {traceback.format_exc()}")
         exit(1)
-
-
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bloqueos entre procesos y escrituras atómicas para los ficheros de datos.
+
+Con varios workers (gunicorn) cada proceso tiene sus propios locks de threading, así
+que además se usa un bloqueo consultivo (flock) sobre un fichero `.lock` por recurso.
+Los JSON se escriben en un temporal único del mismo directorio y se sustituyen con
+os.replace, de modo que un lector nunca ve un fichero a medio escribir.
+"""
+
+import json
+import os
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows: solo hay bloqueo entre hilos del mismo proceso
+    fcntl = None
+
+
+class BloqueoFichero:
+    """
+    Lock reentrante que combina un RLock (hilos del proceso) con flock sobre `ruta`
+    (otros procesos). El flock se toma en la primera entrada y se suelta en la última.
+    """
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._rlock = threading.RLock()
+        self._nivel = 0
+        self._fd = None
+
+    def __enter__(self):
+        self._rlock.acquire()
+        if self._nivel == 0:
+            try:
+                fd = os.open(self.ruta, os.O_RDWR | os.O_CREAT, 0o644)
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+            except BaseException:
+                self._rlock.release()
+                raise
+            self._fd = fd
+        self._nivel += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._nivel -= 1
+        if self._nivel == 0:
+            fd, self._fd = self._fd, None
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+        self._rlock.release()
+        return False
+
+
+class BloqueosPorNombre:
+    """Un BloqueoFichero por nombre (persona, diario...) dentro de `directorio`."""
+
+    def __init__(self, directorio):
+        self.directorio = directorio
+        self._bloqueos = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, nombre):
+        clave = nombre.lower()
+        with self._lock:
+            bloqueo = self._bloqueos.get(clave)
+            if bloqueo is None:
+                os.makedirs(self.directorio, exist_ok=True)
+                bloqueo = BloqueoFichero(os.path.join(self.directorio, f"{clave}.lock"))
+                self._bloqueos[clave] = bloqueo
+            return bloqueo
+
+
+def tomar_bloqueo_sin_espera(ruta):
+    """
+    Intenta tomar un flock exclusivo sobre `ruta` sin esperar. Devuelve el descriptor (que
+    hay que mantener abierto mientras se quiera conservar el bloqueo) o None si lo tiene
+    otro proceso. Sin fcntl siempre se concede.
+    """
+    fd = os.open(ruta, os.O_RDWR | os.O_CREAT, 0o644)
+    if fcntl is None:
+        return fd
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def escribir_atomico(ruta, contenido, modo="w"):
+    """Escribe `contenido` en un temporal del mismo directorio y lo renombra sobre `ruta`."""
+    directorio = os.path.dirname(ruta) or "."
+    fd, tmp = tempfile.mkstemp(dir=directorio, prefix=f".{os.path.basename(ruta)}.", suffix=".tmp")
+    try:
+        os.chmod(tmp, 0o644)  # mkstemp lo crea con 0600
+        with os.fdopen(fd, modo, **({} if "b" in modo else {"encoding": "utf-8"})) as f:
+            f.write(contenido)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, ruta)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def escribir_json_atomico(ruta, datos, **kwargs):
+    escribir_atomico(ruta, json.dumps(datos, ensure_ascii=False, **kwargs))
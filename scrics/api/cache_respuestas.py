@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Caché de respuestas LRU con caducidad (TTL).
+
+Se usa para las preguntas sin persona: la misma pregunta (normalizada) con el mismo
+modelo y opciones devuelve la respuesta guardada sin llamar a Ollama. Opcionalmente
+se persiste en disco para sobrevivir a reinicios.
+"""
+
+import atexit
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from bloqueo_ficheros import escribir_json_atomico
+
+logger = logging.getLogger(__name__)
+
+
+def normalizar_pregunta(pregunta):
+    """Minúsculas, sin espacios repetidos ni signos de puntuación al principio o al final."""
+    texto = unicodedata.normalize("NFC", str(pregunta)).lower()
+    texto = re.sub(r"\s+", " ", texto).strip()
+    return texto.strip("¿?¡!.,;: ")
+
+
+def clave_cache(pregunta, modelo, opciones=None):
+    base = json.dumps(
+        {"p": normalizar_pregunta(pregunta), "m": modelo, "o": opciones or {}},
+        sort_keys=True, ensure_ascii=False
+    )
+    return hashlib.sha256(base.encode("utf-8")).hexdigest()
+
+
+class CacheRespuestas:
+    def __init__(self, max_entradas=1000, ttl=3600, ruta_persistencia=None):
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self.ruta_persistencia = ruta_persistencia
+        self.aciertos = 0
+        self.fallos = 0
+        self._datos = OrderedDict()  # clave -> (expira, respuesta)
+        self._lock = threading.Lock()
+        self._sucia = False
+        if ruta_persistencia:
+            self.cargar()
+
+    def obtener(self, clave):
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada and entrada[0] > time.time():
+                self._datos.move_to_end(clave)
+                self.aciertos += 1
+                return entrada[1]
+            if entrada:
+                del self._datos[clave]
+            self.fallos += 1
+            return None
+
+    def guardar(self, clave, respuesta):
+        with self._lock:
+            self._datos[clave] = (time.time() + self.ttl, respuesta)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_entradas:
+                self._datos.popitem(last=False)
+            self._sucia = True
+
+    def estadisticas(self):
+        with self._lock:
+            total = self.aciertos + self.fallos
+            return {
+                "entradas": len(self._datos),
+                "aciertos": self.aciertos,
+                "fallos": self.fallos,
+                "ratio_aciertos": round(self.aciertos / total, 4) if total else 0.0,
+            }
+
+    # -----------------------------
+    # Persistencia
+    # -----------------------------
+    def cargar(self):
+        if not os.path.exists(self.ruta_persistencia):
+            return
+        try:
+            with open(self.ruta_persistencia, "r", encoding="utf-8") as f:
+                entradas = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"⚠️ No se pudo cargar la caché de respuestas: {e}")
+            return
+        ahora = time.time()
+        with self._lock:
+            for clave, expira, respuesta in entradas:
+                if expira > ahora:
+                    self._datos[clave] = (expira, respuesta)
+            while len(self._datos) > self.max_entradas:
+                self._datos.popitem(last=False)
+        logger.info(f"📦 Caché de respuestas cargada: {len(self._datos)} entradas")
+
+    def persistir(self):
+        if not self.ruta_persistencia:
+            return
+        with self._lock:
+            if not self._sucia:
+                return
+            entradas = [[k, expira, respuesta] for k, (expira, respuesta) in self._datos.items()]
+            self._sucia = False
+        # Temporal único: con varios workers cada proceso persiste su propia copia
+        escribir_json_atomico(self.ruta_persistencia, entradas)
+        logger.debug(f"💾 Caché de respuestas persistida: {len(entradas)} entradas")
+
+    def iniciar_persistencia(self, intervalo=60):
+        """Persiste cada `intervalo` segundos en un hilo de fondo y al salir del proceso."""
+        if not self.ruta_persistencia:
+            return
+        atexit.register(self.persistir)
+
+        def bucle():
+            while True:
+                time.sleep(intervalo)
+                try:
+                    self.persistir()
+                except OSError as e:
+                    logger.warning(f"⚠️ No se pudo persistir la caché de respuestas: {e}")
+
+        threading.Thread(target=bucle, name="cache-respuestas", daemon=True).start()
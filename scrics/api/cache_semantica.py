@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Caché semántica de respuestas.
+
+Guarda el embedding de cada pregunta respondida y, ante una pregunta nueva, busca la
+más parecida por similitud coseno dentro del mismo espacio de nombres (la persona, o
+"" para las preguntas generales). Si supera el umbral se devuelve la respuesta guardada.
+"""
+
+import logging
+import math
+import threading
+import time
+
+try:
+    import numpy as np
+except ImportError:  # numpy viene con chromadb, pero la caché funciona sin él
+    np = None
+
+logger = logging.getLogger(__name__)
+
+
+def normalizar_vector(vector):
+    norma = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norma for x in vector]
+
+
+class _Espacio:
+    """Entradas de un espacio de nombres: vectores normalizados y sus respuestas."""
+
+    def __init__(self):
+        self.vectores = []
+        self.entradas = []  # dicts con pregunta, respuesta, expira
+        self.matriz = None  # caché de la matriz numpy, se invalida al modificar
+
+    def quitar(self, indices):
+        for i in sorted(indices, reverse=True):
+            del self.vectores[i]
+            del self.entradas[i]
+        self.matriz = None
+
+
+class CacheSemantica:
+    def __init__(self, umbral=0.92, ttl=3600, max_por_espacio=500):
+        self.umbral = umbral
+        self.ttl = ttl
+        self.max_por_espacio = max_por_espacio
+        self.aciertos = 0
+        self.fallos = 0
+        self._espacios = {}
+        self._lock = threading.Lock()
+
+    def _similitudes(self, espacio, vector):
+        if np is not None:
+            if espacio.matriz is None:
+                espacio.matriz = np.asarray(espacio.vectores, dtype=np.float32)
+            return (espacio.matriz @ np.asarray(vector, dtype=np.float32)).tolist()
+        return [sum(a * b for a, b in zip(v, vector)) for v in espacio.vectores]
+
+    def buscar(self, espacio_nombre, vector):
+        """
+        Devuelve (respuesta, similitud, pregunta_original) de la entrada más parecida si
+        supera el umbral; si no, (None, mejor_similitud, None).
+        """
+        vector = normalizar_vector(vector)
+        with self._lock:
+            espacio = self._espacios.get(espacio_nombre)
+            if not espacio or not espacio.vectores:
+                self.fallos += 1
+                return None, 0.0, None
+            ahora = time.time()
+            caducadas = [i for i, e in enumerate(espacio.entradas) if e["expira"] <= ahora]
+            if caducadas:
+                espacio.quitar(caducadas)
+                if not espacio.vectores:
+                    self.fallos += 1
+                    return None, 0.0, None
+            similitudes = self._similitudes(espacio, vector)
+            mejor = max(range(len(similitudes)), key=similitudes.__getitem__)
+            similitud = float(similitudes[mejor])
+            if similitud >= self.umbral:
+                self.aciertos += 1
+                entrada = espacio.entradas[mejor]
+                return entrada["respuesta"], similitud, entrada["pregunta"]
+            self.fallos += 1
+            return None, similitud, None
+
+    def guardar(self, espacio_nombre, vector, pregunta, respuesta):
+        with self._lock:
+            espacio = self._espacios.setdefault(espacio_nombre, _Espacio())
+            espacio.vectores.append(normalizar_vector(vector))
+            espacio.entradas.append({"pregunta": pregunta, "respuesta": respuesta, "expira": time.time() + self.ttl})
+            espacio.matriz = None
+            if len(espacio.vectores) > self.max_por_espacio:
+                espacio.quitar(range(len(espacio.vectores) - self.max_por_espacio))
+
+    def invalidar(self, espacio_nombre):
+        with self._lock:
+            self._espacios.pop(espacio_nombre, None)
+
+    def estadisticas(self):
+        with self._lock:
+            total = self.aciertos + self.fallos
+            return {
+                "espacios": len(self._espacios),
+                "entradas": sum(len(e.entradas) for e in self._espacios.values()),
+                "aciertos": self.aciertos,
+                "fallos": self.fallos,
+                "ratio_aciertos": round(self.aciertos / total, 4) if total else 0.0,
+            }
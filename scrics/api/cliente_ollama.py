@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cliente HTTP compartido para hablar con Ollama.
+
+Una única sesión de requests con pool de conexiones keep-alive, timeouts por llamada,
+reintentos con backoff ante errores de conexión y un circuit breaker que falla rápido
+mientras Ollama está caído. Valida en un solo sitio el status HTTP y el formato
+`message.content` de las respuestas.
+"""
+
+import json
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class OllamaError(Exception):
+    """Error genérico al hablar con Ollama."""
+
+
+class OllamaNoDisponible(OllamaError):
+    """Ollama no responde (error de conexión, timeout o circuito abierto)."""
+
+
+class OllamaRespuestaMalformada(OllamaError):
+    """Ollama ha respondido, pero sin el formato esperado."""
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker sencillo: tras `umbral_fallos` fallos seguidos se abre durante
+    `tiempo_apertura` segundos y rechaza las llamadas sin tocar la red. Pasado ese
+    tiempo deja pasar una llamada de prueba (semiabierto).
+    """
+
+    def __init__(self, umbral_fallos=5, tiempo_apertura=30):
+        self.umbral_fallos = umbral_fallos
+        self.tiempo_apertura = tiempo_apertura
+        self._fallos = 0
+        self._abierto_hasta = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def abierto(self):
+        with self._lock:
+            return self._fallos >= self.umbral_fallos and time.monotonic() < self._abierto_hasta
+
+    def permitir(self):
+        with self._lock:
+            if self._fallos < self.umbral_fallos:
+                return True
+            if time.monotonic() >= self._abierto_hasta:
+                # Semiabierto: una llamada de prueba y se vuelve a cerrar el paso
+                self._abierto_hasta = time.monotonic() + self.tiempo_apertura
+                return True
+            return False
+
+    def registrar_exito(self):
+        with self._lock:
+            self._fallos = 0
+            self._abierto_hasta = 0.0
+
+    def registrar_fallo(self):
+        with self._lock:
+            self._fallos += 1
+            if self._fallos >= self.umbral_fallos:
+                self._abierto_hasta = time.monotonic() + self.tiempo_apertura
+                logger.error(f"⛔ Circuito de Ollama abierto durante {self.tiempo_apertura}s tras {self._fallos} fallos")
+
+
+class ClienteOllama:
+    def __init__(self, base_url="http://localhost:11434", pool_size=10, timeout=60,
+                 reintentos=3, backoff=0.5, umbral_fallos=5, tiempo_apertura=30):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.reintentos = reintentos
+        self.backoff = backoff
+        self.circuito = CircuitBreaker(umbral_fallos, tiempo_apertura)
+        self._observadores = []
+        self.keep_alive = {}  # modelo -> keep_alive por defecto de sus peticiones
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def observar(self, funcion):
+        """
+        Registra `funcion(modelo, datos)`, que se llama con la respuesta final de cada
+        generación (prompt_eval_count, eval_count, *_duration...). Si se corta un stream antes
+        de terminar, se llama con lo contado hasta el corte y `"parcial": True`.
+        """
+        self._observadores.append(funcion)
+        return funcion
+
+    def fijar_keep_alive(self, model, keep_alive):
+        """
+        Envía `keep_alive` en todas las peticiones a `model` que no traigan el suyo. Sin
+        esto cada petición vuelve a dejar el modelo con la caducidad por defecto de Ollama.
+        """
+        self.keep_alive[model] = keep_alive
+
+    def _con_keep_alive(self, model, payload):
+        if "keep_alive" not in payload and model in self.keep_alive:
+            payload["keep_alive"] = self.keep_alive[model]
+        return payload
+
+    def _notificar(self, model, data):
+        for funcion in self._observadores:
+            try:
+                funcion(model, data)
+            except Exception as e:
+                logger.warning(f"⚠️ Error en un observador de Ollama: {e}")
+
+    # -----------------------------
+    # Transporte
+    # -----------------------------
+    def _peticion(self, metodo, ruta, timeout=None, **kwargs):
+        """Hace la petición con reintentos y circuit breaker. Devuelve la Response con status 200."""
+        if not self.circuito.permitir():
+            raise OllamaNoDisponible("Circuito abierto: Ollama no está disponible")
+
+        url = f"{self.base_url}{ruta}"
+        timeout = timeout or self.timeout
+        intento = 0
+        while True:
+            try:
+                response = self.session.request(metodo, url, timeout=timeout, **kwargs)
+            except requests.exceptions.ConnectionError as e:
+                intento += 1
+                if intento > self.reintentos:
+                    self.circuito.registrar_fallo()
+                    logger.error(f"❌ Error de conexión con Ollama tras {intento} intentos: {e}")
+                    raise OllamaNoDisponible(f"Error de conexión con Ollama: {e}") from e
+                espera = self.backoff * (2 ** (intento - 1))
+                logger.warning(f"⚠️ Error de conexión con Ollama, reintento {intento}/{self.reintentos} en {espera:.1f}s")
+                time.sleep(espera)
+                continue
+            except requests.exceptions.Timeout as e:
+                self.circuito.registrar_fallo()
+                logger.error(f"❌ Timeout conectando con Ollama ({timeout}s)")
+                raise OllamaNoDisponible(f"Timeout conectando con Ollama: {e}") from e
+            except requests.exceptions.RequestException as e:
+                self.circuito.registrar_fallo()
+                logger.error(f"❌ Error en petición HTTP a Ollama: {e}")
+                raise OllamaError(f"Error en petición HTTP a Ollama: {e}") from e
+            break
+
+        logger.debug(f"📥 Respuesta de Ollama {ruta}: status={response.status_code}")
+        if response.status_code != 200:
+            if response.status_code >= 500:
+                self.circuito.registrar_fallo()
+            else:
+                self.circuito.registrar_exito()
+            texto = response.text
+            response.close()
+            logger.error(f"❌ Error HTTP de Ollama: {response.status_code} - {texto}")
+            raise OllamaError(f"Error HTTP de Ollama: {response.status_code}")
+
+        self.circuito.registrar_exito()
+        return response
+
+    def _post_json(self, ruta, payload, timeout=None):
+        response = self._peticion("POST", ruta, json=payload, timeout=timeout)
+        try:
+            return response.json()
+        except ValueError as e:
+            logger.error(f"❌ Error decodificando JSON de Ollama: {e}")
+            raise OllamaRespuestaMalformada("Respuesta de Ollama no es JSON") from e
+
+    # -----------------------------
+    # API pública
+    # -----------------------------
+    def chat(self, messages, model, timeout=None, **opciones):
+        """Llama a /api/chat sin streaming y devuelve el JSON completo ya validado."""
+        payload = self._con_keep_alive(model, {"model": model, "messages": messages, "stream": False, **opciones})
+        data = self._post_json("/api/chat", payload, timeout=timeout)
+        if "message" not in data or "content" not in data["message"]:
+            logger.error(f"❌ Respuesta de Ollama malformada: {data}")
+            raise OllamaRespuestaMalformada("Respuesta de Ollama malformada")
+        self._notificar(model, data)
+        return data
+
+    def chat_contenido(self, messages, model, timeout=None, **opciones):
+        """Como chat(), pero devuelve solo `message.content`."""
+        return self.chat(messages, model, timeout=timeout, **opciones)["message"]["content"]
+
+    def chat_stream(self, messages, model, timeout=None, **opciones):
+        """
+        Llama a /api/chat en streaming y va devolviendo cada fragmento JSON de Ollama.
+        El último fragmento tiene "done": true. Si se cierra el generador antes (corte de
+        una extracción, cliente que se va), los observadores reciben los fragmentos
+        generados hasta entonces como `eval_count`.
+        """
+        payload = self._con_keep_alive(model, {"model": model, "messages": messages, "stream": True, **opciones})
+        response = self._peticion("POST", "/api/chat", json=payload, timeout=timeout, stream=True)
+        generados, inicio_generacion = 0, None
+        with response:
+            lineas = response.iter_lines()
+            while True:
+                try:
+                    linea = next(lineas, None)
+                except requests.exceptions.RequestException as e:
+                    # Corte a mitad del stream (ChunkedEncodingError, ReadTimeout...)
+                    self.circuito.registrar_fallo()
+                    logger.error(f"❌ Stream de Ollama interrumpido: {e}")
+                    raise OllamaNoDisponible(f"Stream de Ollama interrumpido: {e}") from e
+                if linea is None:
+                    break
+                if not linea:
+                    continue
+                try:
+                    chunk = json.loads(linea)
+                except json.JSONDecodeError as e:
+                    logger.error(f"❌ Error decodificando fragmento JSON de Ollama: {e}")
+                    raise OllamaRespuestaMalformada("Respuesta de Ollama malformada") from e
+                if "error" in chunk:
+                    raise OllamaError(chunk["error"])
+                if chunk.get("done"):
+                    self._notificar(model, chunk)
+                    yield chunk
+                    break
+                # Ollama manda un token por fragmento
+                generados += 1
+                inicio_generacion = inicio_generacion or time.monotonic()
+                try:
+                    yield chunk
+                except GeneratorExit:
+                    self._notificar(model, {
+                        "eval_count": generados,
+                        "eval_duration": int((time.monotonic() - inicio_generacion) * 1e9),
+                        "parcial": True,
+                    })
+                    raise
+
+    def embeddings(self, textos, model, timeout=None):
+        """Devuelve un vector por texto usando /api/embed."""
+        payload = self._con_keep_alive(model, {"model": model, "input": list(textos)})
+        data = self._post_json("/api/embed", payload, timeout=timeout)
+        vectores = data.get("embeddings")
+        if not isinstance(vectores, list) or len(vectores) != len(textos):
+            logger.error(f"❌ Respuesta de /api/embed malformada: {str(data)[:200]}")
+            raise OllamaRespuestaMalformada("Respuesta de /api/embed malformada")
+        return vectores
+
+    def cargar(self, model, keep_alive=None, embeddings=False, timeout=None):
+        """
+        Carga `model` en memoria sin generar nada (mensajes o entrada vacíos) y devuelve
+        el JSON de Ollama, con `load_duration` si ha tenido que cargarlo.
+        """
+        if embeddings:
+            ruta, payload = "/api/embed", {"model": model, "input": []}
+        else:
+            ruta, payload = "/api/chat", {"model": model, "messages": [], "stream": False}
+        if keep_alive is not None:
+            payload["keep_alive"] = keep_alive
+        return self._post_json(ruta, self._con_keep_alive(model, payload), timeout=timeout)
+
+    def modelos(self, timeout=10):
+        """Devuelve la lista de nombres de modelos de /api/tags."""
+        response = self._peticion("GET", "/api/tags", timeout=timeout)
+        try:
+            data = response.json()
+        except ValueError as e:
+            raise OllamaRespuestaMalformada("Respuesta de /api/tags no es JSON") from e
+        return [model["name"] for model in data.get("models", [])]
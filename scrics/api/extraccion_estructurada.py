@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Extracción estructurada con esquema JSON.
+
+El esquema se pasa a Ollama en el parámetro `format`, de modo que el modelo solo puede
+generar JSON con esa forma. La respuesta se valida contra el mismo esquema y, si no lo
+cumple, se reintenta (con un presupuesto acotado) explicándole al modelo el error.
+Se llevan contadores de éxito y latencia por esquema.
+
+Con extraer_cascada() se prueba primero el modelo más barato y solo se pasa al
+siguiente si su respuesta no es válida o ese modelo da error (no está descargado...);
+se lleva la tasa de acierto de cada etapa. La cascada cuenta como una sola llamada en
+los contadores del esquema.
+
+En modo streaming los tokens pasan por un parser incremental y la generación se corta
+en cuanto llega un objeto completo que cumple el esquema, sin esperar al resto.
+"""
+
+import json
+import logging
+import threading
+import time
+from contextlib import nullcontext
+
+from cliente_ollama import OllamaError, OllamaNoDisponible
+from registro_logs import CARGA
+
+logger = logging.getLogger(__name__)
+
+
+# -----------------------------
+# Esquemas
+# -----------------------------
+ESQUEMA_DIARIO = {
+    "type": "object",
+    "properties": {
+        "FECHA": {"type": "string"},
+        "TIPO": {"type": "string"},
+        "LUGAR": {"type": "string"},
+    },
+    "required": ["FECHA", "TIPO", "LUGAR"],
+}
+
+ESQUEMA_EVENTO = {
+    "type": "object",
+    "properties": {
+        "persona": {"type": "string"},
+        "tipo": {"type": "string"},
+        "nombre": {"type": "string"},
+        "lugar": {"type": "string"},
+        "fecha": {"type": "string"},
+        "notas": {"type": "string"},
+    },
+    "required": ["persona", "tipo", "nombre", "lugar", "fecha", "notas"],
+}
+
+ESQUEMAS = {
+    "diario": ESQUEMA_DIARIO,
+    "evento": ESQUEMA_EVENTO,
+}
+
+_TIPOS = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "integer": int,
+    "number": float,
+    "boolean": bool,
+    "null": type(None),
+}
+
+
+class ExtraccionError(ValueError):
+    """El modelo no ha devuelto un JSON que cumpla el esquema dentro del presupuesto de reintentos."""
+
+
+def validar_esquema(valor, esquema, ruta="$"):
+    """
+    Valida `valor` contra el subconjunto de JSON Schema que usamos (type, properties,
+    required, items, enum, minLength, additionalProperties). Devuelve la lista de errores.
+    """
+    errores = []
+    tipo = esquema.get("type")
+    if tipo:
+        tipos = tipo if isinstance(tipo, list) else [tipo]
+        python = tuple(_TIPOS[t] for t in tipos)
+        if "number" in tipos:
+            python += (int,)
+        # bool es subclase de int en Python, pero no es un número en JSON
+        if not isinstance(valor, python) or (isinstance(valor, bool) and "boolean" not in tipos):
+            return [f"{ruta}: se esperaba {tipo}, llegó {type(valor).__name__}"]
+
+    if "enum" in esquema and valor not in esquema["enum"]:
+        errores.append(f"{ruta}: valor {valor!r} no permitido")
+
+    if isinstance(valor, str) and len(valor) < esquema.get("minLength", 0):
+        errores.append(f"{ruta}: texto demasiado corto")
+
+    if isinstance(valor, dict):
+        for clave in esquema.get("required", []):
+            if clave not in valor:
+                errores.append(f"{ruta}: falta la clave '{clave}'")
+        propiedades = esquema.get("properties", {})
+        for clave, sub in valor.items():
+            if clave in propiedades:
+                errores.extend(validar_esquema(sub, propiedades[clave], f"{ruta}.{clave}"))
+            elif esquema.get("additionalProperties") is False:
+                errores.append(f"{ruta}: clave no permitida '{clave}'")
+
+    if isinstance(valor, list) and "items" in esquema:
+        for i, item in enumerate(valor):
+            errores.extend(validar_esquema(item, esquema["items"], f"{ruta}[{i}]"))
+
+    return errores
+
+
+class ParserJsonIncremental:
+    """
+    Recibe texto a trozos y devuelve cada objeto JSON de primer nivel en cuanto se cierra
+    su última llave. Ignora lo que haya fuera de los objetos y respeta llaves dentro de strings.
+    """
+
+    def __init__(self):
+        self._buffer = []
+        self._profundidad = 0
+        self._en_string = False
+        self._escape = False
+
+    def alimentar(self, texto):
+        """Devuelve la lista de objetos (como texto) que se han completado con este trozo."""
+        completos = []
+        for c in texto:
+            if self._profundidad == 0:
+                if c == "{":
+                    self._buffer = [c]
+                    self._profundidad = 1
+                continue
+            self._buffer.append(c)
+            if self._en_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._en_string = False
+            elif c == '"':
+                self._en_string = True
+            elif c == "{":
+                self._profundidad += 1
+            elif c == "}":
+                self._profundidad -= 1
+                if self._profundidad == 0:
+                    completos.append("".join(self._buffer))
+                    self._buffer = []
+        return completos
+
+
+class _Contadores:
+    def __init__(self):
+        self.llamadas = 0
+        self.exitos = 0
+        self.fallos = 0
+        self.reintentos = 0
+        self.cortes = 0
+        self.latencia_total = 0.0
+        self.latencia_max = 0.0
+        self.etapas = {}  # modelo -> [intentos, aciertos] en la cascada
+
+    def como_dict(self):
+        return {
+            "llamadas": self.llamadas,
+            "exitos": self.exitos,
+            "fallos": self.fallos,
+            "reintentos": self.reintentos,
+            "cortes_anticipados": self.cortes,
+            "ratio_exito": round(self.exitos / self.llamadas, 4) if self.llamadas else 0.0,
+            "latencia_media_s": round(self.latencia_total / self.llamadas, 3) if self.llamadas else 0.0,
+            "latencia_max_s": round(self.latencia_max, 3),
+            "etapas": {
+                modelo: {
+                    "intentos": intentos,
+                    "aciertos": aciertos,
+                    "ratio_aciertos": round(aciertos / intentos, 4) if intentos else 0.0,
+                }
+                for modelo, (intentos, aciertos) in self.etapas.items()
+            },
+        }
+
+
+class ExtractorEstructurado:
+    def __init__(self, cliente, reintentos=2, esquemas=None, stream=True, admision=None):
+        self.cliente = cliente
+        self.reintentos = reintentos
+        self.stream = stream
+        # admision(modelo) -> context manager que se mantiene durante cada generación
+        self.admision = admision or (lambda modelo: nullcontext())
+        self.esquemas = dict(ESQUEMAS)
+        self.esquemas.update(esquemas or {})
+        self._contadores = {}
+        self._lock = threading.Lock()
+
+    def extraer(self, nombre_esquema, messages, model, timeout=None, validar=None, reintentos=None, **opciones):
+        """
+        Pide a `model` un JSON con la forma del esquema `nombre_esquema` y lo devuelve ya
+        validado. `validar(objeto)` permite añadir comprobaciones propias (devuelve una
+        lista de errores). Lanza OllamaError si falla Ollama y ExtraccionError si se agota
+        el presupuesto de reintentos.
+        """
+        inicio = time.monotonic()
+        ok = False
+        try:
+            objeto = self._extraer(nombre_esquema, messages, model, timeout, validar, reintentos, opciones)
+            ok = True
+            return objeto
+        finally:
+            self._registrar(nombre_esquema, ok, time.monotonic() - inicio)
+
+    def _extraer(self, nombre_esquema, messages, model, timeout, validar, reintentos, opciones):
+        """extraer() sin actualizar los contadores del esquema."""
+        esquema = self.esquemas[nombre_esquema]
+        reintentos = self.reintentos if reintentos is None else reintentos
+        opciones["options"] = {"temperature": 0, **opciones.get("options", {})}
+        messages = list(messages)
+        errores = []
+        for intento in range(reintentos + 1):
+            if intento:
+                with self._lock:
+                    self._contador(nombre_esquema).reintentos += 1
+                logger.warning(f"⚠️ Extracción '{nombre_esquema}' no válida ({'; '.join(errores)}), reintento {intento}/{reintentos}")
+            with self.admision(model):
+                if self.stream:
+                    objeto, contenido, errores = self._generar_stream(
+                        nombre_esquema, esquema, messages, model, timeout, validar, opciones
+                    )
+                else:
+                    contenido = self.cliente.chat_contenido(messages, model, timeout=timeout, format=esquema, **opciones)
+                    objeto, errores = self._validar(contenido, esquema, validar)
+            logger.debug("🟦 Extracción '%s' recibida: %s", nombre_esquema, contenido, extra=CARGA)
+            if not errores:
+                return objeto
+            messages = messages + [
+                {"role": "assistant", "content": contenido},
+                {"role": "user", "content": f"La respuesta no es válida: {'; '.join(errores)}. Devuelve solo el JSON corregido."},
+            ]
+        raise ExtraccionError(f"No se pudo extraer un JSON válido para '{nombre_esquema}': {'; '.join(errores)}")
+
+    def extraer_cascada(self, nombre_esquema, messages, modelos, timeout=None, validar=None, **opciones):
+        """
+        Prueba los `modelos` en orden (del más barato al más caro) y devuelve
+        (objeto, modelo) con la primera respuesta válida. Las etapas intermedias no se
+        reintentan: si su respuesta no es válida, o el modelo da error (por ejemplo, no
+        está descargado), se pasa al siguiente; la última usa el presupuesto de
+        reintentos normal. Si Ollama no está disponible se falla sin probar más modelos.
+
+        Los fallos de las etapas intermedias solo cuentan en `etapas`; en los contadores
+        del esquema la cascada es una llamada, con éxito si algún modelo ha respondido.
+        """
+        inicio = time.monotonic()
+        ok = False
+        try:
+            for i, modelo in enumerate(modelos):
+                ultima = i == len(modelos) - 1
+                try:
+                    objeto = self._extraer(
+                        nombre_esquema, messages, modelo, timeout, validar,
+                        None if ultima else 0, dict(opciones)
+                    )
+                except OllamaNoDisponible:
+                    self._registrar_etapa(nombre_esquema, modelo, False)
+                    raise
+                except (ExtraccionError, OllamaError) as e:
+                    self._registrar_etapa(nombre_esquema, modelo, False)
+                    if ultima:
+                        raise
+                    logger.info(f"⤴️ Extracción '{nombre_esquema}' fallida con {modelo}, se pasa a {modelos[i + 1]}: {e}")
+                    continue
+                self._registrar_etapa(nombre_esquema, modelo, True)
+                ok = True
+                return objeto, modelo
+        finally:
+            self._registrar(nombre_esquema, ok, time.monotonic() - inicio)
+
+    def _registrar_etapa(self, nombre_esquema, modelo, ok):
+        with self._lock:
+            etapa = self._contador(nombre_esquema).etapas.setdefault(modelo, [0, 0])
+            etapa[0] += 1
+            if ok:
+                etapa[1] += 1
+
+    def _validar(self, texto, esquema, validar):
+        """Devuelve (objeto, errores); sin errores el objeto cumple el esquema y `validar`."""
+        try:
+            objeto = json.loads(texto)
+        except json.JSONDecodeError as e:
+            return None, [f"JSON no válido: {e}"]
+        errores = validar_esquema(objeto, esquema)
+        if not errores and validar:
+            errores = validar(objeto)
+        return objeto, errores
+
+    def _generar_stream(self, nombre_esquema, esquema, messages, model, timeout, validar, opciones):
+        """
+        Genera en streaming y corta la conexión (Ollama deja de generar) en cuanto llega
+        un objeto válido. Devuelve (objeto, texto_recibido, errores).
+        """
+        parser = ParserJsonIncremental()
+        partes = []
+        errores = ["la respuesta no contiene ningún objeto JSON"]
+        chunks = self.cliente.chat_stream(messages, model, timeout=timeout, format=esquema, **opciones)
+        try:
+            for chunk in chunks:
+                token = chunk.get("message", {}).get("content", "")
+                partes.append(token)
+                for texto in parser.alimentar(token):
+                    objeto, errores = self._validar(texto, esquema, validar)
+                    if not errores:
+                        if not chunk.get("done"):
+                            with self._lock:
+                                self._contador(nombre_esquema).cortes += 1
+                            logger.debug(f"✂️ Extracción '{nombre_esquema}' cortada al recibir un objeto válido")
+                        return objeto, "".join(partes), []
+        finally:
+            chunks.close()
+        return None, "".join(partes), errores
+
+    def _contador(self, nombre_esquema):
+        return self._contadores.setdefault(nombre_esquema, _Contadores())
+
+    def _registrar(self, nombre_esquema, ok, latencia):
+        with self._lock:
+            c = self._contador(nombre_esquema)
+            c.llamadas += 1
+            if ok:
+                c.exitos += 1
+            else:
+                c.fallos += 1
+            c.latencia_total += latencia
+            c.latencia_max = max(c.latencia_max, latencia)
+
+    def estadisticas(self):
+        with self._lock:
+            return {nombre: c.como_dict() for nombre, c in self._contadores.items()}
+
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Extractor local (sin LLM) de FECHA/TIPO/LUGAR para entradas del diario.
+
+Reglas para español:
+- Fechas explícitas ("el 1 de mayo del 2024", "1/5/2024", "2024-05-01", "el día 3 de junio").
+- Fechas relativas ("hoy", "ayer", "anteayer", "el domingo", "el lunes pasado", "hace 3 días").
+- Tipo de evento por palabras clave ("cenar" -> Cena, "concierto" -> Concierto...).
+- Lugar con un diccionario de sitios conocidos (ciudades, salas, parques...) ampliable
+  con un fichero JSON. Se busca en el texto original respetando mayúsculas ("la palma de
+  la mano" no es Palma). Los nombres que también son palabras comunes (Granada, León...)
+  solo cuentan detrás de una preposición de lugar ("en Granada") y con menos confianza.
+
+Devuelve una confianza entre 0 y 1; si no llega al umbral la entrada se pasa al LLM.
+"""
+
+import json
+import logging
+import os
+import re
+import unicodedata
+from datetime import date, datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+MESES = {
+    "enero": 1, "febrero": 2, "marzo": 3, "abril": 4, "mayo": 5, "junio": 6, "julio": 7,
+    "agosto": 8, "septiembre": 9, "setiembre": 9, "octubre": 10, "noviembre": 11, "diciembre": 12,
+}
+DIAS_SEMANA = {
+    "lunes": 0, "martes": 1, "miercoles": 2, "jueves": 3, "viernes": 4, "sabado": 5, "domingo": 6,
+}
+NUMEROS = {
+    "un": 1, "una": 1, "uno": 1, "dos": 2, "tres": 3, "cuatro": 4, "cinco": 5, "seis": 6,
+    "siete": 7, "ocho": 8, "nueve": 9, "diez": 10, "quince": 15,
+}
+
+# Palabra clave (sin tildes, como prefijo de palabra) -> TIPO
+TIPOS = [
+    ("cumpleanos", "Cumpleaños"), ("boda", "Boda"), ("concierto", "Concierto"),
+    ("festival", "Concierto"), ("cenar", "Cena"), ("cena", "Cena"), ("comer", "Comida"),
+    ("comida", "Comida"), ("almorz", "Comida"), ("desayun", "Desayuno"), ("brunch", "Desayuno"),
+    ("medico", "Médico"), ("doctor", "Médico"), ("hospital", "Médico"), ("dentista", "Médico"),
+    ("urgencias", "Médico"), ("viaje", "Viaje"), ("viaj", "Viaje"), ("vuelo", "Viaje"),
+    ("excursion", "Excursión"), ("ruta", "Excursión"), ("senderismo", "Excursión"),
+    ("correr", "Correr"), ("carrera", "Correr"), ("maraton", "Correr"), ("gimnasio", "Gimnasio"),
+    ("entren", "Gimnasio"), ("partido", "Deporte"), ("futbol", "Deporte"), ("padel", "Deporte"),
+    ("tenis", "Deporte"), ("cine", "Cine"), ("pelicula", "Cine"), ("teatro", "Teatro"),
+    ("musical", "Teatro"), ("museo", "Museo"), ("exposicion", "Museo"), ("paseo", "Paseo"),
+    ("pasear", "Paseo"), ("reunion", "Trabajo"), ("trabaj", "Trabajo"), ("oficina", "Trabajo"),
+    ("compras", "Compras"), ("comprar", "Compras"), ("copas", "Ocio"), ("fiesta", "Fiesta"),
+]
+
+# Sitios conocidos; se amplían con LUGARES_FILE
+LUGARES = [
+    "Madrid", "Barcelona", "Valencia", "Sevilla", "Zaragoza", "Málaga", "Murcia", "Palma",
+    "Bilbao", "Alicante", "Córdoba", "Valladolid", "Vigo", "Gijón", "Granada", "A Coruña",
+    "Vitoria", "Santander", "San Sebastián", "Pamplona", "Salamanca", "Toledo", "Segovia",
+    "Ávila", "Cádiz", "Oviedo", "León", "Burgos", "Cuenca", "Guadalajara", "Alcalá de Henares",
+    "Lisboa", "Oporto", "París", "Londres", "Roma", "Berlín", "Nueva York",
+    "Retiro", "Casa de Campo", "La Riviera", "WiZink Center", "Bernabéu", "Metropolitano",
+    "Gran Vía", "Puerta del Sol", "Plaza Mayor", "Madrid Río", "Museo del Prado",
+    "Reina Sofía", "Thyssen", "Sala Apolo", "Palau Sant Jordi", "Sierra de Guadarrama",
+]
+
+# Sitios que también son palabras comunes: exigen "en/a/al/de/del/desde/hasta/por <Lugar>"
+LUGARES_AMBIGUOS = {"Palma", "Granada", "León", "Retiro", "Metropolitano", "Córdoba", "Cuenca", "Vigo"}
+CONFIANZA_LUGAR_AMBIGUO = 0.5
+_PREPOSICION_LUGAR = re.compile(r"\b(?:en|a|al|de|del|desde|hasta|por|hacia)\s+(?:el\s+|la\s+)?$", re.IGNORECASE)
+
+
+def quitar_tildes(texto):
+    return "".join(c for c in unicodedata.normalize("NFD", texto) if unicodedata.category(c) != "Mn")
+
+
+def normalizar(texto):
+    """Minúsculas y sin tildes. Conserva la longitud de un texto en NFC."""
+    return quitar_tildes(unicodedata.normalize("NFC", texto)).lower()
+
+
+_MESES_RE = "|".join(MESES)
+_DIAS_RE = "|".join(DIAS_SEMANA)
+_NUMEROS_RE = "|".join(NUMEROS)
+
+RE_FECHA_TEXTO = re.compile(
+    rf"\b(?:el\s+)?(?:dia\s+)?(\d{{1,2}})(?:º|o)?\s+de\s+({_MESES_RE})(?:\s+(?:de|del)\s+(\d{{4}}))?\b"
+)
+RE_FECHA_DMY = re.compile(r"\b(\d{1,2})[/\-.](\d{1,2})[/\-.](\d{4}|\d{2})\b")
+RE_FECHA_YMD = re.compile(r"\b(\d{4})[/\-.](\d{1,2})[/\-.](\d{1,2})\b")
+RE_DIA_SEMANA = re.compile(rf"\b(?:el|este|el pasado)\s+({_DIAS_RE})(\s+pasado)?\b")
+RE_HACE = re.compile(rf"\bhace\s+(\d+|{_NUMEROS_RE})\s+(dias?|semanas?)\b")
+RE_ANTEAYER = re.compile(r"\b(?:anteayer|antes de ayer|antier)\b")
+RE_AYER = re.compile(r"\bayer\b")
+RE_HOY = re.compile(r"\b(?:hoy|esta (?:manana|tarde|noche))\b")
+
+
+def _fecha_segura(anio, mes, dia):
+    try:
+        return date(anio, mes, dia)
+    except ValueError:
+        return None
+
+
+def extraer_fecha(texto_norm, hoy):
+    """Devuelve (fecha, confianza) o (None, 0.0)."""
+    m = RE_FECHA_YMD.search(texto_norm)
+    if m:
+        f = _fecha_segura(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+        if f:
+            return f, 1.0
+
+    m = RE_FECHA_DMY.search(texto_norm)
+    if m:
+        anio = int(m.group(3))
+        if anio < 100:
+            anio += 2000
+        f = _fecha_segura(anio, int(m.group(2)), int(m.group(1)))
+        if f:
+            return f, 1.0
+
+    m = RE_FECHA_TEXTO.search(texto_norm)
+    if m:
+        dia, mes = int(m.group(1)), MESES[m.group(2)]
+        if m.group(3):
+            f = _fecha_segura(int(m.group(3)), mes, dia)
+            if f:
+                return f, 1.0
+        else:
+            # Sin año: el diario habla del pasado, así que si cae en el futuro es del año anterior
+            f = _fecha_segura(hoy.year, mes, dia)
+            if f and f > hoy:
+                f = _fecha_segura(hoy.year - 1, mes, dia)
+            if f:
+                return f, 0.9
+
+    if RE_ANTEAYER.search(texto_norm):
+        return hoy - timedelta(days=2), 0.95
+    if RE_AYER.search(texto_norm):
+        return hoy - timedelta(days=1), 0.95
+
+    m = RE_HACE.search(texto_norm)
+    if m:
+        cantidad = int(m.group(1)) if m.group(1).isdigit() else NUMEROS[m.group(1)]
+        dias = cantidad * 7 if m.group(2).startswith("semana") else cantidad
+        return hoy - timedelta(days=dias), 0.9
+
+    m = RE_DIA_SEMANA.search(texto_norm)
+    if m:
+        atras = (hoy.weekday() - DIAS_SEMANA[m.group(1)]) % 7
+        if atras == 0 and (m.group(2) or "pasado" in m.group(0)):
+            atras = 7
+        return hoy - timedelta(days=atras), 0.85
+
+    if RE_HOY.search(texto_norm):
+        return hoy, 0.9
+
+    return None, 0.0
+
+
+def extraer_tipo(texto_norm):
+    for palabra in re.findall(r"\w+", texto_norm):
+        for clave, tipo in TIPOS:
+            if palabra.startswith(clave):
+                return tipo
+    return None
+
+
+class ExtractorLocal:
+    def __init__(self, umbral=0.8, lugares_file=None):
+        self.umbral = umbral
+        lugares = list(LUGARES)
+        if lugares_file and os.path.exists(lugares_file):
+            try:
+                with open(lugares_file, "r", encoding="utf-8") as f:
+                    lugares.extend(json.load(f))
+                logger.info(f"📍 Lugares cargados de {lugares_file}")
+            except (OSError, json.JSONDecodeError) as e:
+                logger.warning(f"⚠️ No se pudo cargar {lugares_file}: {e}")
+        # Los nombres más largos primero para que "Casa de Campo" gane a "Campo". Sin tildes
+        # pero con mayúsculas: los nombres propios se escriben con mayúscula
+        lugares = sorted(set(lugares), key=len, reverse=True)
+        self._lugares_re = re.compile(
+            r"\b(" + "|".join(re.escape(quitar_tildes(l)) for l in lugares) + r")\b"
+        )
+        self._canonicos = {quitar_tildes(l): l for l in lugares}
+
+    def extraer_lugar(self, texto):
+        """Devuelve (lugares, confianza) buscando en el texto original, o (None, 0.0)."""
+        texto = quitar_tildes(unicodedata.normalize("NFC", texto))
+        encontrados = []
+        confianza = 0.0
+        for m in self._lugares_re.finditer(texto):
+            nombre = self._canonicos[m.group(1)]
+            if nombre in LUGARES_AMBIGUOS:
+                if not _PREPOSICION_LUGAR.search(texto[:m.start()]):
+                    continue
+                conf = CONFIANZA_LUGAR_AMBIGUO
+            else:
+                conf = 1.0
+            if nombre not in encontrados:
+                encontrados.append(nombre)
+                confianza = max(confianza, conf)
+        return (", ".join(encontrados), confianza) if encontrados else (None, 0.0)
+
+    def extraer(self, texto, hoy=None):
+        """
+        Devuelve {"FECHA", "TIPO", "LUGAR", "confianza"}. FECHA en formato DD/MM/YYYY.
+        La confianza es la media de la de cada campo (0 si el campo no se encuentra).
+        """
+        hoy = hoy or datetime.now().date()
+        texto_norm = normalizar(texto)
+        fecha, conf_fecha = extraer_fecha(texto_norm, hoy)
+        tipo = extraer_tipo(texto_norm)
+        lugar, conf_lugar = self.extraer_lugar(texto)
+        confianza = (conf_fecha + (1.0 if tipo else 0.0) + conf_lugar) / 3
+        return {
+            "FECHA": fecha.strftime("%d/%m/%Y") if fecha else "",
+            "TIPO": tipo or "",
+            "LUGAR": lugar or "",
+            "confianza": round(confianza, 3),
+        }
+
+    def es_fiable(self, resultado):
+        return resultado["confianza"] >= self.umbral
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Historial de conversación append-only con índice de offsets.
+
+Por persona se guardan dos ficheros en el directorio de historial:
+- `<persona>_history.jsonl`: un registro JSON por turno
+  {"ts": ..., "usuario": ..., "asistente": ..., "tokens_usuario": ..., "tokens_asistente": ...}
+- `<persona>_history.idx`: offset (8 bytes, little-endian) del inicio de cada registro.
+
+Con el índice se cargan los últimos N turnos leyendo solo N offsets y el final del
+fichero, sin recorrer todo el historial. Los `<persona>_history.txt` antiguos
+(formato "Usuario: ... / Persona: ...") se migran la primera vez que se accede a ellos.
+
+Los accesos de cada persona se serializan con un bloqueo que vale también entre
+procesos (`.locks/<persona>.lock`), así el servidor puede correr con varios workers.
+"""
+
+import json
+import logging
+import os
+import re
+import struct
+from datetime import datetime
+
+from bloqueo_ficheros import BloqueosPorNombre
+from presupuesto_tokens import estimar_tokens
+
+logger = logging.getLogger(__name__)
+
+OFFSET = struct.Struct("<Q")
+SUFIJO_DATOS = "_history.jsonl"
+SUFIJO_INDICE = "_history.idx"
+SUFIJO_LEGADO = "_history.txt"
+
+
+def parsear_historial_legado(lineas, nombre_persona):
+    """
+    Convierte el formato de texto antiguo en pares (usuario, asistente).
+    Las líneas que no empiezan por cabecera se añaden a la entrada anterior, así las
+    respuestas multilínea no rompen el emparejado.
+    """
+    cabecera_persona = re.compile(rf"^{re.escape(nombre_persona)}:\s?", re.IGNORECASE)
+    turnos = []
+    usuario, asistente = None, None
+    actual = None
+
+    def cerrar():
+        if usuario is not None:
+            turnos.append(("\n".join(usuario).strip(), "\n".join(asistente or []).strip()))
+
+    for linea in lineas:
+        linea = linea.rstrip("\n")
+        if linea.startswith("Usuario: ") or linea == "Usuario:":
+            cerrar()
+            usuario, asistente = [linea[len("Usuario:"):].strip()], None
+            actual = usuario
+        elif usuario is not None and asistente is None:
+            # Primera línea tras el usuario: respuesta de la persona, con o sin cabecera
+            m = cabecera_persona.match(linea)
+            if m:
+                contenido = linea[m.end():]
+            elif ": " in linea:
+                contenido = linea.split(": ", 1)[1]
+            else:
+                contenido = linea
+            asistente = [contenido]
+            actual = asistente
+        elif actual is not None:
+            actual.append(linea)
+    cerrar()
+    return turnos
+
+
+class HistorialStore:
+    def __init__(self, directorio):
+        self.directorio = directorio
+        self._bloqueos = BloqueosPorNombre(os.path.join(directorio, ".locks"))
+
+    # -----------------------------
+    # Rutas y bloqueo
+    # -----------------------------
+    def _ruta(self, nombre_persona, sufijo):
+        return os.path.join(self.directorio, f"{nombre_persona}{sufijo}")
+
+    def _lock(self, nombre_persona):
+        return self._bloqueos(nombre_persona)
+
+    def existe(self, nombre_persona):
+        return (os.path.exists(self._ruta(nombre_persona, SUFIJO_DATOS))
+                or os.path.exists(self._ruta(nombre_persona, SUFIJO_LEGADO)))
+
+    def ruta_datos(self, nombre_persona):
+        return self._ruta(nombre_persona, SUFIJO_DATOS)
+
+    # -----------------------------
+    # Migración e índice
+    # -----------------------------
+    def _migrar_si_hace_falta(self, nombre_persona):
+        datos = self._ruta(nombre_persona, SUFIJO_DATOS)
+        legado = self._ruta(nombre_persona, SUFIJO_LEGADO)
+        if os.path.exists(datos) or not os.path.exists(legado):
+            return
+
+        logger.info(f"🔁 Migrando historial de texto a JSONL: {legado}")
+        with open(legado, "r", encoding="utf-8") as f:
+            turnos = parsear_historial_legado(f.readlines(), nombre_persona)
+        ts = datetime.fromtimestamp(os.path.getmtime(legado)).isoformat(timespec="seconds")
+        registros = [self._registro(u, a, ts=ts) for u, a in turnos]
+        self._escribir_todo(nombre_persona, registros)
+        os.replace(legado, legado + ".migrado")
+        logger.info(f"✅ Historial migrado: {len(registros)} turnos")
+
+    def _reconstruir_indice(self, nombre_persona):
+        datos = self._ruta(nombre_persona, SUFIJO_DATOS)
+        offsets = []
+        with open(datos, "rb") as f:
+            pos = 0
+            for linea in f:
+                if linea.strip():
+                    offsets.append(pos)
+                pos += len(linea)
+        with open(self._ruta(nombre_persona, SUFIJO_INDICE), "wb") as f:
+            f.write(b"".join(OFFSET.pack(o) for o in offsets))
+        logger.warning(f"⚠️ Índice de historial reconstruido para {nombre_persona}: {len(offsets)} turnos")
+
+    def _leer_offsets(self, nombre_persona, n=None):
+        """Devuelve los últimos n offsets del índice (todos si n es None)."""
+        indice = self._ruta(nombre_persona, SUFIJO_INDICE)
+        datos = self._ruta(nombre_persona, SUFIJO_DATOS)
+        if not os.path.exists(indice):
+            self._reconstruir_indice(nombre_persona)
+        total = os.path.getsize(indice) // OFFSET.size
+        if n is None or n > total:
+            n = total
+        if n == 0:
+            return [], 0
+        with open(indice, "rb") as f:
+            f.seek((total - n) * OFFSET.size)
+            bloque = f.read(n * OFFSET.size)
+        offsets = [OFFSET.unpack_from(bloque, i * OFFSET.size)[0] for i in range(n)]
+        if offsets[-1] >= os.path.getsize(datos):
+            # El índice apunta más allá de los datos (escritura interrumpida)
+            self._reconstruir_indice(nombre_persona)
+            return self._leer_offsets(nombre_persona, n)
+        return offsets, total
+
+    # -----------------------------
+    # Lectura
+    # -----------------------------
+    def ultimos(self, nombre_persona, n=None):
+        """Devuelve los últimos n turnos (todos si n es None) en orden cronológico."""
+        with self._lock(nombre_persona):
+            self._migrar_si_hace_falta(nombre_persona)
+            datos = self._ruta(nombre_persona, SUFIJO_DATOS)
+            if not os.path.exists(datos):
+                return []
+            offsets, _ = self._leer_offsets(nombre_persona, n)
+            if not offsets:
+                return []
+            with open(datos, "rb") as f:
+                f.seek(offsets[0])
+                contenido = f.read()
+
+        registros = []
+        for linea in contenido.splitlines():
+            if not linea.strip():
+                continue
+            try:
+                registros.append(json.loads(linea))
+            except json.JSONDecodeError:
+                logger.warning(f"⚠️ Registro de historial corrupto ignorado para {nombre_persona}")
+        # Si el índice iba por detrás de los datos, se leen líneas de más
+        return registros[-n:] if n else registros
+
+    def numero_turnos(self, nombre_persona):
+        with self._lock(nombre_persona):
+            self._migrar_si_hace_falta(nombre_persona)
+            if not os.path.exists(self._ruta(nombre_persona, SUFIJO_DATOS)):
+                return 0
+            indice = self._ruta(nombre_persona, SUFIJO_INDICE)
+            if not os.path.exists(indice):
+                self._reconstruir_indice(nombre_persona)
+            return os.path.getsize(indice) // OFFSET.size
+
+    # -----------------------------
+    # Escritura
+    # -----------------------------
+    @staticmethod
+    def _registro(usuario, asistente, tokens_usuario=None, tokens_asistente=None, ts=None):
+        return {
+            "ts": ts or datetime.now().isoformat(timespec="seconds"),
+            "usuario": usuario,
+            "asistente": asistente,
+            "tokens_usuario": tokens_usuario if tokens_usuario is not None else estimar_tokens(usuario),
+            "tokens_asistente": tokens_asistente if tokens_asistente is not None else estimar_tokens(asistente),
+        }
+
+    def anadir(self, nombre_persona, usuario, asistente, tokens_usuario=None, tokens_asistente=None):
+        registro = self._registro(usuario, asistente, tokens_usuario, tokens_asistente)
+        linea = (json.dumps(registro, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._lock(nombre_persona):
+            self._migrar_si_hace_falta(nombre_persona)
+            datos = self._ruta(nombre_persona, SUFIJO_DATOS)
+            indice = self._ruta(nombre_persona, SUFIJO_INDICE)
+            if os.path.exists(datos) and not os.path.exists(indice):
+                self._reconstruir_indice(nombre_persona)
+            with open(datos, "ab") as f:
+                offset = f.tell()
+                f.write(linea)
+            with open(indice, "ab") as f:
+                f.write(OFFSET.pack(offset))
+        return registro
+
+    def _escribir_todo(self, nombre_persona, registros):
+        datos = self._ruta(nombre_persona, SUFIJO_DATOS)
+        indice = self._ruta(nombre_persona, SUFIJO_INDICE)
+        offsets = []
+        with open(datos + ".tmp", "wb") as f:
+            for r in registros:
+                offsets.append(f.tell())
+                f.write((json.dumps(r, ensure_ascii=False) + "\n").encode("utf-8"))
+        with open(indice + ".tmp", "wb") as f:
+            f.write(b"".join(OFFSET.pack(o) for o in offsets))
+        os.replace(datos + ".tmp", datos)
+        os.replace(indice + ".tmp", indice)
+
+    def reemplazar(self, nombre_persona, turnos, conservar_desde=None):
+        """
+        Sustituye el historial por la lista de pares (usuario, asistente).
+        Si se indica `conservar_desde`, los turnos a partir de esa posición (añadidos
+        mientras se generaba, por ejemplo, un resumen) se mantienen al final.
+        """
+        with self._lock(nombre_persona):
+            resto = self.ultimos(nombre_persona)[conservar_desde:] if conservar_desde is not None else []
+            self._escribir_todo(nombre_persona, [self._registro(u, a) for u, a in turnos] + resto)
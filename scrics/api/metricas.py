@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Métricas en formato de texto de Prometheus, sin dependencias externas.
+
+Contadores e histogramas con etiquetas que se actualizan al vuelo, y colectores que se
+evalúan en cada scrape para los valores que ya se llevan en otro sitio (cachés, colas,
+tamaño del historial...).
+"""
+
+import math
+import threading
+
+BUCKETS_POR_DEFECTO = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _escapar(valor):
+    return str(valor).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _formatear_etiquetas(etiquetas):
+    if not etiquetas:
+        return ""
+    return "{" + ",".join(f'{k}="{_escapar(v)}"' for k, v in etiquetas.items()) + "}"
+
+
+def _formatear_valor(valor):
+    if valor == math.inf:
+        return "+Inf"
+    return repr(float(valor)) if isinstance(valor, float) else str(valor)
+
+
+class _Metrica:
+    tipo = None
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._valores = {}
+        self._lock = threading.Lock()
+
+    def _clave(self, etiquetas):
+        return tuple(str(etiquetas.get(e, "")) for e in self.etiquetas)
+
+    def _cabecera(self):
+        return [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} {self.tipo}"]
+
+
+class Contador(_Metrica):
+    tipo = "counter"
+
+    def inc(self, valor=1, **etiquetas):
+        clave = self._clave(etiquetas)
+        with self._lock:
+            self._valores[clave] = self._valores.get(clave, 0) + valor
+
+    def exportar(self):
+        lineas = self._cabecera()
+        with self._lock:
+            for clave, valor in self._valores.items():
+                lineas.append(f"{self.nombre}{_formatear_etiquetas(dict(zip(self.etiquetas, clave)))} {_formatear_valor(valor)}")
+        return lineas
+
+
+class Histograma(_Metrica):
+    tipo = "histogram"
+
+    def __init__(self, nombre, ayuda, etiquetas=(), buckets=BUCKETS_POR_DEFECTO):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observar(self, valor, **etiquetas):
+        clave = self._clave(etiquetas)
+        with self._lock:
+            datos = self._valores.get(clave)
+            if datos is None:
+                datos = self._valores[clave] = {"cuentas": [0] * len(self.buckets), "suma": 0.0, "total": 0}
+            for i, limite in enumerate(self.buckets):
+                if valor <= limite:
+                    datos["cuentas"][i] += 1
+                    break
+            datos["suma"] += valor
+            datos["total"] += 1
+
+    def exportar(self):
+        lineas = self._cabecera()
+        with self._lock:
+            for clave, datos in self._valores.items():
+                base = dict(zip(self.etiquetas, clave))
+                acumulado = 0
+                for limite, cuenta in zip(self.buckets, datos["cuentas"]):
+                    acumulado += cuenta
+                    etiquetas = dict(base, le=_formatear_valor(limite) if limite == math.inf else str(limite))
+                    lineas.append(f"{self.nombre}_bucket{_formatear_etiquetas(etiquetas)} {acumulado}")
+                lineas.append(f"{self.nombre}_sum{_formatear_etiquetas(base)} {_formatear_valor(datos['suma'])}")
+                lineas.append(f"{self.nombre}_count{_formatear_etiquetas(base)} {datos['total']}")
+        return lineas
+
+
+class RegistroMetricas:
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self._metricas = []
+        self._colectores = []
+
+    def contador(self, nombre, ayuda, etiquetas=()):
+        metrica = Contador(nombre, ayuda, etiquetas)
+        self._metricas.append(metrica)
+        return metrica
+
+    def histograma(self, nombre, ayuda, etiquetas=(), buckets=BUCKETS_POR_DEFECTO):
+        metrica = Histograma(nombre, ayuda, etiquetas, buckets)
+        self._metricas.append(metrica)
+        return metrica
+
+    def colector(self, funcion):
+        """
+        Registra `funcion()`, que devuelve tuplas (nombre, tipo, ayuda, muestras) con
+        muestras = [(etiquetas_dict, valor), ...]. Se llama en cada exportación.
+        """
+        self._colectores.append(funcion)
+        return funcion
+
+    def exportar(self):
+        lineas = []
+        for metrica in self._metricas:
+            lineas.extend(metrica.exportar())
+        for colector in self._colectores:
+            for nombre, tipo, ayuda, muestras in colector():
+                lineas.append(f"# HELP {nombre} {ayuda}")
+                lineas.append(f"# TYPE {nombre} {tipo}")
+                for etiquetas, valor in muestras:
+                    lineas.append(f"{nombre}{_formatear_etiquetas(etiquetas)} {_formatear_valor(valor)}")
+        return "\n".join(lineas) + "\n"
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Precarga de modelos en Ollama.
+
+Al arrancar se carga cada modelo de la tabla de rutas con una petición vacía y se fija
+su `keep_alive`, así la primera pregunta real no paga la carga del modelo. Un hilo de
+fondo repite la carga cada `intervalo` segundos: si Ollama se ha reiniciado o ha
+descargado el modelo por falta de memoria, vuelve a tenerlo listo antes de que llegue
+un usuario.
+"""
+
+import logging
+import threading
+import time
+from datetime import datetime
+
+from cliente_ollama import OllamaError
+
+logger = logging.getLogger(__name__)
+
+UMBRAL_CARGA = 0.1  # segundos de load_duration a partir de los que se considera una carga real
+
+
+class ModelosResidentes:
+    def __init__(self, cliente, modelos, keep_alive=-1, intervalo=300, timeout=120):
+        """`modelos` es {nombre: "chat" | "embeddings"}."""
+        self.cliente = cliente
+        self.modelos = dict(modelos)
+        self.keep_alive = keep_alive
+        self.intervalo = intervalo
+        self.timeout = timeout
+        self._estado = {m: {"tipo": t, "cargas": 0, "carga_s": None, "ultimo": None, "error": None}
+                        for m, t in self.modelos.items()}
+        self._lock = threading.Lock()
+        self._hilo = None
+        for modelo in self.modelos:
+            cliente.fijar_keep_alive(modelo, keep_alive)
+
+    def calentar(self, modelo):
+        """Carga `modelo` (si no lo estaba) y renueva su keep_alive. Devuelve True si responde."""
+        inicio = time.monotonic()
+        try:
+            data = self.cliente.cargar(
+                modelo, keep_alive=self.keep_alive,
+                embeddings=self.modelos[modelo] == "embeddings", timeout=self.timeout
+            )
+        except OllamaError as e:
+            logger.warning(f"⚠️ No se pudo precargar {modelo}: {e}")
+            with self._lock:
+                self._estado[modelo]["error"] = str(e)
+            return False
+
+        carga = (data.get("load_duration") or 0) / 1e9
+        with self._lock:
+            estado = self._estado[modelo]
+            estado["ultimo"] = datetime.now().isoformat(timespec="seconds")
+            estado["error"] = None
+            if carga >= UMBRAL_CARGA:
+                estado["cargas"] += 1
+                estado["carga_s"] = round(carga, 3)
+        if carga >= UMBRAL_CARGA:
+            logger.info(f"🔥 Modelo {modelo} cargado en {carga:.1f}s (total {time.monotonic() - inicio:.1f}s)")
+        return True
+
+    def calentar_todos(self):
+        """Carga todos los modelos en orden. Devuelve {modelo: ok}."""
+        return {modelo: self.calentar(modelo) for modelo in self.modelos}
+
+    def iniciar(self):
+        """Arranca el hilo que mantiene los modelos cargados (una vez por proceso)."""
+        if self._hilo is not None or not self.intervalo:
+            return
+
+        def bucle():
+            while True:
+                time.sleep(self.intervalo)
+                self.calentar_todos()
+
+        self._hilo = threading.Thread(target=bucle, name="modelos-residentes", daemon=True)
+        self._hilo.start()
+
+    def estadisticas(self):
+        with self._lock:
+            return {modelo: dict(estado) for modelo, estado in self._estado.items()}
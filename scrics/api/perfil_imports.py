@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Diagnóstico del tiempo de importación (equivalente a `python -X importtime`).
+
+Ejecuta los imports del módulo indicado en un proceso aparte con `-X importtime` y
+resume qué dependencias directas cuestan más. También dice qué módulos pesados están ya
+cargados en el proceso actual, para comprobar que un worker de solo chat no ha cargado Chroma.
+
+Si el módulo es un fichero de este directorio no se importa: se leen sus `import` de
+nivel superior y solo se ejecutan esos. Importar api_ollama_server de verdad crearía la
+base de datos, los hilos de volcado y el log; la medida no debe tocar el directorio de datos.
+
+Uso desde la línea de comandos:
+    python perfil_imports.py api_ollama_server
+"""
+
+import ast
+import logging
+import os
+import re
+import subprocess
+import sys
+
+logger = logging.getLogger(__name__)
+
+MODULOS_PESADOS = ("langchain_chroma", "chromadb", "langchain_ollama", "langchain_text_splitters", "langchain_core")
+
+_LINEA = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)")
+# Se escribe en stderr antes de los imports medidos, para no contar los del arranque de Python (site...)
+_MARCA = "--- perfil_imports ---"
+
+
+def imports_de_modulo(ruta):
+    """Código con las sentencias import de nivel superior del fichero (también las de un try)."""
+    with open(ruta, encoding="utf-8") as f:
+        arbol = ast.parse(f.read(), ruta)
+    sentencias = []
+    for nodo in arbol.body:
+        if isinstance(nodo, (ast.Import, ast.ImportFrom)):
+            sentencias.append(ast.unparse(nodo))
+        elif isinstance(nodo, ast.Try) and any(isinstance(n, (ast.Import, ast.ImportFrom)) for n in nodo.body):
+            # try: import numpy / except ImportError: ... se copia entero
+            sentencias.append(ast.unparse(nodo))
+    return "\n".join(sentencias)
+
+
+def medir_imports(modulo, directorio=None, timeout=120):
+    """
+    Devuelve [(paquete, propio_us, acumulado_us, profundidad)] en el orden en que
+    Python los reporta (cada paquete después de sus dependencias).
+    """
+    directorio = directorio or os.path.dirname(os.path.abspath(__file__))
+    ruta = os.path.join(directorio, modulo.replace(".", os.sep) + ".py")
+    local = os.path.isfile(ruta)
+    codigo = imports_de_modulo(ruta) if local else f"import {modulo}"
+    codigo = f"import sys; sys.stderr.write({_MARCA!r} + '\\n')\n{codigo}"
+    resultado = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", codigo],
+        cwd=directorio, capture_output=True, text=True, timeout=timeout
+    )
+    medidas = []
+    salida = resultado.stderr.split(_MARCA + "\n", 1)[-1]
+    for linea in salida.splitlines():
+        m = _LINEA.match(linea)
+        if m:
+            propio, acumulado, sangria, nombre = m.groups()
+            # Los imports del módulo salen a profundidad 0: se bajan un nivel, como si los importase él
+            medidas.append((nombre, int(propio), int(acumulado), len(sangria) // 2 + local))
+    if resultado.returncode != 0 and not medidas:
+        raise RuntimeError(f"No se pudo importar {modulo}: {resultado.stderr.strip()[-500:]}")
+    if local:
+        # El módulo no se ha ejecutado: su acumulado es la suma de sus dependencias directas
+        medidas.append((modulo, 0, sum(m[2] for m in medidas if m[3] == 1), 0))
+    return medidas
+
+
+def resumen_imports(modulo, top=15, directorio=None):
+    """Total en segundos y las `top` dependencias directas de `modulo` más caras."""
+    medidas = medir_imports(modulo, directorio)
+    propio = next((m for m in reversed(medidas) if m[0] == modulo), None)
+    directas = [m for m in medidas if m[3] == 1]
+    directas.sort(key=lambda m: m[2], reverse=True)
+    return {
+        "modulo": modulo,
+        "total_s": round(propio[2] / 1e6, 3) if propio else None,
+        "dependencias": [{"modulo": n, "acumulado_s": round(a / 1e6, 3)} for n, _, a, _ in directas[:top]],
+    }
+
+
+def modulos_pesados_cargados():
+    return [m for m in MODULOS_PESADOS if m in sys.modules]
+
+
+def registrar_perfil(modulo, top=15):
+    """Escribe en el log el resumen de `resumen_imports`. No falla si no se puede medir."""
+    try:
+        resumen = resumen_imports(modulo, top)
+    except (OSError, RuntimeError, subprocess.TimeoutExpired) as e:
+        logger.warning(f"⚠️ No se pudo medir el tiempo de importación de {modulo}: {e}")
+        return None
+    logger.info(f"⏱️ Importar {modulo}: {resumen['total_s']}s")
+    for dep in resumen["dependencias"]:
+        logger.info(f"   {dep['acumulado_s']:>8.3f}s  {dep['modulo']}")
+    return resumen
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    registrar_perfil(sys.argv[1] if len(sys.argv) > 1 else "api_ollama_server")
@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Almacén de personas en SQLite: contexto, eventos e historial de conversación.
+
+Una sola base de datos en modo WAL (lectores y un escritor a la vez, también entre
+workers) con cuatro tablas:
+- `personas`: nombre, clave en minúsculas (las búsquedas no distinguen mayúsculas),
+  el JSON del contexto sin los eventos y una `version` que aumenta con cada cambio.
+- `eventos`: uno por fila, indexados por persona y fecha, tipo y lugar.
+- `turnos`: el historial, en orden de inserción.
+- `trabajos`: el estado de los trabajos en segundo plano, para que cualquier worker
+  pueda responder a GET /jobs/<id> (ver trabajos.ColaTrabajos).
+
+Para el historial se mantiene la interfaz de HistorialStore (ultimos, numero_turnos,
+anadir, reemplazar), así que quien lo usa no cambia. migrar() importa los
+`contextos/<persona>.json` y los `historial/<persona>_history.*` existentes y los
+renombra a `.migrado`.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+from historial_store import SUFIJO_DATOS, SUFIJO_INDICE, SUFIJO_LEGADO, HistorialStore
+from presupuesto_tokens import estimar_tokens
+
+logger = logging.getLogger(__name__)
+
+ESQUEMA = """
+CREATE TABLE IF NOT EXISTS personas (
+    id INTEGER PRIMARY KEY,
+    nombre TEXT NOT NULL,
+    clave TEXT NOT NULL UNIQUE,
+    datos TEXT NOT NULL DEFAULT '{}',
+    version INTEGER NOT NULL DEFAULT 0,
+    actualizado TEXT
+);
+CREATE TABLE IF NOT EXISTS eventos (
+    id INTEGER PRIMARY KEY,
+    persona_id INTEGER NOT NULL REFERENCES personas(id) ON DELETE CASCADE,
+    tipo TEXT NOT NULL DEFAULT '',
+    nombre TEXT NOT NULL DEFAULT '',
+    lugar TEXT NOT NULL DEFAULT '',
+    fecha TEXT NOT NULL DEFAULT '',
+    fecha_iso TEXT,
+    notas TEXT NOT NULL DEFAULT '',
+    creado TEXT
+);
+CREATE INDEX IF NOT EXISTS eventos_persona_fecha ON eventos(persona_id, fecha_iso);
+CREATE INDEX IF NOT EXISTS eventos_tipo ON eventos(tipo COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS eventos_lugar ON eventos(lugar COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS turnos (
+    id INTEGER PRIMARY KEY,
+    persona_id INTEGER NOT NULL REFERENCES personas(id) ON DELETE CASCADE,
+    ts TEXT NOT NULL,
+    usuario TEXT NOT NULL,
+    asistente TEXT NOT NULL,
+    tokens_usuario INTEGER,
+    tokens_asistente INTEGER
+);
+CREATE INDEX IF NOT EXISTS turnos_persona ON turnos(persona_id, id);
+CREATE TABLE IF NOT EXISTS trabajos (
+    id TEXT PRIMARY KEY,
+    tipo TEXT NOT NULL,
+    estado TEXT NOT NULL,
+    creado REAL NOT NULL,
+    iniciado REAL,
+    terminado REAL,
+    resultado TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS trabajos_creado ON trabajos(creado);
+"""
+
+CAMPOS_TRABAJO = ("tipo", "estado", "creado", "iniciado", "terminado", "resultado", "error")
+
+CAMPOS_EVENTO = ("tipo", "nombre", "lugar", "fecha", "notas")
+FORMATOS_FECHA = ("%Y/%m/%d", "%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y")
+
+
+def fecha_iso(texto):
+    """Fecha de un evento en AAAA-MM-DD (para ordenar y filtrar), o None si no se entiende."""
+    for formato in FORMATOS_FECHA:
+        try:
+            return datetime.strptime(str(texto).strip(), formato).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    return None
+
+
+def _ahora():
+    return datetime.now().isoformat(timespec="seconds")
+
+
+class PersonaStore:
+    def __init__(self, ruta, timeout=10):
+        self.ruta = ruta
+        self.timeout = timeout
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(ruta) or ".", exist_ok=True)
+        # Conexión aparte para crear el esquema: así no queda ninguna abierta antes de un fork
+        conn = sqlite3.connect(ruta, timeout=timeout)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(ESQUEMA)
+        finally:
+            conn.close()
+
+    # -----------------------------
+    # Conexiones y transacciones
+    # -----------------------------
+    def _conexion(self):
+        """Una conexión por hilo; las de sqlite3 no se comparten entre hilos."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.ruta, timeout=self.timeout, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _escritura(self):
+        """Transacción de escritura; BEGIN IMMEDIATE toma el bloqueo al empezar, no al primer UPDATE."""
+        conn = self._conexion()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    @staticmethod
+    def _id(conn, nombre, crear=False):
+        fila = conn.execute("SELECT id FROM personas WHERE clave = ?", (nombre.lower(),)).fetchone()
+        if fila:
+            return fila["id"]
+        if not crear:
+            return None
+        return conn.execute(
+            "INSERT INTO personas (nombre, clave, actualizado) VALUES (?, ?, ?)",
+            (nombre, nombre.lower(), _ahora())
+        ).lastrowid
+
+    @staticmethod
+    def _tocar(conn, persona_id):
+        conn.execute("UPDATE personas SET version = version + 1, actualizado = ? WHERE id = ?", (_ahora(), persona_id))
+
+    # -----------------------------
+    # Personas y contexto
+    # -----------------------------
+    def existe(self, nombre):
+        return self._id(self._conexion(), nombre) is not None
+
+    def nombre_canonico(self, nombre):
+        """Nombre con el que se dio de alta la persona (sin distinguir mayúsculas), o None."""
+        fila = self._conexion().execute("SELECT nombre FROM personas WHERE clave = ?", (nombre.lower(),)).fetchone()
+        return fila["nombre"] if fila else None
+
+    def version(self, nombre):
+        """Versión del contexto de la persona, o None si no tiene contexto (ni datos ni eventos)."""
+        fila = self._conexion().execute(
+            "SELECT version, datos != '{}' OR EXISTS (SELECT 1 FROM eventos WHERE persona_id = personas.id) AS con_contexto "
+            "FROM personas WHERE clave = ?", (nombre.lower(),)
+        ).fetchone()
+        return fila["version"] if fila and fila["con_contexto"] else None
+
+    def contexto(self, nombre):
+        """Devuelve el contexto como el antiguo JSON ({..., "eventos": [...]}) o None."""
+        conn = self._conexion()
+        fila = conn.execute("SELECT id, datos FROM personas WHERE clave = ?", (nombre.lower(),)).fetchone()
+        if fila is None:
+            return None
+        datos = json.loads(fila["datos"])
+        eventos = self.eventos(nombre, _persona_id=fila["id"])
+        if not datos and not eventos:
+            return None
+        datos["eventos"] = [{k: e[k] for k in CAMPOS_EVENTO} for e in eventos]
+        return datos
+
+    def datos(self, nombre):
+        """Datos del contexto sin los eventos (nombre, relación, personalidad...), o None."""
+        fila = self._conexion().execute("SELECT datos FROM personas WHERE clave = ?", (nombre.lower(),)).fetchone()
+        return json.loads(fila["datos"]) if fila else None
+
+    def guardar_contexto(self, nombre, datos):
+        """Sustituye el contexto completo de la persona, eventos incluidos."""
+        datos = dict(datos)
+        eventos = datos.pop("eventos", None) or []
+        with self._escritura() as conn:
+            persona_id = self._id(conn, nombre, crear=True)
+            conn.execute("UPDATE personas SET datos = ? WHERE id = ?", (json.dumps(datos, ensure_ascii=False), persona_id))
+            conn.execute("DELETE FROM eventos WHERE persona_id = ?", (persona_id,))
+            for evento in eventos:
+                self._insertar_evento(conn, persona_id, evento)
+            self._tocar(conn, persona_id)
+
+    # -----------------------------
+    # Eventos
+    # -----------------------------
+    @staticmethod
+    def _insertar_evento(conn, persona_id, evento):
+        valores = {k: str(evento.get(k) or "") for k in CAMPOS_EVENTO}
+        return conn.execute(
+            "INSERT INTO eventos (persona_id, tipo, nombre, lugar, fecha, fecha_iso, notas, creado) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (persona_id, valores["tipo"], valores["nombre"], valores["lugar"], valores["fecha"],
+             fecha_iso(valores["fecha"]), valores["notas"], _ahora())
+        ).lastrowid
+
+    def anadir_evento(self, nombre, evento):
+        """Añade un evento a la persona (la crea si no existe). Devuelve su id."""
+        with self._escritura() as conn:
+            persona_id = self._id(conn, nombre, crear=True)
+            evento_id = self._insertar_evento(conn, persona_id, evento)
+            self._tocar(conn, persona_id)
+        return evento_id
+
+    def eventos(self, nombre, desde=None, hasta=None, tipo=None, lugar=None, _persona_id=None):
+        """
+        Eventos de la persona en orden de alta. `desde`/`hasta` (AAAA-MM-DD) filtran por
+        fecha y dejan fuera los eventos sin fecha; `tipo` y `lugar` no distinguen mayúsculas.
+        """
+        conn = self._conexion()
+        persona_id = _persona_id if _persona_id is not None else self._id(conn, nombre)
+        if persona_id is None:
+            return []
+        condiciones, parametros = ["persona_id = ?"], [persona_id]
+        if desde:
+            condiciones.append("fecha_iso >= ?")
+            parametros.append(desde)
+        if hasta:
+            condiciones.append("fecha_iso <= ?")
+            parametros.append(hasta)
+        if tipo:
+            condiciones.append("tipo = ? COLLATE NOCASE")
+            parametros.append(tipo)
+        if lugar:
+            condiciones.append("lugar = ? COLLATE NOCASE")
+            parametros.append(lugar)
+        filas = conn.execute(
+            f"SELECT id, tipo, nombre, lugar, fecha, fecha_iso, notas FROM eventos "
+            f"WHERE {' AND '.join(condiciones)} ORDER BY id", parametros
+        ).fetchall()
+        return [dict(f) for f in filas]
+
+    # -----------------------------
+    # Historial (misma interfaz que HistorialStore)
+    # -----------------------------
+    @staticmethod
+    def _registro(usuario, asistente, tokens_usuario=None, tokens_asistente=None, ts=None):
+        return {
+            "ts": ts or _ahora(),
+            "usuario": usuario,
+            "asistente": asistente,
+            "tokens_usuario": tokens_usuario if tokens_usuario is not None else estimar_tokens(usuario),
+            "tokens_asistente": tokens_asistente if tokens_asistente is not None else estimar_tokens(asistente),
+        }
+
+    @staticmethod
+    def _insertar_turno(conn, persona_id, registro):
+        conn.execute(
+            "INSERT INTO turnos (persona_id, ts, usuario, asistente, tokens_usuario, tokens_asistente) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (persona_id, registro["ts"], registro["usuario"], registro["asistente"],
+             registro["tokens_usuario"], registro["tokens_asistente"])
+        )
+
+    def ultimos(self, nombre, n=None):
+        """Devuelve los últimos n turnos (todos si n es None) en orden cronológico."""
+        conn = self._conexion()
+        persona_id = self._id(conn, nombre)
+        if persona_id is None:
+            return []
+        consulta = ("SELECT ts, usuario, asistente, tokens_usuario, tokens_asistente FROM turnos "
+                    "WHERE persona_id = ? ORDER BY id DESC")
+        if n is not None:
+            filas = conn.execute(consulta + " LIMIT ?", (persona_id, n)).fetchall()
+        else:
+            filas = conn.execute(consulta, (persona_id,)).fetchall()
+        return [dict(f) for f in reversed(filas)]
+
+    def numero_turnos(self, nombre):
+        fila = self._conexion().execute(
+            "SELECT COUNT(*) FROM turnos JOIN personas ON personas.id = turnos.persona_id WHERE personas.clave = ?",
+            (nombre.lower(),)
+        ).fetchone()
+        return fila[0]
+
+    def anadir(self, nombre, usuario, asistente, tokens_usuario=None, tokens_asistente=None):
+        registro = self._registro(usuario, asistente, tokens_usuario, tokens_asistente)
+        with self._escritura() as conn:
+            self._insertar_turno(conn, self._id(conn, nombre, crear=True), registro)
+        return registro
+
+    def reemplazar(self, nombre, turnos, conservar_desde=None):
+        """
+        Sustituye el historial por la lista de pares (usuario, asistente).
+        Si se indica `conservar_desde`, los turnos a partir de esa posición (añadidos
+        mientras se generaba, por ejemplo, un resumen) se mantienen al final.
+        """
+        with self._escritura() as conn:
+            persona_id = self._id(conn, nombre, crear=True)
+            resto = []
+            if conservar_desde is not None:
+                resto = [dict(f) for f in conn.execute(
+                    "SELECT ts, usuario, asistente, tokens_usuario, tokens_asistente FROM turnos "
+                    "WHERE persona_id = ? ORDER BY id LIMIT -1 OFFSET ?", (persona_id, conservar_desde)
+                ).fetchall()]
+            conn.execute("DELETE FROM turnos WHERE persona_id = ?", (persona_id,))
+            for registro in [self._registro(u, a) for u, a in turnos] + resto:
+                self._insertar_turno(conn, persona_id, registro)
+
+    def resumen_historial(self):
+        """[(nombre, turnos, bytes)] de cada persona con historial, en una sola consulta."""
+        filas = self._conexion().execute(
+            "SELECT personas.nombre, COUNT(*) AS turnos, "
+            "SUM(LENGTH(CAST(usuario AS BLOB)) + LENGTH(CAST(asistente AS BLOB))) AS bytes "
+            "FROM turnos JOIN personas ON personas.id = turnos.persona_id GROUP BY personas.id"
+        ).fetchall()
+        return [(f["nombre"], f["turnos"], f["bytes"]) for f in filas]
+
+    # -----------------------------
+    # Trabajos en segundo plano
+    # -----------------------------
+    def guardar_trabajo(self, trabajo, max_historico=None):
+        """
+        Inserta o actualiza el trabajo (dict con "id" y CAMPOS_TRABAJO). Con `max_historico`
+        se borran los terminados más antiguos que sobren.
+        """
+        fila = {campo: trabajo.get(campo) for campo in CAMPOS_TRABAJO}
+        fila["resultado"] = json.dumps(fila["resultado"], ensure_ascii=False, default=str)
+        with self._escritura() as conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO trabajos (id, {', '.join(CAMPOS_TRABAJO)}) "
+                f"VALUES (?, {', '.join('?' * len(CAMPOS_TRABAJO))})",
+                (trabajo["id"], *fila.values())
+            )
+            if max_historico is not None:
+                conn.execute(
+                    "DELETE FROM trabajos WHERE id IN (SELECT id FROM trabajos WHERE terminado IS NOT NULL "
+                    "ORDER BY creado LIMIT max(0, (SELECT COUNT(*) FROM trabajos) - ?))", (max_historico,)
+                )
+
+    def trabajo(self, id_trabajo):
+        fila = self._conexion().execute("SELECT * FROM trabajos WHERE id = ?", (id_trabajo,)).fetchone()
+        if fila is None:
+            return None
+        trabajo = dict(fila)
+        trabajo["resultado"] = json.loads(trabajo["resultado"]) if trabajo["resultado"] is not None else None
+        return trabajo
+
+    # -----------------------------
+    # Migración desde ficheros
+    # -----------------------------
+    def importar_contexto(self, archivo, nombre=None):
+        """
+        Importa `contextos/<persona>.json` y lo renombra a `.migrado`. Devuelve False si
+        otro proceso se ha adelantado (el fichero ya no está).
+        """
+        nombre = nombre or os.path.basename(archivo)[:-len(".json")]
+        with self._escritura() as conn:
+            # Dentro de la transacción: entre varios workers solo uno lo importa
+            if not os.path.exists(archivo):
+                return False
+            with open(archivo, "r", encoding="utf-8") as f:
+                datos = json.load(f)
+            eventos = datos.pop("eventos", None)
+            persona_id = self._id(conn, nombre, crear=True)
+            # El JSON es el contexto completo: sustituye al que hubiera
+            conn.execute("UPDATE personas SET datos = ? WHERE id = ?", (json.dumps(datos, ensure_ascii=False), persona_id))
+            conn.execute("DELETE FROM eventos WHERE persona_id = ?", (persona_id,))
+            for evento in eventos if isinstance(eventos, list) else []:
+                self._insertar_evento(conn, persona_id, evento)
+            self._tocar(conn, persona_id)
+            os.replace(archivo, archivo + ".migrado")
+        logger.info(f"🔁 Contexto de {nombre} migrado a SQLite ({len(eventos or [])} eventos)")
+        return True
+
+    def importar_historial(self, directorio, nombre):
+        """Importa `<persona>_history.jsonl` (o el `.txt` antiguo) y lo renombra a `.migrado`."""
+        datos = os.path.join(directorio, nombre + SUFIJO_DATOS)
+        legado = os.path.join(directorio, nombre + SUFIJO_LEGADO)
+        with self._escritura() as conn:
+            if not os.path.exists(datos) and not os.path.exists(legado):
+                return False
+            # HistorialStore sabe leer los dos formatos (y migra el de texto a JSONL)
+            registros = HistorialStore(directorio).ultimos(nombre)
+            persona_id = self._id(conn, nombre, crear=True)
+            for r in registros:
+                self._insertar_turno(conn, persona_id, self._registro(
+                    r.get("usuario", ""), r.get("asistente", ""),
+                    r.get("tokens_usuario"), r.get("tokens_asistente"), r.get("ts")
+                ))
+            os.replace(datos, datos + ".migrado")
+            indice = os.path.join(directorio, nombre + SUFIJO_INDICE)
+            if os.path.exists(indice):
+                os.remove(indice)
+        logger.info(f"🔁 Historial de {nombre} migrado a SQLite ({len(registros)} turnos)")
+        return True
+
+    def migrar(self, contextos_dir, historial_dir):
+        """Importa todos los ficheros pendientes. Devuelve cuántos contextos e historiales se han migrado."""
+        migrados = {"contextos": 0, "historiales": 0}
+        if os.path.isdir(contextos_dir):
+            for fichero in sorted(os.listdir(contextos_dir)):
+                if fichero.endswith(".json"):
+                    try:
+                        migrados["contextos"] += self.importar_contexto(os.path.join(contextos_dir, fichero))
+                    except (OSError, ValueError) as e:
+                        logger.error(f"❌ No se pudo migrar el contexto {fichero}: {e}")
+        if os.path.isdir(historial_dir):
+            nombres = set()
+            for fichero in os.listdir(historial_dir):
+                for sufijo in (SUFIJO_DATOS, SUFIJO_LEGADO):
+                    if fichero.endswith(sufijo):
+                        nombres.add(fichero[:-len(sufijo)])
+            for nombre in sorted(nombres):
+                try:
+                    migrados["historiales"] += self.importar_historial(historial_dir, nombre)
+                except (OSError, ValueError) as e:
+                    logger.error(f"❌ No se pudo migrar el historial de {nombre}: {e}")
+        return migrados
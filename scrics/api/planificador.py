@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Control de admisión para las generaciones contra Ollama.
+
+Cada modelo admite como mucho `max_en_vuelo` generaciones a la vez. El resto espera en
+una cola por clase (chat, extracción, resumen); cuando queda un hueco libre pasa el
+primero de la clase de mayor prioridad. Las colas están acotadas: si la cola de una
+clase está llena, o se agota su espera máxima, se lanza Saturado con una estimación de
+cuándo reintentar (para responder HTTP 429 con Retry-After).
+"""
+
+import logging
+import math
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+CLASES_POR_DEFECTO = {
+    "chat": {"prioridad": 0, "max_cola": 16, "espera_max": 30},
+    "extraccion": {"prioridad": 1, "max_cola": 32, "espera_max": 60},
+    "resumen": {"prioridad": 2, "max_cola": 8, "espera_max": None},
+}
+
+
+class Saturado(Exception):
+    """No hay hueco para la generación: cola llena o espera agotada."""
+
+    def __init__(self, clase, modelo, retry_after):
+        super().__init__(f"Cola '{clase}' de {modelo} saturada, reintentar en {retry_after}s")
+        self.clase = clase
+        self.modelo = modelo
+        self.retry_after = retry_after
+
+
+class Turno:
+    """Hueco concedido para una generación. Se libera al salir del `with` o con liberar()."""
+
+    def __init__(self, planificador, modelo, clase, espera):
+        self.planificador = planificador
+        self.modelo = modelo
+        self.clase = clase
+        self.espera = espera
+        self._inicio = time.monotonic()
+        self._liberado = False
+
+    def liberar(self):
+        if not self._liberado:
+            self._liberado = True
+            self.planificador._liberar(self.modelo, time.monotonic() - self._inicio)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.liberar()
+        return False
+
+
+class _EstadoModelo:
+    def __init__(self, clases, limite):
+        self.limite = limite
+        self.en_vuelo = 0
+        self.colas = {clase: deque() for clase in clases}
+        self.servicio_medio = 5.0  # segundos por generación (media móvil)
+
+
+class Planificador:
+    def __init__(self, max_en_vuelo=1, clases=None, max_por_modelo=None):
+        self.max_en_vuelo = max_en_vuelo
+        self.max_por_modelo = max_por_modelo or {}
+        self.clases = clases or CLASES_POR_DEFECTO
+        self._orden = sorted(self.clases, key=lambda c: self.clases[c]["prioridad"])
+        self._modelos = {}
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._stats = {c: {"admitidas": 0, "rechazadas": 0, "espera_total": 0.0, "espera_max": 0.0} for c in self.clases}
+
+    def _modelo(self, modelo):
+        estado = self._modelos.get(modelo)
+        if estado is None:
+            estado = _EstadoModelo(self.clases, self.max_por_modelo.get(modelo, self.max_en_vuelo))
+            self._modelos[modelo] = estado
+        return estado
+
+    def _siguiente(self, estado):
+        for clase in self._orden:
+            if estado.colas[clase]:
+                return estado.colas[clase][0]
+        return None
+
+    def _retry_after(self, estado):
+        en_espera = sum(len(c) for c in estado.colas.values())
+        return max(1, math.ceil(estado.servicio_medio * (en_espera + 1) / estado.limite))
+
+    def admitir(self, clase, modelo, rechazar=True):
+        """
+        Espera un hueco para generar con `modelo` y devuelve el Turno. Con `rechazar`
+        (peticiones HTTP) se lanza Saturado si la cola está llena o se agota la espera;
+        sin él (trabajos de fondo) se espera lo que haga falta.
+        """
+        config = self.clases[clase]
+        inicio = time.monotonic()
+        espera_max = config.get("espera_max") if rechazar else None
+        limite_espera = inicio + espera_max if espera_max else None
+        with self._cond:
+            estado = self._modelo(modelo)
+            cola = estado.colas[clase]
+            if rechazar and len(cola) >= config["max_cola"]:
+                self._stats[clase]["rechazadas"] += 1
+                raise Saturado(clase, modelo, self._retry_after(estado))
+            ticket = object()
+            cola.append(ticket)
+            while estado.en_vuelo >= estado.limite or self._siguiente(estado) is not ticket:
+                restante = limite_espera - time.monotonic() if limite_espera else None
+                if restante is not None and restante <= 0:
+                    cola.remove(ticket)
+                    self._stats[clase]["rechazadas"] += 1
+                    self._cond.notify_all()
+                    raise Saturado(clase, modelo, self._retry_after(estado))
+                self._cond.wait(restante)
+            cola.popleft()
+            estado.en_vuelo += 1
+            espera = time.monotonic() - inicio
+            stats = self._stats[clase]
+            stats["admitidas"] += 1
+            stats["espera_total"] += espera
+            stats["espera_max"] = max(stats["espera_max"], espera)
+            # Puede quedar otro hueco libre para el siguiente de la cola
+            self._cond.notify_all()
+        if espera > 1:
+            logger.info(f"⏳ Generación '{clase}' con {modelo} admitida tras {espera:.1f}s en cola")
+        return Turno(self, modelo, clase, espera)
+
+    def _liberar(self, modelo, duracion):
+        with self._cond:
+            estado = self._modelo(modelo)
+            estado.en_vuelo -= 1
+            estado.servicio_medio = 0.8 * estado.servicio_medio + 0.2 * duracion
+            self._cond.notify_all()
+
+    def estadisticas(self):
+        with self._lock:
+            clases = {}
+            for clase, s in self._stats.items():
+                clases[clase] = {
+                    "admitidas": s["admitidas"],
+                    "rechazadas": s["rechazadas"],
+                    "en_cola": sum(len(e.colas[clase]) for e in self._modelos.values()),
+                    "espera_media_s": round(s["espera_total"] / s["admitidas"], 3) if s["admitidas"] else 0.0,
+                    "espera_max_s": round(s["espera_max"], 3),
+                }
+            modelos = {
+                nombre: {"en_vuelo": e.en_vuelo, "limite": e.limite, "servicio_medio_s": round(e.servicio_medio, 3)}
+                for nombre, e in self._modelos.items()
+            }
+            return {"clases": clases, "modelos": modelos}
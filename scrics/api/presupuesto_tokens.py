@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Presupuesto de tokens para los mensajes que se envían a Ollama.
+
+No cargamos el tokenizer real del modelo: se aproxima contando palabras y signos
+(las palabras largas cuentan como varios tokens) y se cachea por texto, porque el
+system prompt y el historial se repiten en cada pregunta.
+"""
+
+import math
+import re
+from functools import lru_cache
+
+# Tokens de contexto que usamos por modelo (num_ctx) y los que se reservan para la respuesta
+CONTEXTO_MODELOS = {
+    "llama3.2:1b": 4096,
+    "llama3.1:8b": 8192,
+}
+CONTEXTO_POR_DEFECTO = 4096
+RESERVA_RESPUESTA = 512
+TOKENS_POR_MENSAJE = 4  # cabeceras de rol que añade la plantilla de chat
+
+_PALABRAS = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+
+@lru_cache(maxsize=8192)
+def estimar_tokens(texto):
+    """Número aproximado de tokens de un texto."""
+    if not texto:
+        return 0
+    total = 0
+    for pieza in _PALABRAS.findall(texto):
+        total += max(1, math.ceil(len(pieza) / 4))
+    return total
+
+
+def tokens_mensaje(mensaje):
+    return estimar_tokens(mensaje["content"]) + TOKENS_POR_MENSAJE
+
+
+def presupuesto_modelo(modelo):
+    """Tokens disponibles para el prompt una vez reservado el hueco de la respuesta."""
+    return CONTEXTO_MODELOS.get(modelo, CONTEXTO_POR_DEFECTO) - RESERVA_RESPUESTA
+
+
+def opciones_modelo(modelo):
+    """Opciones de Ollama para que el contexto del modelo coincida con el presupuesto."""
+    return {"num_ctx": CONTEXTO_MODELOS.get(modelo, CONTEXTO_POR_DEFECTO)}
+
+
+def empaquetar_fragmentos(fragmentos, presupuesto, coste=estimar_tokens, minimo=1):
+    """
+    Elige, en el orden recibido (de más a menos relevante), los fragmentos que caben en
+    `presupuesto` tokens. Un fragmento que no cabe se salta y se prueba con el siguiente.
+    `coste(fragmento)` da sus tokens (por defecto se estiman sobre el texto); se deja de
+    buscar cuando quedan menos de `minimo` tokens libres.
+    Devuelve (fragmentos_elegidos, tokens_usados).
+    """
+    elegidos = []
+    usados = 0
+    for fragmento in fragmentos:
+        tokens = coste(fragmento)
+        if usados + tokens <= presupuesto:
+            elegidos.append(fragmento)
+            usados += tokens
+            if presupuesto - usados < minimo:
+                break
+    return elegidos, usados
+
+
+def recortar_historial(contexto, historial, pregunta, modelo):
+    """
+    Se queda con los turnos más recientes del historial que caben en el presupuesto del
+    modelo, después de reservar el system prompt, la pregunta y la respuesta.
+    Los turnos (user + assistant) se descartan enteros, de más antiguo a más nuevo.
+
+    Devuelve (historial_recortado, info) donde info resume lo que se ha descartado.
+    """
+    presupuesto = presupuesto_modelo(modelo)
+    fijos = TOKENS_POR_MENSAJE + estimar_tokens(str(pregunta))
+    if contexto:
+        fijos += TOKENS_POR_MENSAJE + estimar_tokens(str(contexto))
+    disponible = presupuesto - fijos
+
+    # Agrupar en turnos para no separar una pregunta de su respuesta
+    turnos = []
+    for mensaje in historial:
+        if mensaje["role"] == "user" or not turnos:
+            turnos.append([mensaje])
+        else:
+            turnos[-1].append(mensaje)
+
+    conservados = []
+    usados = 0
+    for turno in reversed(turnos):
+        coste = sum(tokens_mensaje(m) for m in turno)
+        if usados + coste > disponible:
+            break
+        conservados.append(turno)
+        usados += coste
+    conservados.reverse()
+
+    descartados = len(turnos) - len(conservados)
+    info = {
+        "modelo": modelo,
+        "presupuesto_tokens": presupuesto,
+        "tokens_estimados": fijos + usados,
+        "turnos_enviados": len(conservados),
+        "turnos_descartados": descartados,
+    }
+    return [m for turno in conservados for m in turno], info
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Acceso compartido al vector store Chroma del diario.
+
+El vector store y los embeddings se crean una sola vez por proceso (la primera vez
+que se usan) y se reutilizan en todas las peticiones. Las escrituras se acumulan en
+un buffer y se vuelcan por lotes cada pocos segundos, al llenarse el lote o al parar
+el servidor.
+
+langchain y Chroma se importan la primera vez que se necesitan: un proceso que solo
+atiende el chat no llega a cargarlos.
+
+buscar() consulta el mismo vector store ya abierto (las entradas aún en el buffer no
+aparecen hasta el siguiente volcado). `version` aumenta con cada volcado, para que
+quien cachee búsquedas sepa cuándo han quedado viejas. Con `ruta_escritor` la versión
+se guarda en `ruta_escritor + ".version"`: así la ven todos los workers, no solo el que
+escribe, y no vuelve a empezar de cero al reiniciar.
+
+Chroma no admite varios procesos escribiendo a la vez. Con `ruta_escritor` (varios
+workers de gunicorn) solo escribe el proceso que tiene el flock de `ruta_escritor`;
+los demás dejan sus documentos en `ruta_escritor + ".pendientes.jsonl"` y el escritor
+los recoge en su siguiente volcado. Si el escritor muere, otro proceso toma el bloqueo.
+"""
+
+import atexit
+import json
+import logging
+import os
+import threading
+import traceback
+
+from bloqueo_ficheros import BloqueoFichero, tomar_bloqueo_sin_espera
+
+logger = logging.getLogger(__name__)
+
+
+class DiarioVectorial:
+    def __init__(self, persist_directory, embed_model="nomic-embed-text", intervalo_flush=5, max_lote=64,
+                 separador="\n---\n", chunk_size=4000, ruta_escritor=None):
+        self.persist_directory = persist_directory
+        self.embed_model = embed_model
+        self.separador = separador
+        self.chunk_size = chunk_size
+        self._splitter = None
+        self._version = 0
+        self.intervalo_flush = intervalo_flush
+        self.max_lote = max_lote
+        self._vectorstore = None
+        self._init_lock = threading.Lock()
+        self._pendientes = []
+        self._pendientes_lock = threading.Lock()
+        self._escritura_lock = threading.Lock()
+        self._hay_pendientes = threading.Event()
+        self._hilo = None
+        # Escritor único entre procesos; sin ruta_escritor este proceso escribe siempre
+        self.ruta_escritor = ruta_escritor
+        self._fd_escritor = None
+        self._cola_procesos = ruta_escritor + ".pendientes.jsonl" if ruta_escritor else None
+        self._bloqueo_cola = BloqueoFichero(self._cola_procesos + ".lock") if ruta_escritor else None
+        self._ruta_version = ruta_escritor + ".version" if ruta_escritor else None
+
+    # -----------------------------
+    # Versión de los datos
+    # -----------------------------
+    @property
+    def version(self):
+        """Cambia cada vez que se vuelcan documentos al vector store (en cualquier proceso)."""
+        if self._ruta_version is None:
+            return self._version
+        try:
+            with open(self._ruta_version, encoding="utf-8") as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _subir_version(self):
+        if self._ruta_version is None:
+            self._version += 1
+            return
+        # Solo escribe el escritor; se reemplaza el fichero entero para que nadie lea uno a medias
+        temporal = f"{self._ruta_version}.{os.getpid()}"
+        with open(temporal, "w", encoding="utf-8") as f:
+            f.write(str(self.version + 1))
+        os.replace(temporal, self._ruta_version)
+
+    # -----------------------------
+    # Vector store
+    # -----------------------------
+    @property
+    def vectorstore(self):
+        if self._vectorstore is None:
+            with self._init_lock:
+                if self._vectorstore is None:
+                    logger.info(f"📂 Abriendo vector store Chroma: {self.persist_directory}")
+                    from langchain_chroma import Chroma
+                    from langchain_ollama import OllamaEmbeddings
+                    embeddings = OllamaEmbeddings(model=self.embed_model)
+                    self._vectorstore = Chroma(
+                        embedding_function=embeddings,
+                        persist_directory=self.persist_directory
+                    )
+        return self._vectorstore
+
+    def trocear(self, textos):
+        """Convierte los textos en documentos, partidos por el separador de entradas."""
+        if self._splitter is None:
+            from langchain_text_splitters import CharacterTextSplitter
+            self._splitter = CharacterTextSplitter(
+                separator=self.separador, chunk_size=self.chunk_size, chunk_overlap=0, length_function=len
+            )
+        return self._splitter.create_documents(textos)
+
+    def buscar(self, consulta, k=4):
+        """Devuelve [(texto, distancia)] de los `k` fragmentos más parecidos (menor distancia, más parecido)."""
+        resultados = self.vectorstore.similarity_search_with_score(str(consulta), k=k)
+        return [(doc.page_content, float(distancia)) for doc, distancia in resultados]
+
+    # -----------------------------
+    # Escritor único entre procesos
+    # -----------------------------
+    def es_escritor(self):
+        """True si este proceso puede escribir en Chroma (intenta tomar el bloqueo si no lo tiene)."""
+        if self.ruta_escritor is None or self._fd_escritor is not None:
+            return True
+        with self._init_lock:
+            if self._fd_escritor is None:
+                os.makedirs(os.path.dirname(self.ruta_escritor) or ".", exist_ok=True)
+                self._fd_escritor = tomar_bloqueo_sin_espera(self.ruta_escritor)
+                if self._fd_escritor is not None:
+                    logger.info(f"✍️ Este proceso (pid {os.getpid()}) escribe en ChromaDB")
+        return self._fd_escritor is not None
+
+    def _dejar_para_escritor(self, documentos):
+        lineas = "".join(json.dumps({"texto": d.page_content, "metadata": d.metadata}, ensure_ascii=False) + "\n"
+                         for d in documentos)
+        with self._bloqueo_cola, open(self._cola_procesos, "a", encoding="utf-8") as f:
+            f.write(lineas)
+
+    def _recoger_de_procesos(self):
+        """Documentos que otros procesos han dejado para el escritor (vacía la cola)."""
+        if self._cola_procesos is None:
+            return []
+        with self._bloqueo_cola:
+            try:
+                with open(self._cola_procesos, encoding="utf-8") as f:
+                    lineas = f.read().splitlines()
+            except FileNotFoundError:
+                return []
+            if not lineas:
+                return []
+            open(self._cola_procesos, "w").close()
+        from langchain_core.documents import Document
+        documentos = []
+        for linea in lineas:
+            try:
+                datos = json.loads(linea)
+            except json.JSONDecodeError:
+                logger.warning(f"⚠️ Línea no válida en {self._cola_procesos}, se descarta")
+                continue
+            documentos.append(Document(page_content=datos["texto"], metadata=datos.get("metadata") or {}))
+        return documentos
+
+    # -----------------------------
+    # Escrituras por lotes
+    # -----------------------------
+    def anadir(self, documentos, sincrono=False):
+        """
+        Encola documentos para añadirlos al vector store. Con `sincrono` se vuelcan ya.
+        Devuelve "sincrono" si ya están en Chroma o "pendiente" si se escribirán en el
+        siguiente volcado (de este proceso o del escritor).
+        """
+        self._asegurar_hilo()
+        if not self.es_escritor():
+            self._dejar_para_escritor(documentos)
+            return "pendiente"
+        with self._pendientes_lock:
+            self._pendientes.extend(documentos)
+            lleno = len(self._pendientes) >= self.max_lote
+        if sincrono:
+            self.flush()
+            return "sincrono"
+        if lleno:
+            self._hay_pendientes.set()
+        return "pendiente"
+
+    def pendientes(self):
+        with self._pendientes_lock:
+            return len(self._pendientes)
+
+    def flush(self):
+        """Vuelca al vector store los documentos pendientes. Devuelve cuántos se han escrito."""
+        if not self.es_escritor():
+            return 0
+        with self._escritura_lock:
+            with self._pendientes_lock:
+                lote, self._pendientes = self._pendientes, []
+            lote = self._recoger_de_procesos() + lote
+            if not lote:
+                return 0
+            try:
+                vectorstore = self.vectorstore
+                vectorstore.add_documents(lote)
+                if hasattr(vectorstore, "persist"):
+                    vectorstore.persist()
+            except Exception:
+                # Se devuelven al buffer para reintentar en el siguiente volcado
+                with self._pendientes_lock:
+                    self._pendientes = lote + self._pendientes
+                raise
+            self._subir_version()
+            logger.info(f"✅ {len(lote)} entradas volcadas al vector store ChromaDB")
+            return len(lote)
+
+    def _asegurar_hilo(self):
+        if self._hilo is not None:
+            return
+        with self._init_lock:
+            if self._hilo is not None:
+                return
+            self._hilo = threading.Thread(target=self._bucle, name="chroma-flush", daemon=True)
+            self._hilo.start()
+            atexit.register(self._flush_final)
+
+    def _bucle(self):
+        while True:
+            self._hay_pendientes.wait(self.intervalo_flush)
+            self._hay_pendientes.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"❌ Error volcando entradas a ChromaDB: {e}")
+                logger.error(f"   Traceback: {traceback.format_exc()}")
+
+    def _flush_final(self):
+        try:
+            escritos = self.flush()
+            if escritos:
+                logger.info(f"💾 Volcado final de {escritos} entradas a ChromaDB")
+        except Exception as e:
+            logger.error(f"❌ Error en el volcado final a ChromaDB: {e}")
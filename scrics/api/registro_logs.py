@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Logging asíncrono para el servidor.
+
+Los hilos de las peticiones solo dejan el registro en una cola (QueueHandler); un hilo
+de fondo (QueueListener) lo escribe en el fichero y en consola, así la E/S de disco no
+queda en el camino de cada petición.
+
+La rotación por tamaño (RotatingFileHandler) solo es segura con un proceso: con varios
+workers cada uno renombraría el fichero por su cuenta y se perderían líneas. Con
+`rotar=False` se usa WatchedFileHandler, que solo añade y reabre el fichero si otro
+(logrotate) lo ha rotado.
+
+Las líneas con cargas grandes (prompts, mensajes, respuestas de Ollama) se marcan con
+`extra=CARGA` y se pasan los datos como argumentos (`logger.debug("... %s", datos,
+extra=CARGA)`). Esas líneas se muestrean y se truncan o redactan antes de formatearlas,
+de modo que, si se descartan, el coste de convertir el payload a texto no se paga.
+"""
+
+import atexit
+import logging
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, WatchedFileHandler
+
+FORMATO = '%(asctime)s - %(levelname)s - %(message)s'
+
+NIVELES_POR_ENTORNO = {
+    "desarrollo": logging.DEBUG,
+    "pruebas": logging.INFO,
+    "produccion": logging.INFO,
+}
+
+# Por entorno: fracción de líneas de carga que se escriben y qué se hace con el payload
+CARGAS_POR_ENTORNO = {
+    "desarrollo": {"muestreo": 1.0, "max_caracteres": 4000, "redactar": False},
+    "pruebas": {"muestreo": 0.1, "max_caracteres": 1000, "redactar": False},
+    "produccion": {"muestreo": 0.01, "max_caracteres": 200, "redactar": True},
+}
+
+CARGA = {"carga": True}
+
+_listeners = []
+
+
+def _resumir_mensajes(mensajes, max_caracteres, redactar):
+    partes = []
+    for m in mensajes:
+        contenido = str(m.get("content", ""))
+        if redactar:
+            contenido = f"<{len(contenido)} caracteres>"
+        partes.append({"role": m.get("role"), "content": _truncar(contenido, max_caracteres)})
+    return partes
+
+
+def _truncar(texto, max_caracteres):
+    if len(texto) <= max_caracteres:
+        return texto
+    return f"{texto[:max_caracteres]}…[+{len(texto) - max_caracteres} caracteres]"
+
+
+def resumir_carga(valor, max_caracteres=2000, redactar=False):
+    """Versión acotada de un payload para el log: listas de mensajes, dicts o texto."""
+    if isinstance(valor, list) and valor and all(isinstance(m, dict) and "content" in m for m in valor):
+        return _resumir_mensajes(valor, max_caracteres, redactar)
+    texto = valor if isinstance(valor, str) else repr(valor)
+    if redactar:
+        return f"<{len(texto)} caracteres>"
+    return _truncar(texto, max_caracteres)
+
+
+class FiltroCargas(logging.Filter):
+    """Muestrea las líneas marcadas con CARGA y acota sus argumentos."""
+
+    def __init__(self, muestreo=1.0, max_caracteres=2000, redactar=False):
+        super().__init__()
+        self.muestreo = muestreo
+        self.max_caracteres = max_caracteres
+        self.redactar = redactar
+
+    def filter(self, record):
+        if not getattr(record, "carga", False):
+            return True
+        if self.muestreo < 1.0 and random.random() >= self.muestreo:
+            return False
+        if record.args:
+            args = record.args if isinstance(record.args, tuple) else (record.args,)
+            record.args = tuple(resumir_carga(a, self.max_caracteres, self.redactar) for a in args)
+        else:
+            record.msg = resumir_carga(str(record.msg), self.max_caracteres, self.redactar)
+        return True
+
+
+def _escuchar(handlers, filtro=None):
+    """Crea la cola y el hilo que vacía en `handlers`. Devuelve el QueueHandler."""
+    cola = queue.SimpleQueue()
+    handler = QueueHandler(cola)
+    if filtro is not None:
+        handler.addFilter(filtro)
+    listener = QueueListener(cola, *handlers, respect_handler_level=True)
+    listener.start()
+    _listeners.append(listener)
+    return handler
+
+
+def _handler_fichero(fichero, rotar, max_bytes, copias):
+    if rotar:
+        return RotatingFileHandler(fichero, maxBytes=max_bytes, backupCount=copias, encoding="utf-8")
+    return WatchedFileHandler(fichero, encoding="utf-8")
+
+
+def configurar_logging(fichero, entorno="desarrollo", nivel=None, max_bytes=10 * 1024 * 1024, copias=5, rotar=True):
+    """
+    Sustituye los handlers del logger raíz por una cola hacia el fichero y la consola
+    (solo consola si `fichero` es None). `nivel` (nombre o número) manda sobre el nivel
+    del entorno. `rotar` activa la rotación por tamaño: solo con un proceso.
+    """
+    if entorno not in NIVELES_POR_ENTORNO:
+        raise ValueError(f"Entorno de logging desconocido: {entorno}")
+    if nivel is None:
+        nivel = NIVELES_POR_ENTORNO[entorno]
+    elif isinstance(nivel, str):
+        nivel = logging.getLevelName(nivel.upper())
+
+    formato = logging.Formatter(FORMATO)
+    handlers = [logging.StreamHandler()]
+    if fichero:
+        handlers.insert(0, _handler_fichero(fichero, rotar, max_bytes, copias))
+    for h in handlers:
+        h.setFormatter(formato)
+
+    raiz = logging.getLogger()
+    for h in list(raiz.handlers):
+        raiz.removeHandler(h)
+    raiz.addHandler(_escuchar(handlers, FiltroCargas(**CARGAS_POR_ENTORNO[entorno])))
+    raiz.setLevel(nivel)
+    return raiz
+
+
+def logger_a_fichero(nombre, fichero, formato='%(asctime)s - %(message)s', max_bytes=10 * 1024 * 1024, copias=5,
+                     rotar=True):
+    """
+    Logger propio (sin propagar al raíz) que escribe en `fichero` a través de su cola.
+    Sin fichero no escribe nada.
+    """
+    logger = logging.getLogger(nombre)
+    logger.propagate = False
+    if not fichero:
+        logger.addHandler(logging.NullHandler())
+        return logger
+    handler = _handler_fichero(fichero, rotar, max_bytes, copias)
+    handler.setFormatter(logging.Formatter(formato))
+    logger.addHandler(_escuchar([handler]))
+    return logger
+
+
+@atexit.register
+def detener_logging():
+    """Vacía las colas pendientes; se llama sola al salir del proceso."""
+    while _listeners:
+        _listeners.pop().stop()
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Selección de los eventos de una persona que se meten en el system prompt.
+
+Los eventos solo se añaden, así que con el tiempo no caben todos en el prompt. Para
+cada pregunta se puntúa cada evento con tres señales y se meten los mejores hasta
+llenar un presupuesto de tokens:
+
+- fecha: cercanía a la fecha de la que habla la pregunta ("ayer", "el 3 de mayo"...)
+  o, si no nombra ninguna, a hoy.
+- palabras: palabras de la pregunta que aparecen en el evento (tipo, nombre, lugar, notas).
+- embeddings: similitud coseno entre la pregunta y el evento.
+
+El índice de cada persona (líneas ya renderizadas, tokens, fechas, palabras y la matriz
+de embeddings) se calcula una vez por versión del contexto. Al añadir un evento solo se
+calcula el embedding del nuevo; los demás se reutilizan del índice anterior. Si falla el
+cálculo de embeddings, el índice queda sin ellos y se vuelve a intentar pasados
+REINTENTO_EMBEDDINGS segundos aunque no cambie la versión.
+"""
+
+import logging
+import math
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+
+from extractor_local import extraer_fecha, normalizar
+from presupuesto_tokens import empaquetar_fragmentos, estimar_tokens
+
+try:
+    import numpy as np
+except ImportError:  # numpy viene con chromadb, pero el selector funciona sin él
+    np = None
+
+logger = logging.getLogger(__name__)
+
+PESOS = {"fecha": 0.3, "palabras": 0.3, "embeddings": 0.4}
+ESCALA_FECHA_PREGUNTA = 30   # días; a esta distancia de la fecha preguntada la señal vale 1/e
+ESCALA_FECHA_HOY = 365       # días; sin fecha en la pregunta se favorece lo reciente, más suave
+PESO_FECHA_HOY = 0.5         # la cercanía a hoy cuenta menos que una fecha dicha en la pregunta
+REINTENTO_EMBEDDINGS = 60    # segundos; tras un fallo de embeddings se reintenta con la misma versión
+
+PALABRAS_VACIAS = {
+    "que", "con", "por", "para", "los", "las", "del", "una", "uno", "unos", "unas", "como",
+    "cuando", "donde", "quien", "cual", "cuanto", "pero", "sus", "mis", "tus", "nos", "fue",
+    "fuimos", "era", "eso", "esto", "esta", "este", "ese", "esa", "hay", "muy", "mas", "sin",
+    "sobre", "entre", "hasta", "desde", "tambien", "algo", "todo", "nada", "sabes", "dime",
+    "hicimos", "hiciste", "paso", "tal", "hoy", "ayer", "manana", "dia", "dias", "vez",
+}
+
+_PALABRA = re.compile(r"\w+", re.UNICODE)
+
+
+def palabras_clave(texto):
+    """Palabras normalizadas (minúsculas, sin tildes, sin plural en -s) sin las vacías."""
+    palabras = set()
+    for palabra in _PALABRA.findall(normalizar(str(texto))):
+        if len(palabra) < 3 or palabra.isdigit() or palabra in PALABRAS_VACIAS:
+            continue
+        if len(palabra) > 4 and palabra.endswith("s"):
+            palabra = palabra[:-1]
+        palabras.add(palabra)
+    return palabras
+
+
+def renderizar_evento(evento):
+    linea = f"- {evento.get('tipo', '')}: {evento.get('nombre', '')} en {evento.get('lugar', '')} el {evento.get('fecha', '')}"
+    notas = evento.get('notas', '')
+    if notas:
+        linea += f" | Notas: {notas}"
+    return linea
+
+
+def texto_evento(evento):
+    """Texto del evento que se usa para su embedding y sus palabras clave."""
+    return " ".join(str(evento.get(k) or "") for k in ("tipo", "nombre", "lugar", "notas")).strip()
+
+
+def _normalizar_vector(vector):
+    norma = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norma for x in vector]
+
+
+class IndiceEventos:
+    """Datos precalculados de los eventos de una persona para una versión de su contexto."""
+
+    def __init__(self, version, eventos, vectores=None, fallo_embeddings=None):
+        self.version = version
+        # time.monotonic() del fallo si no se pudieron calcular los embeddings
+        self.fallo_embeddings = fallo_embeddings
+        self.ids = [e.get("id") for e in eventos]
+        self.lineas = [renderizar_evento(e) for e in eventos]
+        self.tokens = [estimar_tokens(linea) for linea in self.lineas]
+        self.tokens_total = sum(self.tokens)
+        self.tokens_min = min(self.tokens, default=0)
+        self.dias = [date.fromisoformat(e["fecha_iso"]).toordinal() if e.get("fecha_iso") else None
+                     for e in eventos]
+        # Índice invertido: palabra -> posiciones de los eventos que la contienen
+        self.por_palabra = {}
+        for i, evento in enumerate(eventos):
+            for palabra in palabras_clave(texto_evento(evento)):
+                self.por_palabra.setdefault(palabra, []).append(i)
+        self.dias_np = None
+        if np is not None:
+            self.dias_np = np.array([d if d is not None else np.nan for d in self.dias], dtype=np.float64)
+            self.por_palabra = {p: np.array(posiciones) for p, posiciones in self.por_palabra.items()}
+        # Vectores normalizados por id de evento; None si no hay embeddings. Tras un fallo
+        # pueden faltar los de los eventos nuevos: se guardan para reutilizarlos, sin matriz
+        self.vectores = vectores
+        self.matriz = None
+        if vectores is not None and all(i in vectores for i in self.ids):
+            filas = [vectores[i] for i in self.ids]
+            self.matriz = np.asarray(filas, dtype=np.float32) if np is not None else filas
+
+    def __len__(self):
+        return len(self.lineas)
+
+    def cercania(self, referencia, escala):
+        """exp(-días / escala) por evento; 0 para los que no tienen fecha."""
+        if self.dias_np is not None:
+            return np.nan_to_num(np.exp(-np.abs(self.dias_np - referencia) / escala))
+        return [math.exp(-abs(d - referencia) / escala) if d is not None else 0.0 for d in self.dias]
+
+    def coincidencias(self, palabras):
+        """Fracción de `palabras` que aparece en cada evento."""
+        if np is not None:
+            cuenta = np.zeros(len(self))
+            for palabra in palabras:
+                if palabra in self.por_palabra:
+                    cuenta[self.por_palabra[palabra]] += 1  # posiciones sin repetir
+            return cuenta / len(palabras)
+        cuenta = [0] * len(self)
+        for palabra in palabras:
+            for i in self.por_palabra.get(palabra, ()):
+                cuenta[i] += 1
+        return [c / len(palabras) for c in cuenta]
+
+    def similitudes(self, vector):
+        if np is not None:
+            vector = np.asarray(vector, dtype=np.float32)
+            return np.maximum(self.matriz @ vector, 0.0) / (float(np.linalg.norm(vector)) or 1.0)
+        vector = _normalizar_vector(vector)
+        return [max(0.0, sum(a * b for a, b in zip(v, vector))) for v in self.matriz]
+
+
+class SelectorEventos:
+    def __init__(self, embeber=None, presupuesto=512, max_indices=256, pesos=None,
+                 reintento_embeddings=REINTENTO_EMBEDDINGS):
+        """
+        `embeber(textos)` devuelve un vector por texto; si es None (o falla) se puntúa
+        solo por fecha y palabras.
+        """
+        self.embeber = embeber
+        self.presupuesto = presupuesto
+        self.max_indices = max_indices
+        self.pesos = dict(pesos or PESOS)
+        self.reintento_embeddings = reintento_embeddings
+        self._indices = OrderedDict()
+        self._lock = threading.Lock()
+
+    # -----------------------------
+    # Índice por persona
+    # -----------------------------
+    def _vectores(self, eventos, anterior):
+        """
+        Embeddings de los eventos, reutilizando los del índice anterior. Lanza la excepción
+        de `embeber` si falla.
+        """
+        previos = anterior.vectores if anterior is not None and anterior.vectores is not None else {}
+        nuevos = [e for e in eventos if e.get("id") not in previos]
+        vectores = {i: previos[i] for i in (e.get("id") for e in eventos) if i in previos}
+        if nuevos:
+            calculados = self.embeber([texto_evento(e) or renderizar_evento(e) for e in nuevos])
+            for evento, vector in zip(nuevos, calculados):
+                vectores[evento.get("id")] = _normalizar_vector(vector)
+        return vectores
+
+    def indice(self, persona, version, cargar_eventos):
+        """
+        Índice de la persona para `version`. `cargar_eventos()` solo se llama si hay que
+        reconstruirlo; devuelve la lista de eventos (con id y fecha_iso).
+        """
+        clave = persona.lower()
+        with self._lock:
+            anterior = self._indices.get(clave)
+            if anterior is not None and anterior.version == version and not self._reintentar(anterior):
+                self._indices.move_to_end(clave)
+                return anterior
+
+        eventos = cargar_eventos()
+        vectores, fallo = None, None
+        if (self.embeber is not None and eventos
+                and sum(estimar_tokens(renderizar_evento(e)) for e in eventos) > self.presupuesto):
+            # Solo hace falta puntuar (y por tanto embeber) si no caben todos
+            try:
+                vectores = self._vectores(eventos, anterior)
+            except Exception as e:
+                logger.warning(f"⚠️ Sin embeddings para los eventos de {persona}, se seleccionan por fecha y palabras: {e}")
+                fallo = time.monotonic()
+                vectores = anterior.vectores if anterior is not None else None
+        indice = IndiceEventos(version, eventos, vectores, fallo)
+
+        with self._lock:
+            self._indices[clave] = indice
+            self._indices.move_to_end(clave)
+            while len(self._indices) > self.max_indices:
+                self._indices.popitem(last=False)
+        return indice
+
+    def _reintentar(self, indice):
+        return (indice.fallo_embeddings is not None
+                and time.monotonic() - indice.fallo_embeddings >= self.reintento_embeddings)
+
+    def invalidar(self, persona):
+        """Descarta el índice de la persona (y sus embeddings). Al añadir eventos no hace falta: basta la versión."""
+        with self._lock:
+            self._indices.pop(persona.lower(), None)
+
+    # -----------------------------
+    # Selección
+    # -----------------------------
+    def necesita_vector(self, indice):
+        """True si la selección usaría el embedding de la pregunta."""
+        return indice.matriz is not None and indice.tokens_total > self.presupuesto
+
+    def puntuar(self, indice, pregunta=None, vector=None, hoy=None):
+        """Puntuación de cada evento entre 0 y 1 (array de numpy si está disponible)."""
+        hoy = hoy or date.today()
+        fecha_pregunta = None
+        palabras = set()
+        if pregunta:
+            fecha_pregunta, _ = extraer_fecha(normalizar(str(pregunta)), hoy)
+            palabras = palabras_clave(pregunta)
+
+        if fecha_pregunta is not None:
+            referencia, escala, peso_fecha = fecha_pregunta.toordinal(), ESCALA_FECHA_PREGUNTA, self.pesos["fecha"]
+        else:
+            referencia, escala, peso_fecha = hoy.toordinal(), ESCALA_FECHA_HOY, self.pesos["fecha"] * PESO_FECHA_HOY
+        senales = [(peso_fecha, indice.cercania(referencia, escala))]
+        if palabras:
+            senales.append((self.pesos["palabras"], indice.coincidencias(palabras)))
+        if vector is not None and indice.matriz is not None:
+            senales.append((self.pesos["embeddings"], indice.similitudes(vector)))
+
+        total = sum(peso for peso, _ in senales) or 1.0
+        if np is not None:
+            return sum(peso * valores for peso, valores in senales) / total
+        return [sum(peso * valores[i] for peso, valores in senales) / total for i in range(len(indice))]
+
+    def seleccionar(self, indice, pregunta=None, vector=None, hoy=None):
+        """
+        Devuelve (lineas, info): las líneas de los eventos elegidos en su orden original y
+        un resumen de la selección. Si todos caben en el presupuesto se devuelven todos.
+        """
+        info = {"total": len(indice), "presupuesto_tokens": self.presupuesto}
+        if indice.tokens_total <= self.presupuesto:
+            info.update({"incluidos": len(indice), "tokens": indice.tokens_total})
+            return list(indice.lineas), info
+
+        puntuaciones = self.puntuar(indice, pregunta, vector, hoy)
+        if np is not None:
+            # Orden estable de mayor a menor; a igual puntuación gana el evento más nuevo
+            orden = (len(indice) - 1 - np.argsort(-puntuaciones[::-1], kind="stable")).tolist()
+        else:
+            orden = sorted(range(len(indice)), key=lambda i: (-puntuaciones[i], -i))
+        elegidos, tokens = empaquetar_fragmentos(orden, self.presupuesto, coste=indice.tokens.__getitem__,
+                                                 minimo=indice.tokens_min)
+        elegidos.sort()
+        info.update({"incluidos": len(elegidos), "tokens": tokens, "embeddings": vector is not None})
+        return [indice.lineas[i] for i in elegidos], info
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                "personas": len(self._indices),
+                "eventos": sum(len(i) for i in self._indices.values()),
+                "palabras": sum(len(i.por_palabra) for i in self._indices.values()),
+                "con_embeddings": sum(1 for i in self._indices.values() if i.matriz is not None),
+            }
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sesiones por persona para reutilizar la caché KV de Ollama.
+
+Ollama reutiliza la caché KV cuando el principio del prompt coincide byte a byte con
+la petición anterior y el modelo sigue cargado (keep_alive). En modo sesión el servidor
+guarda la lista de mensajes ya enviada para cada persona y solo añade al final los
+turnos nuevos, así Ollama solo evalúa la última pregunta.
+
+La sesión se reinicia si cambia el system prompt de la persona o si los mensajes ya
+no caben en el presupuesto de tokens. Las sesiones se desalojan por LRU al superar un
+máximo de memoria estimada, por inactividad o cuando el sistema va justo de memoria.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def memoria_disponible_mb():
+    """MemAvailable de /proc/meminfo en MB, o None si no se puede leer."""
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for linea in f:
+                if linea.startswith("MemAvailable:"):
+                    return int(linea.split()[1]) // 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+class Sesion:
+    def __init__(self, persona, contexto, mensajes):
+        self.persona = persona
+        self.contexto = contexto
+        self.mensajes = mensajes
+        self.ultimo_uso = time.monotonic()
+        self.turnos = 0
+        self.lock = threading.Lock()
+
+    def instantanea(self):
+        """Copia de los mensajes tomada con el lock: otra petición puede estar añadiendo un turno."""
+        with self.lock:
+            return list(self.mensajes)
+
+    @property
+    def tamano(self):
+        return sum(len(m["content"]) for m in self.instantanea())
+
+
+class GestorSesiones:
+    def __init__(self, max_sesiones=100, max_bytes=50 * 1024 * 1024, ttl=1800, memoria_minima_mb=512):
+        self.max_sesiones = max_sesiones
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.memoria_minima_mb = memoria_minima_mb
+        self._sesiones = OrderedDict()
+        self._lock = threading.Lock()
+
+    def obtener(self, persona, contexto, crear_mensajes):
+        """
+        Devuelve la sesión de la persona. Si no existe, ha caducado o el system prompt ha
+        cambiado, se crea una nueva con `crear_mensajes()` (system prompt + historial recortado).
+        """
+        with self._lock:
+            sesion = self._sesiones.get(persona)
+            if sesion and (sesion.contexto != contexto or time.monotonic() - sesion.ultimo_uso > self.ttl):
+                logger.debug(f"♻️ Sesión de {persona} invalidada")
+                sesion = None
+            if sesion is None:
+                sesion = Sesion(persona, contexto, crear_mensajes())
+                self._sesiones[persona] = sesion
+            self._sesiones.move_to_end(persona)
+            sesion.ultimo_uso = time.monotonic()
+            return sesion
+
+    def anadir_turno(self, sesion, pregunta, respuesta):
+        with sesion.lock:
+            sesion.mensajes.append({"role": "user", "content": str(pregunta)})
+            sesion.mensajes.append({"role": "assistant", "content": str(respuesta)})
+            sesion.turnos += 1
+        self._desalojar()
+
+    def descartar(self, persona):
+        with self._lock:
+            self._sesiones.pop(persona, None)
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                "sesiones": len(self._sesiones),
+                "bytes": sum(s.tamano for s in self._sesiones.values()),
+            }
+
+    def _desalojar(self):
+        with self._lock:
+            ahora = time.monotonic()
+            for persona in [p for p, s in self._sesiones.items() if ahora - s.ultimo_uso > self.ttl]:
+                del self._sesiones[persona]
+
+            total = sum(s.tamano for s in self._sesiones.values())
+            memoria = memoria_disponible_mb()
+            presion = memoria is not None and memoria < self.memoria_minima_mb
+            while self._sesiones and (len(self._sesiones) > self.max_sesiones or total > self.max_bytes or presion):
+                persona, sesion = self._sesiones.popitem(last=False)
+                total -= sesion.tamano
+                logger.info(f"🧹 Sesión de {persona} desalojada (memoria disponible: {memoria} MB)")
+                # Con presión de memoria basta con liberar la mitad de las sesiones
+                if presion and len(self._sesiones) <= self.max_sesiones // 2:
+                    break
@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+"""Los módulos de la API son ficheros sueltos en scrics/api: se importan por su nombre."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+import os
+
+from bloqueo_ficheros import BloqueoFichero, BloqueosPorNombre, escribir_json_atomico, tomar_bloqueo_sin_espera
+
+
+def test_bloqueo_sin_espera_es_exclusivo(tmp_path):
+    ruta = str(tmp_path / "escritor.lock")
+    fd = tomar_bloqueo_sin_espera(ruta)
+    assert fd is not None
+    # Otro descriptor sobre el mismo fichero, como el de otro proceso
+    assert tomar_bloqueo_sin_espera(ruta) is None
+    os.close(fd)
+    otro = tomar_bloqueo_sin_espera(ruta)
+    assert otro is not None
+    os.close(otro)
+
+
+def test_bloqueo_reentrante(tmp_path):
+    bloqueo = BloqueoFichero(str(tmp_path / "diario.lock"))
+    with bloqueo:
+        with bloqueo:
+            pass
+        fd = tomar_bloqueo_sin_espera(bloqueo.ruta)
+        assert fd is None
+    fd = tomar_bloqueo_sin_espera(bloqueo.ruta)
+    assert fd is not None
+    os.close(fd)
+
+
+def test_bloqueos_por_nombre_sin_distinguir_mayusculas(tmp_path):
+    bloqueos = BloqueosPorNombre(str(tmp_path / "locks"))
+    assert bloqueos("Laia") is bloqueos("laia")
+    assert bloqueos("Laia") is not bloqueos("Jandro")
+
+
+def test_escribir_json_atomico(tmp_path):
+    ruta = str(tmp_path / "datos.json")
+    escribir_json_atomico(ruta, {"ñ": 1})
+    with open(ruta, encoding="utf-8") as f:
+        assert f.read() == '{"ñ": 1}'
+    assert os.listdir(tmp_path) == ["datos.json"]
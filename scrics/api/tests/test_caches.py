@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import cache_respuestas
+import cache_semantica
+from cache_respuestas import CacheRespuestas, clave_cache
+from cache_semantica import CacheSemantica
+
+
+class Reloj:
+    def __init__(self):
+        self.ahora = 1000.0
+
+    def __call__(self):
+        return self.ahora
+
+
+@pytest.fixture
+def reloj(monkeypatch):
+    reloj = Reloj()
+    monkeypatch.setattr(cache_respuestas.time, "time", reloj)
+    monkeypatch.setattr(cache_semantica.time, "time", reloj)
+    return reloj
+
+
+def test_clave_normaliza_la_pregunta():
+    assert clave_cache("¿Qué tiempo hace?", "m") == clave_cache("  qué   TIEMPO hace ", "m")
+    assert clave_cache("qué tiempo hace", "m") != clave_cache("qué tiempo hace", "otro")
+    assert clave_cache("hola", "m", {"k": 1}) != clave_cache("hola", "m", {"k": 2})
+
+
+def test_respuestas_caducan(reloj):
+    cache = CacheRespuestas(ttl=10)
+    cache.guardar("a", "respuesta")
+    reloj.ahora += 9
+    assert cache.obtener("a") == "respuesta"
+    reloj.ahora += 2
+    assert cache.obtener("a") is None
+    assert cache.estadisticas()["entradas"] == 0
+
+
+def test_respuestas_lru(reloj):
+    cache = CacheRespuestas(max_entradas=2)
+    cache.guardar("a", 1)
+    cache.guardar("b", 2)
+    assert cache.obtener("a") == 1  # "a" pasa a ser la más reciente
+    cache.guardar("c", 3)
+    assert cache.obtener("b") is None
+    assert (cache.obtener("a"), cache.obtener("c")) == (1, 3)
+    assert cache.estadisticas() == {"entradas": 2, "aciertos": 3, "fallos": 1, "ratio_aciertos": 0.75}
+
+
+def test_respuestas_persistidas_sin_las_caducadas(tmp_path, reloj):
+    ruta = str(tmp_path / "cache.json")
+    cache = CacheRespuestas(ttl=10, ruta_persistencia=ruta)
+    cache.guardar("vieja", 1)
+    reloj.ahora += 5
+    cache.guardar("nueva", 2)
+    cache.persistir()
+    reloj.ahora += 6
+    recargada = CacheRespuestas(ttl=10, ruta_persistencia=ruta)
+    assert recargada.obtener("vieja") is None
+    assert recargada.obtener("nueva") == 2
+
+
+def test_semantica_umbral(reloj):
+    cache = CacheSemantica(umbral=0.9)
+    cache.guardar("laia", [1.0, 0.0], "¿qué cenamos?", "pizza")
+    respuesta, similitud, pregunta = cache.buscar("laia", [0.99, 0.05])
+    assert (respuesta, pregunta) == ("pizza", "¿qué cenamos?")
+    assert similitud > 0.9
+    assert cache.buscar("laia", [0.0, 1.0])[0] is None
+    assert cache.buscar("jandro", [1.0, 0.0])[0] is None
+
+
+def test_semantica_caduca(reloj):
+    cache = CacheSemantica(umbral=0.9, ttl=10)
+    cache.guardar("laia", [1.0, 0.0], "p", "r")
+    reloj.ahora += 11
+    assert cache.buscar("laia", [1.0, 0.0]) == (None, 0.0, None)
+    assert cache.estadisticas()["entradas"] == 0
+
+
+def test_semantica_maximo_por_espacio(reloj):
+    cache = CacheSemantica(umbral=0.99, max_por_espacio=2)
+    cache.guardar("laia", [1.0, 0.0, 0.0], "p1", "r1")
+    cache.guardar("laia", [0.0, 1.0, 0.0], "p2", "r2")
+    cache.guardar("laia", [0.0, 0.0, 1.0], "p3", "r3")
+    assert cache.buscar("laia", [1.0, 0.0, 0.0])[0] is None
+    assert cache.buscar("laia", [0.0, 0.0, 1.0])[0] == "r3"
+    cache.invalidar("laia")
+    assert cache.estadisticas()["entradas"] == 0
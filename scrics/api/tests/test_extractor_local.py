@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import json
+from datetime import date
+
+from extractor_local import CONFIANZA_LUGAR_AMBIGUO, ExtractorLocal, extraer_fecha, normalizar
+
+HOY = date(2025, 12, 10)  # miércoles
+
+
+def fecha(texto):
+    return extraer_fecha(normalizar(texto), HOY)[0]
+
+
+def test_fechas_explicitas():
+    assert fecha("El 1 de mayo del 2024 fui al concierto") == date(2024, 5, 1)
+    assert fecha("el 15/08/2023 estuvimos en la playa") == date(2023, 8, 15)
+    assert fecha("reunión el 2024-05-01") == date(2024, 5, 1)
+
+
+def test_fechas_relativas():
+    assert fecha("hoy he cenado fuera") == HOY
+    assert fecha("ayer fui al cine") == date(2025, 12, 9)
+    assert fecha("anteayer fui al cine") == date(2025, 12, 8)
+    assert fecha("hace dos semanas fuimos a Toledo") == date(2025, 11, 26)
+
+
+def test_sin_fecha():
+    assert fecha("fui al cine con Ana") is None
+
+
+def test_extraer_con_todos_los_campos_es_fiable():
+    extractor = ExtractorLocal(umbral=0.8)
+    resultado = extractor.extraer("Ayer fui a cenar al restaurante Coque de Madrid", hoy=HOY)
+    assert resultado["FECHA"] == "09/12/2025"
+    assert resultado["TIPO"] == "Cena"
+    assert resultado["LUGAR"] == "Madrid"
+    assert extractor.es_fiable(resultado)
+
+
+def test_el_nombre_mas_largo_gana():
+    lugar, confianza = ExtractorLocal().extraer_lugar("Paseo por la Casa de Campo")
+    assert lugar == "Casa de Campo"
+    assert confianza == 1.0
+
+
+def test_lugares_ambiguos_sin_preposicion_no_cuentan():
+    extractor = ExtractorLocal()
+    assert extractor.extraer_lugar("me di un golpe en la palma de la mano") == (None, 0.0)
+    assert extractor.extraer_lugar("Palma de la mano dolorida") == (None, 0.0)
+    assert extractor.extraer_lugar("me comí una granada") == (None, 0.0)
+
+
+def test_lugares_ambiguos_con_preposicion_cuentan_con_media_confianza():
+    extractor = ExtractorLocal()
+    assert extractor.extraer_lugar("cena en Palma con amigos") == ("Palma", CONFIANZA_LUGAR_AMBIGUO)
+    assert extractor.extraer_lugar("paseo por el Retiro") == ("Retiro", CONFIANZA_LUGAR_AMBIGUO)
+
+
+def test_un_lugar_ambiguo_baja_la_confianza():
+    extractor = ExtractorLocal()
+    ambiguo = extractor.extraer("ayer cena en Granada", hoy=HOY)
+    claro = extractor.extraer("ayer cena en Sevilla", hoy=HOY)
+    assert ambiguo["LUGAR"] == "Granada"
+    assert ambiguo["confianza"] < claro["confianza"]
+
+
+def test_lugares_de_fichero(tmp_path):
+    fichero = tmp_path / "lugares.json"
+    fichero.write_text(json.dumps(["Sala Clamores"]), encoding="utf-8")
+    extractor = ExtractorLocal(lugares_file=str(fichero))
+    assert extractor.extraer_lugar("concierto en la Sala Clamores") == ("Sala Clamores", 1.0)
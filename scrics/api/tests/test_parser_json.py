@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+import json
+
+from extraccion_estructurada import ParserJsonIncremental
+
+
+def alimentar_a_trozos(texto, tamano):
+    parser = ParserJsonIncremental()
+    completos = []
+    for i in range(0, len(texto), tamano):
+        completos.extend(parser.alimentar(texto[i:i + tamano]))
+    return completos
+
+
+def test_objeto_partido_en_trozos():
+    texto = '{"FECHA": "2024-05-01", "TIPO": "Concierto", "LUGAR": "Vigo"}'
+    for tamano in (1, 3, 7, len(texto)):
+        assert alimentar_a_trozos(texto, tamano) == [texto]
+
+
+def test_no_devuelve_nada_hasta_cerrar_el_objeto():
+    parser = ParserJsonIncremental()
+    assert parser.alimentar('{"TIPO": "Cena", "LUGAR": {"ciudad": "Madrid"}') == []
+    assert parser.alimentar("}") == ['{"TIPO": "Cena", "LUGAR": {"ciudad": "Madrid"}}']
+
+
+def test_ignora_el_texto_fuera_de_los_objetos():
+    texto = 'Aquí tienes el JSON: {"a": 1} y algo de charla extra {"b": 2}.'
+    assert alimentar_a_trozos(texto, 4) == ['{"a": 1}', '{"b": 2}']
+
+
+def test_llaves_y_comillas_dentro_de_strings():
+    objeto = {"notas": 'dijo "hola {amigo}" y se fue }', "ruta": "C:\\\\tmp\\\\"}
+    texto = json.dumps(objeto, ensure_ascii=False)
+    completos = alimentar_a_trozos(texto, 2)
+    assert len(completos) == 1
+    assert json.loads(completos[0]) == objeto
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from persona_store import PersonaStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return PersonaStore(str(tmp_path / "personas.db"))
+
+
+def turnos(store, nombre):
+    return [(r["usuario"], r["asistente"]) for r in store.ultimos(nombre)]
+
+
+def test_ultimos_en_orden_cronologico(store):
+    for i in range(5):
+        store.anadir("Laia", f"p{i}", f"r{i}")
+    assert turnos(store, "Laia") == [(f"p{i}", f"r{i}") for i in range(5)]
+    assert [r["usuario"] for r in store.ultimos("Laia", 2)] == ["p3", "p4"]
+    assert store.numero_turnos("Laia") == 5
+
+
+def test_ultimos_sin_historial(store):
+    assert store.ultimos("nadie") == []
+    assert store.ultimos("nadie", 3) == []
+    assert store.numero_turnos("nadie") == 0
+
+
+def test_nombres_sin_distinguir_mayusculas(store):
+    store.anadir("Laia", "hola", "qué tal")
+    store.anadir("LAIA", "adiós", "hasta luego")
+    assert turnos(store, "laia") == [("hola", "qué tal"), ("adiós", "hasta luego")]
+    assert store.nombre_canonico("laia") == "Laia"
+
+
+def test_anadir_estima_tokens(store):
+    registro = store.anadir("Laia", "una pregunta", "una respuesta")
+    assert registro["tokens_usuario"] > 0
+    assert store.ultimos("Laia")[0]["tokens_asistente"] == registro["tokens_asistente"]
+
+
+def test_reemplazar(store):
+    for i in range(4):
+        store.anadir("Laia", f"p{i}", f"r{i}")
+    store.reemplazar("Laia", [("resumen", "ok")])
+    assert turnos(store, "Laia") == [("resumen", "ok")]
+
+
+def test_reemplazar_conserva_los_turnos_nuevos(store):
+    for i in range(3):
+        store.anadir("Laia", f"p{i}", f"r{i}")
+    # Mientras se resumían los 3 primeros llegan dos turnos más
+    store.anadir("Laia", "p3", "r3")
+    store.anadir("Laia", "p4", "r4")
+    store.reemplazar("Laia", [("resumen", "ok")], conservar_desde=3)
+    assert turnos(store, "Laia") == [("resumen", "ok"), ("p3", "r3"), ("p4", "r4")]
+
+
+def test_reemplazar_no_toca_otras_personas(store):
+    store.anadir("Laia", "p", "r")
+    store.anadir("Jandro", "p", "r")
+    store.reemplazar("Laia", [])
+    assert turnos(store, "Laia") == []
+    assert turnos(store, "Jandro") == [("p", "r")]
+
+
+def test_version_cambia_con_cada_evento(store):
+    assert store.version("Laia") is None
+    store.anadir_evento("Laia", {"tipo": "Cena", "nombre": "Coque", "lugar": "Madrid", "fecha": "2025/12/08"})
+    version = store.version("laia")
+    assert version is not None
+    store.anadir_evento("Laia", {"tipo": "Cine", "nombre": "Dune", "lugar": "Vigo", "fecha": ""})
+    assert store.version("Laia") > version
+    assert [e["fecha_iso"] for e in store.eventos("Laia")] == ["2025-12-08", None]
+
+
+def test_trabajos(store):
+    trabajo = {"id": "a", "tipo": "resumir", "estado": "completado", "creado": 1.0,
+               "terminado": 2.0, "resultado": {"turnos": 3, "persona": "Laia"}}
+    store.guardar_trabajo(trabajo)
+    guardado = store.trabajo("a")
+    assert guardado["estado"] == "completado"
+    assert guardado["resultado"] == {"turnos": 3, "persona": "Laia"}
+    assert store.trabajo("b") is None
+
+
+def test_trabajos_se_purgan_los_terminados_mas_antiguos(store):
+    store.guardar_trabajo({"id": "en_marcha", "tipo": "t", "estado": "ejecutando", "creado": 0.0})
+    for i in range(5):
+        store.guardar_trabajo({"id": f"t{i}", "tipo": "t", "estado": "completado", "creado": float(i + 1),
+                               "terminado": float(i + 1)}, max_historico=3)
+    assert store.trabajo("en_marcha") is not None
+    assert [store.trabajo(f"t{i}") is not None for i in range(5)] == [False, False, False, True, True]
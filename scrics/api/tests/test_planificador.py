@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+import pytest
+
+from planificador import Planificador, Saturado
+
+CLASES = {
+    "chat": {"prioridad": 0, "max_cola": 4, "espera_max": 5},
+    "resumen": {"prioridad": 1, "max_cola": 4, "espera_max": None},
+    "lleno": {"prioridad": 2, "max_cola": 0, "espera_max": 5},
+    "impaciente": {"prioridad": 3, "max_cola": 4, "espera_max": 0.05},
+}
+
+
+def test_cola_llena_o_espera_agotada():
+    planificador = Planificador(max_en_vuelo=1, clases=CLASES)
+    with planificador.admitir("chat", "m"):
+        with pytest.raises(Saturado) as error:
+            planificador.admitir("lleno", "m")
+        assert error.value.retry_after >= 1
+        with pytest.raises(Saturado):
+            planificador.admitir("impaciente", "m")
+        # Otro modelo tiene sus propios huecos
+        with planificador.admitir("chat", "otro"):
+            pass
+    clases = planificador.estadisticas()["clases"]
+    assert clases["lleno"]["rechazadas"] == clases["impaciente"]["rechazadas"] == 1
+    assert planificador.estadisticas()["modelos"]["m"]["en_vuelo"] == 0
+
+
+def test_pasa_primero_la_clase_de_mas_prioridad():
+    planificador = Planificador(max_en_vuelo=1, clases=CLASES)
+    orden = []
+
+    def generar(clase):
+        with planificador.admitir(clase, "m"):
+            orden.append(clase)
+
+    turno = planificador.admitir("chat", "m")
+    hilos = [threading.Thread(target=generar, args=("resumen",))]
+    hilos[0].start()
+    time.sleep(0.05)  # el resumen ya está en cola antes que el chat
+    hilos.append(threading.Thread(target=generar, args=("chat",)))
+    hilos[1].start()
+    time.sleep(0.05)
+    turno.liberar()
+    for hilo in hilos:
+        hilo.join(2)
+    assert orden == ["chat", "resumen"]
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+from datetime import date
+
+import pytest
+
+import seleccion_eventos
+from seleccion_eventos import SelectorEventos
+
+
+def evento(i, **campos):
+    return {"id": i, "tipo": "Cena", "nombre": f"Sitio {i}", "lugar": "Madrid", "fecha": "",
+            "fecha_iso": None, "notas": "", **campos}
+
+
+class Embeber:
+    def __init__(self):
+        self.llamadas = []
+        self.fallar = False
+
+    def __call__(self, textos):
+        self.llamadas.append(len(textos))
+        if self.fallar:
+            raise RuntimeError("timeout")
+        return [[1.0, float(len(t)), 0.5] for t in textos]
+
+
+@pytest.fixture
+def embeber():
+    return Embeber()
+
+
+def test_si_caben_todos_no_se_embebe(embeber):
+    selector = SelectorEventos(embeber=embeber, presupuesto=10_000)
+    indice = selector.indice("Laia", 1, lambda: [evento(i) for i in range(5)])
+    lineas, info = selector.seleccionar(indice, "¿dónde cenamos?")
+    assert len(lineas) == 5
+    assert info["incluidos"] == info["total"] == 5
+    assert embeber.llamadas == []
+
+
+def test_nueva_version_solo_embebe_los_eventos_nuevos(embeber):
+    selector = SelectorEventos(embeber=embeber, presupuesto=50)
+    eventos = [evento(i) for i in range(20)]
+    selector.indice("Laia", 1, lambda: eventos)
+    indice = selector.indice("laia", 2, lambda: eventos + [evento(20, tipo="Cine")])
+    assert embeber.llamadas == [20, 1]
+    assert indice.matriz is not None
+    # Misma versión: no se vuelve a cargar ni a embeber
+    assert selector.indice("Laia", 2, lambda: pytest.fail("no debe recargar")) is indice
+
+
+def test_fallo_de_embeddings_se_reintenta(embeber, monkeypatch):
+    reloj = [100.0]
+    monkeypatch.setattr(seleccion_eventos.time, "monotonic", lambda: reloj[0])
+    selector = SelectorEventos(embeber=embeber, presupuesto=50, reintento_embeddings=60)
+    eventos = [evento(i) for i in range(20)]
+    selector.indice("Laia", 1, lambda: eventos)
+    embeber.fallar = True
+    eventos = eventos + [evento(20)]
+    indice = selector.indice("Laia", 2, lambda: eventos)
+    assert indice.matriz is None
+    embeber.fallar = False
+    assert selector.indice("Laia", 2, lambda: eventos) is indice  # antes de REINTENTO_EMBEDDINGS
+    reloj[0] += 60
+    indice = selector.indice("Laia", 2, lambda: eventos)
+    assert indice.matriz is not None
+    assert embeber.llamadas == [20, 1, 1]
+
+
+def test_seleccion_por_fecha_y_palabras():
+    selector = SelectorEventos(presupuesto=40)
+    eventos = [evento(i, fecha_iso=f"2024-0{1 + i % 9}-01") for i in range(30)]
+    eventos.append(evento(30, tipo="Concierto", nombre="Rosalía", fecha_iso="2025-11-02"))
+    indice = selector.indice("Laia", 1, lambda: eventos)
+    lineas, info = selector.seleccionar(indice, "¿qué tal el concierto de Rosalía?", hoy=date(2025, 12, 1))
+    assert info["incluidos"] < info["total"]
+    assert info["tokens"] <= 40
+    assert any("Rosalía" in linea for linea in lineas)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import threading
+
+from persona_store import PersonaStore
+from trabajos import COMPLETADO, ERROR, ColaTrabajos
+
+
+def esperar(cola, id_trabajo):
+    cola._cola.join()
+    return cola.estado(id_trabajo)
+
+
+def test_trabajo_completado_y_con_error():
+    cola = ColaTrabajos()
+    ok = cola.encolar("suma", lambda a, b: a + b, 2, 3)
+    mal = cola.encolar("division", lambda: 1 / 0)
+    assert esperar(cola, ok)["estado"] == COMPLETADO
+    assert cola.estado(ok)["resultado"] == 5
+    assert cola.estado(mal)["estado"] == ERROR
+    assert "division" in cola.estado(mal)["error"]
+    assert cola.estado("no-existe") is None
+
+
+def test_misma_clave_mismo_trabajo():
+    soltar = threading.Event()
+    cola = ColaTrabajos()
+    primero = cola.encolar("resumir", soltar.wait, clave="laia")
+    assert cola.encolar("resumir", soltar.wait, clave="laia") == primero
+    soltar.set()
+    esperar(cola, primero)
+    assert cola.encolar("resumir", soltar.wait, clave="laia") != primero
+
+
+def test_estado_visible_desde_otro_proceso(tmp_path):
+    ruta = str(tmp_path / "personas.db")
+    cola = ColaTrabajos(almacen=PersonaStore(ruta))
+    id_trabajo = cola.encolar("resumir", lambda: {"turnos": 4})
+    esperar(cola, id_trabajo)
+    # Otra cola con su propia conexión, como la de otro worker
+    otra = ColaTrabajos(almacen=PersonaStore(ruta))
+    trabajo = otra.estado(id_trabajo)
+    assert trabajo["estado"] == COMPLETADO
+    assert trabajo["resultado"] == {"turnos": 4}
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cola de trabajos en segundo plano.
+
+Los trabajos largos (como resumir un historial) se encolan y los ejecutan hilos
+trabajadores, así no ocupan un worker de Flask mientras Ollama genera. Cada trabajo
+tiene un id para consultar su estado.
+
+El trabajo lo ejecuta el proceso que lo encola, pero con varios workers la consulta puede
+llegar a otro. Si se pasa un `almacen` (PersonaStore), cada cambio de estado se guarda
+también en SQLite y estado() lo busca ahí cuando no es de este proceso.
+"""
+
+import logging
+import queue
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+PENDIENTE = "pendiente"
+EJECUTANDO = "ejecutando"
+COMPLETADO = "completado"
+ERROR = "error"
+
+
+class ColaTrabajos:
+    def __init__(self, num_hilos=1, max_historico=1000, almacen=None):
+        self.max_historico = max_historico
+        self.almacen = almacen
+        self._cola = queue.Queue()
+        self._trabajos = OrderedDict()
+        self._activos = {}  # clave de deduplicación -> id de trabajo pendiente o en ejecución
+        self._lock = threading.Lock()
+        self._hilos = []
+        for i in range(num_hilos):
+            hilo = threading.Thread(target=self._bucle, name=f"trabajos-{i}", daemon=True)
+            hilo.start()
+            self._hilos.append(hilo)
+
+    def encolar(self, tipo, funcion, *args, clave=None, **kwargs):
+        """
+        Encola `funcion(*args, **kwargs)` y devuelve el id del trabajo.
+        Si ya hay un trabajo pendiente o en ejecución con la misma `clave`, devuelve su id.
+        """
+        with self._lock:
+            if clave is not None and clave in self._activos:
+                return self._activos[clave]
+            id_trabajo = uuid.uuid4().hex
+            trabajo = self._trabajos[id_trabajo] = {
+                "id": id_trabajo,
+                "tipo": tipo,
+                "estado": PENDIENTE,
+                "creado": time.time(),
+                "iniciado": None,
+                "terminado": None,
+                "resultado": None,
+                "error": None,
+            }
+            if clave is not None:
+                self._activos[clave] = id_trabajo
+            self._purgar()
+            trabajo = dict(trabajo)
+        self._persistir(trabajo, purgar=True)
+        self._cola.put((id_trabajo, clave, funcion, args, kwargs))
+        logger.info(f"📥 Trabajo {tipo} encolado: {id_trabajo}")
+        return id_trabajo
+
+    def estado(self, id_trabajo):
+        with self._lock:
+            trabajo = self._trabajos.get(id_trabajo)
+            if trabajo:
+                return dict(trabajo)
+        if self.almacen is not None:
+            try:
+                return self.almacen.trabajo(id_trabajo)
+            except Exception as e:
+                logger.warning(f"⚠️ No se pudo leer el trabajo {id_trabajo} de la base de datos: {e}")
+        return None
+
+    def pendientes(self):
+        return self._cola.qsize()
+
+    def _purgar(self):
+        """Olvida los trabajos terminados más antiguos si se supera el máximo."""
+        terminados = [k for k, t in self._trabajos.items() if t["estado"] in (COMPLETADO, ERROR)]
+        sobrantes = len(self._trabajos) - self.max_historico
+        for k in terminados[:max(0, sobrantes)]:
+            del self._trabajos[k]
+
+    def _persistir(self, trabajo, purgar=False):
+        """Guarda el estado en el almacén compartido; si falla, el trabajo sigue (solo se ve en este proceso)."""
+        if self.almacen is None:
+            return
+        try:
+            self.almacen.guardar_trabajo(trabajo, self.max_historico if purgar else None)
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudo guardar el trabajo {trabajo['id']} en la base de datos: {e}")
+
+    def _actualizar(self, id_trabajo, **campos):
+        with self._lock:
+            self._trabajos[id_trabajo].update(campos)
+            trabajo = dict(self._trabajos[id_trabajo])
+        self._persistir(trabajo)
+
+    def _bucle(self):
+        while True:
+            id_trabajo, clave, funcion, args, kwargs = self._cola.get()
+            self._actualizar(id_trabajo, estado=EJECUTANDO, iniciado=time.time())
+            try:
+                resultado = funcion(*args, **kwargs)
+                self._actualizar(id_trabajo, estado=COMPLETADO, resultado=resultado, terminado=time.time())
+                logger.info(f"✅ Trabajo {id_trabajo} completado")
+            except Exception as e:
+                logger.error(f"❌ Error en trabajo {id_trabajo}: {e}")
+                logger.error(f"   Traceback: {traceback.format_exc()}")
+                self._actualizar(id_trabajo, estado=ERROR, error=str(e), terminado=time.time())
+            finally:
+                with self._lock:
+                    if clave is not None and self._activos.get(clave) == id_trabajo:
+                        del self._activos[clave]
+                self._cola.task_done()